@@ -1,12 +1,12 @@
-import pathlib
-
 import streamlit as st
 
 from src.models.claan import Claan
-from src.utils.data.scores import get_scores
-from src.utils.data.stocks import get_corporate_data
+from src.utils.assets import show_image
 from src.utils.database import Database
-from src.utils.logger import LOGGER
+from src.utils.jobs import sync_jobs
+from src.utils.snapshot import get_portal_snapshot
+from src.utils.tenancy import select_tenant
+from src.utils.tracing import trace_rerun
 
 
 def init_page() -> None:
@@ -33,26 +33,19 @@ def init_page() -> None:
         st.session_state["db_session"] = Database.get_session()
     if st.session_state["db_session"].in_transaction():
         st.session_state["db_session"].rollback()
-    if "scores" not in st.session_state:
-        LOGGER.info("Loading `scores`")
-        st.session_state["scores"] = get_scores(_session=st.session_state["db_session"])
-    for claan in Claan:
-        if f"data_{claan.name}" not in st.session_state:
-            LOGGER.info(f"Loading `data_{claan.name}`")
-            st.session_state[f"data_{claan.name}"] = get_corporate_data(
-                _session=st.session_state["db_session"], claan=claan
-            )
+    tenant = select_tenant(_session=st.session_state["db_session"])
+    sync_jobs(_session=st.session_state["db_session"])
+    snapshot = get_portal_snapshot()
 
     # --- HEADER --- #
     with st.container():
         col_header, col_logo = st.columns((3, 0.8))
 
         with col_logo:
-            path_img_logo = pathlib.Path("./assets/images/logo.png")
-            if path_img_logo.exists():
-                st.image(str(path_img_logo))
+            # The logo column is about a fifth of the 60rem page
+            show_image("logo", width=200, alt=tenant.name)
         with col_header:
-            st.header("Advancing Analytics")
+            st.header(tenant.name)
             st.subheader("Season 5 - Corporate Claash")
     # --- HEADER ---#
 
@@ -68,24 +61,20 @@ def init_page() -> None:
         for claan, col in cols:
             with col:
                 with st.container(border=True):
-                    claan_img = pathlib.Path(
-                        f"./assets/images/{claan.name.lower()}.png"
-                    )
                     st.subheader(claan.value)
-                    if claan_img.exists():
-                        st.image(str(claan_img))
+                    show_image(claan.name.lower(), width=300, alt=claan.value)
 
                     st.metric(
                         label="Share Price",
-                        value=f"${float(st.session_state[f"data_{claan.name}"]["instrument"] or 0.0)}",
+                        value=f"${float(snapshot.corporate[claan]['instrument'] or 0.0)}",
                     )
                     st.metric(
                         label="Stash",
-                        value=f"${float(st.session_state[f"data_{claan.name}"]["funds"] or 0.0)}",
+                        value=f"${float(snapshot.corporate[claan]['funds'] or 0.0)}",
                     )
                     st.metric(
                         label="Escrow",
-                        value=f"${float(st.session_state[f"data_{claan.name}"]["escrow"] or 0.0)}",
+                        value=f"${float(snapshot.corporate[claan]['escrow'] or 0.0)}",
                     )
     # --- SCORES --- #
 
@@ -150,7 +139,8 @@ Each Claan has been issues 50 shares initially, with 2 shares given to each Boar
 
 
 def main() -> None:
-    init_page()
+    with trace_rerun("Claan Portal"):
+        init_page()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,36 @@
+from datetime import datetime
+from math import ceil
+from tempfile import TemporaryFile
+from typing import Callable, Tuple
+
 import pandas as pd
 import streamlit as st
 
 from src.models.claan import Claan
+from src.models.dto import UserDTO
+from src.models.job import JobStatus, JobType
+from src.models.market.pricing_curve import CurveKind
 from src.models.task_reward import TaskReward
-from src.models.user import User
-from src.utils.data.scores import get_scores
+from src.models.tenant import current_tenant
+from src.utils.cache import CACHE
+from src.utils.data.admin import (
+    get_claan_summary,
+    get_share_summary,
+    get_tasks_page,
+    get_users_page,
+)
+from src.utils.data.history import (
+    NoCheckpointError,
+    get_market_state,
+    get_portfolio_labels,
+)
+from src.utils.data.pricing import set_pricing_curve
+from src.utils.data.seasons import get_fortnight_number, get_seasons
 from src.utils.data.stocks import (
     add_user,
     delete_unowned_company_share,
-    get_all_shares,
     get_instruments,
     issue_company_share,
-    issue_credit,
-    process_escrow,
 )
 from src.utils.data.tasks import add_task, delete_task, get_tasks, set_active_task
 from src.utils.data.users import (
@@ -21,35 +39,80 @@ from src.utils.data.users import (
     get_users,
     update_user,
 )
-from src.utils.database import Database, initialise
+from src.utils.database import Database
+from src.utils.export import DATASETS, FORMATS, export
+from src.utils.jobs import (
+    credit_key,
+    enqueue,
+    escrow_key,
+    get_jobs,
+    retry,
+    sync_jobs,
+)
+from src.utils.tenancy import get_password, select_tenant
+from src.utils.tracing import flame, get_slow_traces, trace_rerun, traced
+
+PAGE_SIZE = 50
 
 
 def load_data():
     if "db_session" not in st.session_state:
         st.session_state["db_session"] = Database.get_session()
+    sync_jobs(_session=st.session_state["db_session"])
     st.session_state["tasks"] = get_tasks(_session=st.session_state["db_session"])
     st.session_state["users"] = get_users(_session=st.session_state["db_session"])
-    st.session_state["scores"] = get_scores(_session=st.session_state["db_session"])
     st.session_state["instruments"] = get_instruments(
         _session=st.session_state["db_session"]
     )
-    st.session_state["shares"] = get_all_shares(_session=st.session_state["db_session"])
-
-    for claan in Claan:
-        st.session_state[f"users_{claan}"] = get_claan_users(
-            _session=st.session_state["db_session"], claan=claan
-        )
 
 
 def refresh_data():
-    """Hard refresh of all data, including clearing data cache."""
-    st.cache_data.clear()
+    """Hard refresh of all data, including clearing this tenant's data cache."""
+    CACHE.clear(tenant_id=current_tenant().id)
     load_data()
 
 
+def queue_job(type: JobType, **kwargs) -> None:
+    job = enqueue(st.session_state["db_session"], type, **kwargs)
+    if job.status == JobStatus.FAILED:
+        st.toast(f"{job} already failed, retry it from Jobs")
+    elif job.status == JobStatus.SUCCEEDED:
+        st.toast(f"{job} already ran, see Jobs")
+    else:
+        st.toast(f"{job} queued, see Jobs for progress")
+
+
+def queue_escrow() -> None:
+    """Run the close of the fortnight that just ended, if the worker hasn't yet.
+
+    The same job the worker schedules, so it's brought forward rather than run twice.
+    Closing the current fortnight early would take the key of the close scheduled
+    for its end, which then wouldn't run.
+    """
+    fortnight = get_fortnight_number(_session=st.session_state["db_session"]) - 1
+    if fortnight < 0:
+        st.toast("No fortnight has ended yet")
+        return
+    queue_job(
+        JobType.PROCESS_ESCROW,
+        params={"fortnight": fortnight},
+        key=escrow_key(fortnight),
+    )
+
+
+def queue_credit() -> None:
+    fortnight = get_fortnight_number(_session=st.session_state["db_session"])
+    value = round(st.session_state["credit_amount"], 2)
+    queue_job(
+        JobType.ISSUE_CREDIT,
+        params={"value": value},
+        key=credit_key(fortnight, value),
+    )
+
+
 def check_password():
     def password_entered():
-        if st.session_state["admin_password"] == st.secrets["passwords"]["admin"]:
+        if st.session_state["admin_password"] == get_password("admin"):
             st.session_state["admin_password_correct"] = True
             del st.session_state["admin_password"]
         else:
@@ -73,14 +136,39 @@ def check_password():
     return False
 
 
+def paginated(
+    loader: Callable[..., Tuple[pd.DataFrame, int]],
+    key: str,
+    page_size: int = PAGE_SIZE,
+) -> pd.DataFrame:
+    """Load the page of rows selected by a page number input under ``key``."""
+    page = st.session_state.get(key, 1)
+    rows, total = loader(
+        _session=st.session_state["db_session"], page=page - 1, page_size=page_size
+    )
+    pages = max(1, ceil(total / page_size))
+    if page > pages:
+        # Rows were deleted since the page was picked
+        st.session_state[key] = page = pages
+        rows, total = loader(
+            _session=st.session_state["db_session"], page=page - 1, page_size=page_size
+        )
+
+    st.number_input(
+        label=f"Page (of {pages})", key=key, min_value=1, max_value=pages, step=1
+    )
+
+    return rows
+
+
 @st.fragment
 def update_user_form():
     with st.container(border=True):
         st.subheader("Update User")
-        user: User = st.selectbox(
+        user: UserDTO = st.selectbox(
             label="User",
             key="update_user_user",
-            options=sorted(st.session_state["users"]),
+            options=st.session_state["users"],
         )
         if user:
             if user.claan:
@@ -122,7 +210,7 @@ def update_user_form():
                 label="Submit",
                 key="update_user_button",
                 type="primary",
-                on_click=update_user,
+                on_click=traced(update_user),
                 kwargs={"_session": st.session_state["db_session"]},
             )
 
@@ -142,9 +230,9 @@ def delete_user_form():
             user = st.selectbox(
                 label="User",
                 key="delete_user_selection",
-                options=st.session_state[
-                    f"users_{st.session_state["delete_user_claan"]}"
-                ],
+                options=get_claan_users(
+                    _session=st.session_state["db_session"], claan=claan
+                ),
                 format_func=lambda user: user.name,
             )
 
@@ -153,7 +241,7 @@ def delete_user_form():
             "Submit",
             type="primary",
             disabled=not submit_enabled,
-            on_click=delete_user,
+            on_click=traced(delete_user),
             kwargs={"_session": st.session_state["db_session"]},
         ):
             st.rerun()
@@ -184,24 +272,14 @@ def user_management() -> None:
                 )
                 st.form_submit_button(
                     label="Submit",
-                    on_click=add_user,
+                    on_click=traced(add_user),
                     kwargs={"_session": st.session_state["db_session"]},
                 )
             update_user_form()
             delete_user_form()
         with col_df:
-            df_users = pd.DataFrame.from_records(
-                data=[vars(user) for user in st.session_state["users"]]
-            )
-            if "_sa_instance_state" in df_users.columns:
-                df_users.drop("_sa_instance_state", inplace=True, axis=1)
-            if "claan" in df_users.columns:
-                df_users["claan"] = df_users["claan"].apply(
-                    lambda x: x.value if x is not None else "None"
-                )
-
             st.dataframe(
-                data=df_users,
+                data=paginated(loader=get_users_page, key="users_table"),
                 use_container_width=True,
                 hide_index=True,
                 column_config={"name": "Name", "claan": "Claan"},
@@ -234,7 +312,7 @@ def set_active_task_form():
             label="Submit",
             key="set_active_task_submit",
             disabled=not (quest_reward and quest_selection),
-            on_click=set_active_task,
+            on_click=traced(set_active_task),
             kwargs={"_session": st.session_state["db_session"]},
         ):
             st.rerun()
@@ -246,33 +324,18 @@ def task_management() -> None:
 
         with st.container(border=True):
             st.header("Claan Info")
-            cols = st.columns(len(list(Claan)))
-            for claan in Claan:
-                with cols[list(Claan).index(claan)]:
-                    st.metric(
-                        label=claan.name,
-                        value=len(
-                            [
-                                user
-                                for user in st.session_state["users"]
-                                if user.claan == claan
-                            ]
-                        ),
-                    )
-                    st.metric(label="Score", value=st.session_state["scores"][claan])
+            summary = get_claan_summary(_session=st.session_state["db_session"])
+            cols = st.columns(len(summary))
+            for col, (claan, row) in zip(cols, summary.iterrows()):
+                with col:
+                    st.metric(label=claan.name, value=row["users"])
+                    st.metric(label="Score", value=row["score"])
 
         col_df, col_forms = st.columns(2)
 
         with col_df:
-            df_tasks = pd.DataFrame.from_records(
-                data=[vars(task) for task in st.session_state["tasks"]]
-            )
-            if "_sa_instance_state" in df_tasks.columns:
-                df_tasks.drop("_sa_instance_state", inplace=True, axis=1)
-            if "reward" in df_tasks.columns:
-                df_tasks["reward"] = df_tasks["reward"].apply(lambda x: x.value)
             st.dataframe(
-                data=df_tasks,
+                data=paginated(loader=get_tasks_page, key="tasks_table"),
                 use_container_width=True,
                 hide_index=True,
             )
@@ -294,7 +357,7 @@ def task_management() -> None:
                 )
                 st.form_submit_button(
                     label="Submit",
-                    on_click=add_task,
+                    on_click=traced(add_task),
                     kwargs={"_session": st.session_state["db_session"]},
                 )
             with st.form(key="delete_task", clear_on_submit=True, border=True):
@@ -307,7 +370,7 @@ def task_management() -> None:
                 )
                 st.form_submit_button(
                     label="Submit",
-                    on_click=delete_task,
+                    on_click=traced(delete_task),
                     kwargs={"_session": st.session_state["db_session"]},
                 )
 
@@ -317,18 +380,13 @@ def share_management() -> None:
         st.header("Share Management")
 
         with st.container(border=True):
-            cols = st.columns(len(st.session_state["instruments"]))
-            for instrument in st.session_state["instruments"]:
-                with cols[st.session_state["instruments"].index(instrument)]:
-                    st.metric(
-                        label=instrument.ticker,
-                        value=len(
-                            [
-                                share
-                                for share in st.session_state["shares"]
-                                if share.instrument_id == instrument.id
-                            ]
-                        ),
+            summary = get_share_summary(_session=st.session_state["db_session"])
+            cols = st.columns(len(summary))
+            for col, (_, row) in zip(cols, summary.iterrows()):
+                with col:
+                    st.metric(label=row["ticker"], value=row["total"])
+                    st.caption(
+                        f"IPO: {row['ipo']} · Owned: {row['owned']} · For sale: {row['unowned']}"
                     )
 
         instrument = st.selectbox(
@@ -339,28 +397,70 @@ def share_management() -> None:
             index=None,
         )
 
-        if st.button(
+        st.button(
             label="Process Escrow",
             key="process_escrow",
-        ):
-            process_escrow(_session=st.session_state["db_session"])
+            help="Closes the fortnight that just ended now, if the worker hasn't yet",
+            on_click=traced(queue_escrow),
+        )
 
-        credit_value = float(
-            st.number_input(
-                label="Credit amount",
-                min_value=1.0,
-                max_value=50.0,
-                value=10.0,
-                step=0.1,
-                key="credit_amount",
-            )
+        st.number_input(
+            label="Credit amount",
+            min_value=1.0,
+            max_value=50.0,
+            value=10.0,
+            step=0.1,
+            key="credit_amount",
         )
-        if st.button(
+        st.button(
             label="Issue Credit",
             key="issue_credit",
-        ):
-            issue_credit(
-                _session=st.session_state["db_session"], value=round(credit_value, 2)
+            help="Once per amount each fortnight, so a repeated click doesn't pay twice",
+            on_click=traced(queue_credit),
+        )
+
+        with st.form(key="pricing_curve", border=True):
+            st.subheader("Pricing Curve")
+            st.selectbox(
+                label="Instrument",
+                key="curve_instrument",
+                options=[None, *st.session_state["instruments"]],
+                format_func=lambda instrument: (
+                    "All instruments" if instrument is None else instrument.ticker
+                ),
+            )
+            st.selectbox(
+                label="Curve",
+                key="curve_kind",
+                options=[None, *CurveKind],
+                format_func=lambda kind: (
+                    "Fixed steps"
+                    if kind is None
+                    else kind.name.replace("_", " ").title()
+                ),
+            )
+            st.number_input(
+                label="Slope",
+                key="curve_slope",
+                min_value=0.0,
+                max_value=1.0,
+                value=0.05,
+                step=0.01,
+                help="Linear curves: price rise per share held, as a fraction of the base price",
+            )
+            st.number_input(
+                label="Virtual shares",
+                key="curve_virtual_shares",
+                min_value=2,
+                max_value=10000,
+                value=200,
+                step=10,
+                help="Constant product curves: size of the pool, fewer makes prices steeper",
+            )
+            st.form_submit_button(
+                label="Set for this season",
+                on_click=traced(set_pricing_curve),
+                kwargs={"_session": st.session_state["db_session"]},
             )
 
         if instrument:
@@ -388,9 +488,225 @@ def share_management() -> None:
                 )
 
 
+@st.fragment
+def market_history() -> None:
+    with st.container(border=True):
+        st.header("Market History")
+
+        col_date, col_time = st.columns(2)
+        with col_date:
+            history_date = st.date_input(label="Date", key="history_date")
+        with col_time:
+            history_time = st.time_input(label="Time", key="history_time", step=60)
+
+        if not st.button(label="Load", key="history_load"):
+            return
+
+        try:
+            state = get_market_state(
+                _session=st.session_state["db_session"],
+                timestamp=datetime.combine(history_date, history_time),
+            )
+        except NoCheckpointError as e:
+            st.warning(str(e))
+            return
+
+        tickers = {
+            instrument.id: instrument.ticker
+            for instrument in get_instruments(_session=st.session_state["db_session"])
+        }
+        labels = get_portfolio_labels(_session=st.session_state["db_session"])
+
+        st.caption(f"Rebuilt from checkpoint {state.checkpoint_id}")
+        st.dataframe(
+            data=pd.DataFrame(
+                {
+                    "Ticker": [tickers.get(id, id) for id in state.prices],
+                    "Price": list(state.prices.values()),
+                }
+            ),
+            hide_index=True,
+        )
+
+        df_portfolios = pd.DataFrame.from_dict(
+            data=state.holdings, orient="index"
+        ).reindex(index=list(state.portfolio_cash), fill_value=0)
+        df_portfolios = df_portfolios.fillna(0).astype(int)
+        df_portfolios.columns = [tickers.get(id, id) for id in df_portfolios.columns]
+        df_portfolios.insert(0, "Cash", pd.Series(state.portfolio_cash))
+        df_portfolios.insert(
+            1,
+            "Value",
+            [
+                state.portfolio_value(portfolio_id)
+                for portfolio_id in df_portfolios.index
+            ],
+        )
+        df_portfolios.index = df_portfolios.index.map(
+            lambda portfolio_id: labels.get(portfolio_id, portfolio_id)
+        )
+        df_portfolios.index.name = "User"
+        st.dataframe(data=df_portfolios, use_container_width=True)
+
+
+@st.fragment(run_every=5)
+def job_queue() -> None:
+    with st.container(border=True):
+        st.header("Jobs")
+
+        jobs = get_jobs(_session=st.session_state["db_session"])
+        st.dataframe(
+            data=pd.DataFrame(
+                [
+                    {
+                        "id": job.id,
+                        "type": job.type.name,
+                        "status": job.status.name,
+                        "progress": job.progress,
+                        "message": job.message,
+                        "attempts": f"{job.attempts}/{job.max_attempts}",
+                        "run_after": job.run_after,
+                        "finished": job.finished,
+                    }
+                    for job in jobs
+                ]
+            ),
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "progress": st.column_config.ProgressColumn(
+                    "Progress", min_value=0.0, max_value=1.0
+                )
+            },
+        )
+
+        failed = [job for job in jobs if job.status == JobStatus.FAILED]
+        if failed:
+            job = st.selectbox(
+                label="Failed job",
+                key="retry_job_selection",
+                options=failed,
+                format_func=str,
+            )
+            with st.expander("Error"):
+                st.code(job.error)
+            st.button(
+                label="Retry",
+                key="retry_job",
+                on_click=traced(retry),
+                args=(st.session_state["db_session"], job.id),
+            )
+
+
+@st.fragment
+def season_export() -> None:
+    with st.container(border=True):
+        st.header("Export")
+
+        seasons = get_seasons(_session=st.session_state["db_session"])
+        col_dataset, col_season, col_format = st.columns(3)
+        with col_dataset:
+            dataset = st.selectbox(
+                label="Dataset", key="export_dataset", options=list(DATASETS)
+            )
+        with col_season:
+            season_id = st.selectbox(
+                label="Season",
+                key="export_season",
+                options=[None, *seasons],
+                format_func=lambda id: "All seasons" if id is None else seasons[id],
+            )
+        with col_format:
+            format = st.radio(
+                label="Format", key="export_format", options=FORMATS, horizontal=True
+            )
+
+        if not st.button(label="Prepare Export", key="export_prepare"):
+            return
+
+        # Rows are streamed to disk, and only the finished file is handed to Streamlit
+        with TemporaryFile() as file, st.spinner("Exporting..."):
+            rows = export(
+                st.session_state["db_session"],
+                dataset,
+                format,
+                file,
+                season_id=season_id,
+            )
+            file.seek(0)
+            data = file.read()
+
+        suffix = f"_{seasons[season_id]}" if season_id is not None else ""
+        st.download_button(
+            label=f"Download {rows} rows",
+            key="export_download",
+            data=data,
+            file_name=f"{dataset}{suffix}.{format}".replace(" ", "_").lower(),
+            mime="text/csv" if format == "csv" else "application/octet-stream",
+        )
+
+
+def trace_summary() -> None:
+    with st.container(border=True):
+        st.header("Slow Reruns")
+
+        traces = get_slow_traces(tenant=current_tenant().slug)
+        if not traces:
+            st.write("No slow reruns since the app started.")
+            return
+
+        root = st.selectbox(
+            label="Rerun",
+            key="trace_selection",
+            options=traces,
+            format_func=lambda root: (
+                f"{root.duration_ms:.0f}ms: {root.attributes.get('page', root.name)} "
+                f"at {datetime.fromtimestamp(root.start / 1e9):%H:%M:%S}"
+            ),
+        )
+        spans = list(root.walk())
+        sql_ms = sum(
+            span.duration_ms for _, span in spans if span.name.startswith("SQL")
+        )
+        col_total, col_spans, col_sql = st.columns(3)
+        col_total.metric(label="Duration", value=f"{root.duration_ms:.0f}ms")
+        col_spans.metric(label="Spans", value=len(spans))
+        col_sql.metric(label="In SQL", value=f"{sql_ms:.0f}ms")
+
+        st.dataframe(
+            data=flame(root),
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                "span": st.column_config.TextColumn("Span"),
+                "start": st.column_config.NumberColumn("Start", format="%.1fms"),
+                "duration": st.column_config.NumberColumn("Duration", format="%.1fms"),
+                "self": st.column_config.NumberColumn("Self", format="%.1fms"),
+                "share": st.column_config.ProgressColumn(
+                    "Share", min_value=0.0, max_value=1.0
+                ),
+                "detail": st.column_config.TextColumn("Detail"),
+            },
+        )
+
+
+SECTIONS = {
+    "Users": user_management,
+    "Tasks": task_management,
+    "Shares": share_management,
+    "History": market_history,
+    "Jobs": job_queue,
+    "Export": season_export,
+    "Traces": trace_summary,
+}
+
+
 def init_page() -> None:
     st.set_page_config(page_title="Admin", layout="wide")
 
+    if "db_session" not in st.session_state:
+        st.session_state["db_session"] = Database.get_session()
+    select_tenant(_session=st.session_state["db_session"])
     if not check_password():
         st.stop()
 
@@ -402,16 +718,40 @@ def init_page() -> None:
         st.button(
             label="Initialise Database",
             key="button_init_data",
-            on_click=initialise,
+            on_click=traced(queue_job),
+            args=(JobType.INITIALISE,),
+        )
+        st.button(
+            label="Bootstrap Stock Game",
+            key="button_stock_game",
+            on_click=traced(queue_job),
+            args=(JobType.STOCK_GAME,),
         )
         st.button(
             label="Refresh Data", key="button_refresh_data", on_click=refresh_data
         )
 
-        user_management()
-        task_management()
-        share_management()
+        with st.expander("Cache Stats"):
+            st.metric(label="Entries", value=len(CACHE))
+            st.dataframe(
+                data=pd.DataFrame.from_dict(
+                    {name: vars(stats) for name, stats in CACHE.stats().items()},
+                    orient="index",
+                ),
+                use_container_width=True,
+            )
+
+    # Only the selected section is loaded and rendered, unlike tabs
+    section = st.radio(
+        label="Section",
+        key="admin_section",
+        options=list(SECTIONS),
+        horizontal=True,
+        label_visibility="collapsed",
+    )
+    SECTIONS[section]()
 
 
 if __name__ == "__main__":
-    init_page()
+    with trace_rerun("Admin"):
+        init_page()
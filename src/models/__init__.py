@@ -1,7 +1,9 @@
 from src.models.claan import Claan
+from src.models.job import Job
 from src.models.record import Record
 from src.models.season import Season
 from src.models.task import Task
+from src.models.tenant import Tenant
 from src.models.user import User
 
-__all__ = ["Claan", "Record", "Season", "Task", "User"]
+__all__ = ["Claan", "Job", "Record", "Season", "Task", "Tenant", "User"]
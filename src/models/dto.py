@@ -0,0 +1,101 @@
+"""Immutable read models returned by the cached loaders in :mod:`src.utils.data`.
+
+Loaders select plain columns into these instead of returning ORM instances, so
+cached values are small to serialize, never detached from a session, and safe to
+share between reruns. Equality and hashing only consider ``id``, so a DTO can be
+used as a dict key or selectbox option and still match after its row changes.
+
+Write paths take ids and load the ORM row they need inside their own transaction.
+"""
+
+from dataclasses import dataclass, field
+from datetime import date
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, Optional
+
+from src.models.claan import Claan
+from src.models.market.portfolio import BoardVote
+from src.models.task_reward import TaskReward
+
+
+@dataclass(frozen=True, slots=True)
+class UserDTO:
+    id: int
+    name: str = field(compare=False)
+    long_name: str = field(compare=False)
+    email: str = field(compare=False)
+    claan: Optional[Claan] = field(compare=False)
+    active: bool = field(compare=False)
+
+    def __str__(self):
+        return f"{self.name}"
+
+
+@dataclass(frozen=True, slots=True)
+class TaskDTO:
+    id: int
+    description: str = field(compare=False)
+    reward: TaskReward = field(compare=False)
+    ephemeral: bool = field(compare=False)
+    active: bool = field(compare=False)
+    last: Optional[date] = field(compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class PortfolioDTO:
+    id: int
+    user_id: int = field(compare=False)
+    company_id: int = field(compare=False)
+    cash: float = field(compare=False)
+    board_vote: BoardVote = field(compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class InstrumentDTO:
+    id: int
+    ticker: str = field(compare=False)
+    price: float = field(compare=False)
+    enabled: bool = field(compare=False)
+    company_id: int = field(compare=False)
+    claan: Claan = field(compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class PositionDTO:
+    """A portfolio's position in one instrument, read straight after a trade."""
+
+    portfolio_id: int
+    instrument_id: int
+    cash: float = field(compare=False)
+    owned: int = field(compare=False)
+    for_sale: int = field(compare=False)
+    price: float = field(compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class PositionStateDTO:
+    """A portfolio's cash, shares owned by instrument, and instruments sold this fortnight.
+
+    Everything the trading rules need, so they can be checked without a query.
+    """
+
+    portfolio_id: int
+    fortnight_start: date
+    cash: float = field(compare=False)
+    owned: Mapping[int, int] = field(compare=False)
+    sold: FrozenSet[int] = field(compare=False)
+
+    def owned_count(self, instrument_id: int) -> int:
+        return self.owned.get(instrument_id, 0)
+
+    def with_trade(
+        self, instrument_id: int, cash: float, owned: int, sold: bool
+    ) -> "PositionStateDTO":
+        """Return a copy with the values a trade in ``instrument_id`` left behind."""
+        return PositionStateDTO(
+            portfolio_id=self.portfolio_id,
+            fortnight_start=self.fortnight_start,
+            cash=cash,
+            owned=MappingProxyType({**self.owned, instrument_id: owned}),
+            sold=self.sold | {instrument_id} if sold else self.sold,
+        )
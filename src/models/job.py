@@ -0,0 +1,87 @@
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Optional
+
+from sqlalchemy import JSON, Index, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.models.base import Base
+from src.models.tenant import TenantScoped
+
+
+class JobType(Enum):
+    PROCESS_ESCROW = 1
+    ISSUE_CREDIT = 2
+    INITIALISE = 3
+    STOCK_GAME = 4
+
+
+class JobStatus(Enum):
+    PENDING = 1
+    RUNNING = 2
+    SUCCEEDED = 3
+    FAILED = 4
+
+
+class Job(TenantScoped, Base):
+    """Job ORM model.
+
+    A job is a heavy admin action queued for the worker in :mod:`src.utils.jobs`,
+    instead of running inside a Streamlit button callback. Workers claim pending jobs
+    whose ``run_after`` has passed, report progress on the row while running, and put
+    failed jobs back to pending until ``max_attempts`` is reached.
+
+    ``key`` is unique within a tenant, so a job that must only run once, such as one
+    fortnight's escrow, can't be queued twice.
+    """
+
+    __tablename__ = "jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    type: Mapped[JobType] = mapped_column(nullable=False)
+    status: Mapped[JobStatus] = mapped_column(nullable=False, default=JobStatus.PENDING)
+    key: Mapped[Optional[str]] = mapped_column(nullable=True)
+    params: Mapped[Dict[str, Any]] = mapped_column(JSON, nullable=False, default=dict)
+
+    # Set by the job's handler on success, and used to publish its event to the app
+    result: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSON, nullable=True)
+
+    progress: Mapped[float] = mapped_column(nullable=False, default=0.0)
+    message: Mapped[Optional[str]] = mapped_column(nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(nullable=True)
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(nullable=False, default=3)
+
+    created: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now)
+    run_after: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now)
+    started: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    # Refreshed with progress, so jobs of crashed workers can be told from slow ones
+    heartbeat: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    finished: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+    # Workers claim jobs of every tenant, so this index isn't led by the tenant
+    __table_args__ = (
+        Index("job_status_run_after_idx", status, run_after),
+        UniqueConstraint("tenant_id", "key"),
+    )
+
+    def __init__(
+        self,
+        type: JobType,
+        params: Optional[Dict[str, Any]] = None,
+        run_after: Optional[datetime] = None,
+        key: Optional[str] = None,
+        max_attempts: int = 3,
+    ):
+        self.type = type
+        self.status = JobStatus.PENDING
+        self.params = params or {}
+        self.key = key
+        self.progress = 0.0
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.created = datetime.now()
+        self.run_after = run_after or self.created
+
+    def __str__(self):
+        return f"Job {self.id} ({self.type.name}, {self.status.name})"
@@ -1,7 +1,17 @@
+from src.models.market.checkpoint import Checkpoint
 from src.models.market.company import Company
 from src.models.market.instrument import Instrument
 from src.models.market.portfolio import Portfolio
+from src.models.market.pricing_curve import PricingCurve
 from src.models.market.share import Share
 from src.models.market.transaction import Transaction
 
-__all__ = ["Company", "Instrument", "Portfolio", "Share", "Transaction"]
+__all__ = [
+    "Checkpoint",
+    "Company",
+    "Instrument",
+    "Portfolio",
+    "PricingCurve",
+    "Share",
+    "Transaction",
+]
@@ -0,0 +1,57 @@
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import JSON, Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.models.base import Base
+from src.models.tenant import TenantScoped
+
+
+class Checkpoint(TenantScoped, Base):
+    """Checkpoint ORM model.
+
+    A checkpoint is a snapshot of the whole market at a point in time, written when a
+    fortnight's escrow is processed. Market state at any later time can be rebuilt
+    from the nearest checkpoint plus the transactions recorded after it.
+
+    JSON keys are the string form of the relevant ids, as JSON objects can't have integer keys.
+    """
+
+    __tablename__ = "checkpoints"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    timestamp: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now)
+    fortnight: Mapped[int] = mapped_column(nullable=True)
+
+    # {<instrument_id>: <price>}
+    prices: Mapped[Dict[str, float]] = mapped_column(JSON, nullable=False)
+    # {<portfolio_id>: {<instrument_id>: <owned_count>}}
+    holdings: Mapped[Dict[str, Dict[str, int]]] = mapped_column(JSON, nullable=False)
+    # {<portfolio_id>: <cash>}
+    portfolio_cash: Mapped[Dict[str, float]] = mapped_column(JSON, nullable=False)
+    # {<company_id>: <cash>}
+    company_cash: Mapped[Dict[str, float]] = mapped_column(JSON, nullable=False)
+
+    __table_args__ = (
+        Index("checkpoint_tenant_timestamp_idx", "tenant_id", timestamp.desc()),
+    )
+
+    def __init__(
+        self,
+        prices: Dict[str, float],
+        holdings: Dict[str, Dict[str, int]],
+        portfolio_cash: Dict[str, float],
+        company_cash: Dict[str, float],
+        fortnight: Optional[int] = None,
+        timestamp: Optional[datetime] = None,
+    ):
+        self.prices = prices
+        self.holdings = holdings
+        self.portfolio_cash = portfolio_cash
+        self.company_cash = company_cash
+        self.fortnight = fortnight
+        self.timestamp = timestamp or datetime.now()
+
+    def __str__(self):
+        return f"Checkpoint {self.id} at {self.timestamp} (fortnight {self.fortnight})"
@@ -1,9 +1,11 @@
 from typing import TYPE_CHECKING, List
 
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.claan import Claan
+from src.models.tenant import TenantScoped
 
 if TYPE_CHECKING:
     from src.models.market.instrument import Instrument
@@ -11,7 +13,7 @@ if TYPE_CHECKING:
     from src.models.market.transaction import Transaction
 
 
-class Company(Base):
+class Company(TenantScoped, Base):
     __tablename__ = "companies"
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -38,5 +40,7 @@ class Company(Base):
         passive_updates=True,
     )
 
+    __table_args__ = (UniqueConstraint("tenant_id", "claan"),)
+
     def __init__(self, claan: Claan):
         self.claan = claan
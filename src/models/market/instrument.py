@@ -1,19 +1,21 @@
 from typing import TYPE_CHECKING, List, Optional, Type
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, Session, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.claan import Claan
 from src.models.market.company import Company
+from src.models.tenant import TenantScoped
 
 if TYPE_CHECKING:
     from src.models.market.share import Share
     from src.models.market.transaction import Transaction
 
 
-class Instrument(Base):
+class Instrument(TenantScoped, Base):
     __tablename__ = "instruments"
+    __table_args__ = (Index("instrument_tenant_idx", "tenant_id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     ticker: Mapped[str] = mapped_column(nullable=False)
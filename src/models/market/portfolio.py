@@ -1,11 +1,12 @@
 from enum import Enum
 from typing import TYPE_CHECKING, List
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.market.company import Company
+from src.models.tenant import TenantScoped
 from src.models.user import User
 
 if TYPE_CHECKING:
@@ -25,8 +26,9 @@ class BoardVote(Enum):
             return self.name
 
 
-class Portfolio(Base):
+class Portfolio(TenantScoped, Base):
     __tablename__ = "portfolios"
+    __table_args__ = (Index("portfolio_tenant_idx", "tenant_id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     cash: Mapped[float] = mapped_column(nullable=False, default=0.0)
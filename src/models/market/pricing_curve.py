@@ -0,0 +1,58 @@
+from enum import Enum
+from typing import Optional
+
+from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.models.base import Base
+from src.models.tenant import TenantScoped
+
+
+class CurveKind(Enum):
+    LINEAR = 1
+    CONSTANT_PRODUCT = 2
+
+
+class PricingCurve(TenantScoped, Base):
+    """Pricing curve ORM model.
+
+    Prices an instrument's trades by a bonding curve for a season, instead of the
+    fixed price steps. A curve with no instrument applies to every instrument in the
+    season without one of its own. Only the curve's shape is stored; its base price
+    follows from the instrument's current price and shares held, so escrow can still
+    move prices as before.
+
+    ``slope`` is used by linear curves, and ``virtual_shares`` by constant product ones.
+    """
+
+    __tablename__ = "pricing_curves"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    season_id: Mapped[int] = mapped_column(
+        ForeignKey("seasons.id", ondelete="CASCADE"), nullable=False
+    )
+    instrument_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("instruments.id", ondelete="CASCADE"), nullable=True
+    )
+    kind: Mapped[CurveKind] = mapped_column(nullable=False)
+    slope: Mapped[Optional[float]] = mapped_column(nullable=True)
+    virtual_shares: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+    __table_args__ = (UniqueConstraint(season_id, instrument_id),)
+
+    def __init__(
+        self,
+        season_id: int,
+        kind: CurveKind,
+        instrument_id: Optional[int] = None,
+        slope: Optional[float] = None,
+        virtual_shares: Optional[int] = None,
+    ):
+        self.season_id = season_id
+        self.instrument_id = instrument_id
+        self.kind = kind
+        self.slope = slope
+        self.virtual_shares = virtual_shares
+
+    def __str__(self):
+        return f"{self.kind.name} curve for instrument {self.instrument_id} in season {self.season_id}"
@@ -1,15 +1,17 @@
 from typing import Optional, Type
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, Session, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.market.instrument import Instrument
 from src.models.market.portfolio import Portfolio
+from src.models.tenant import TenantScoped
 
 
-class Share(Base):
+class Share(TenantScoped, Base):
     __tablename__ = "shares"
+    __table_args__ = (Index("share_tenant_idx", "tenant_id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     ipo: Mapped[bool] = mapped_column(nullable=False, default=True)
@@ -2,13 +2,14 @@ from datetime import datetime
 from enum import Enum
 from typing import TYPE_CHECKING, Optional
 
-from sqlalchemy import CheckConstraint, ForeignKey
+from sqlalchemy import CheckConstraint, ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.market.company import Company
 from src.models.market.instrument import Instrument
 from src.models.market.portfolio import Portfolio
+from src.models.tenant import TenantScoped
 
 if TYPE_CHECKING:
     pass
@@ -25,7 +26,16 @@ class Operation(Enum):
     DEBIT = 4
 
 
-class Transaction(Base):
+# Direction each operation moves the holder's cash in
+OPERATION_SIGNS = {
+    Operation.BUY: -1.0,
+    Operation.SELL: 1.0,
+    Operation.CREDIT: 1.0,
+    Operation.DEBIT: -1.0,
+}
+
+
+class Transaction(TenantScoped, Base):
     """Transaction ORM model.
 
     A transaction records the movement of funds from one entity to another
@@ -36,12 +46,13 @@ class Transaction(Base):
         CheckConstraint(
             "(company_id IS NOT NULL AND portfolio_id IS NULL) or (company_id IS NULL AND portfolio_id IS NOT NULL)"
         ),
+        Index("transaction_tenant_timestamp_idx", "tenant_id", "timestamp"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     value: Mapped[float] = mapped_column(nullable=False)
     operation: Mapped[Operation] = mapped_column(nullable=False)
-    timestamp: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now())
+    timestamp: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now)
 
     instrument_id: Mapped[int] = mapped_column(
         ForeignKey("instruments.id", ondelete="CASCADE"), nullable=True
@@ -7,10 +7,11 @@ from src.models.base import Base
 from src.models.claan import Claan
 from src.models.task import Task
 from src.models.task_reward import TaskReward
+from src.models.tenant import TenantScoped
 from src.models.user import User
 
 
-class Record(Base):
+class Record(TenantScoped, Base):
     """
     Defines a record for a quest or activity, for submission of the record into the mongo database.
 
@@ -55,7 +56,8 @@ class Record(Base):
             task_id,
         ),
         Index(
-            "record_timestamp_idx",
+            "record_tenant_timestamp_idx",
+            "tenant_id",
             timestamp.desc(),
         ),
     )
@@ -1,17 +1,21 @@
 from datetime import date
 
+from sqlalchemy import Index
 from sqlalchemy.orm import Mapped, mapped_column
 
 from src.models.base import Base
+from src.models.tenant import TenantScoped
 
 
-class Season(Base):
+class Season(TenantScoped, Base):
     __tablename__ = "seasons"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(nullable=False)
     start_date: Mapped[date] = mapped_column(nullable=False)
 
+    __table_args__ = (Index("season_tenant_start_idx", "tenant_id", start_date),)
+
     def __init__(self, name: str, start_date: date):
         self.name = name
         self.start_date = start_date
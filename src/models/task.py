@@ -1,21 +1,23 @@
 from datetime import date
 from typing import TYPE_CHECKING, List
 
+from sqlalchemy import Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.models.base import Base
 from src.models.task_reward import TaskReward
+from src.models.tenant import TenantScoped
 
 if TYPE_CHECKING:
     from src.models.record import Record
 
 
-class Task(Base):
+class Task(TenantScoped, Base):
     __tablename__ = "tasks"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     description: Mapped[str] = mapped_column(nullable=False)
-    reward: Mapped[TaskReward] = mapped_column(nullable=False, index=True)
+    reward: Mapped[TaskReward] = mapped_column(nullable=False)
     ephemeral: Mapped[bool] = mapped_column(default=False)
     active: Mapped[bool] = mapped_column(default=False)
     last: Mapped[date] = mapped_column(nullable=True)
@@ -24,6 +26,8 @@ class Task(Base):
         back_populates="task", cascade="all, delete", passive_deletes=True
     )
 
+    __table_args__ = (Index("task_tenant_reward_idx", "tenant_id", reward),)
+
     def __init__(self, description: str, reward: TaskReward, ephemeral: bool):
         self.description = description
         self.reward = reward
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import ForeignKey, event, insert
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.models.base import Base
+
+
+class Tenant(Base):
+    """Tenant ORM model.
+
+    An organisation running its own Claans, market and seasons in a shared deployment
+    and database. Every other table is :class:`TenantScoped`, and members sign up
+    with an email address on the tenant's ``email_domain``.
+    """
+
+    __tablename__ = "tenants"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    slug: Mapped[str] = mapped_column(nullable=False, unique=True)
+    name: Mapped[str] = mapped_column(nullable=False)
+    email_domain: Mapped[str] = mapped_column(nullable=False)
+
+    def __init__(self, slug: str, name: str, email_domain: str):
+        self.slug = slug
+        self.name = name
+        self.email_domain = email_domain
+
+    def __str__(self):
+        return f"{self.name}"
+
+
+@dataclass(frozen=True, slots=True)
+class TenantContext:
+    """The tenant code runs for, with what validation needs without a query."""
+
+    id: int
+    slug: str
+    name: str
+    email_domain: str
+
+
+# Added with the tenants table, and used for anything not run for a tenant of its own
+DEFAULT_TENANT = TenantContext(
+    id=1,
+    slug="advancinganalytics",
+    name="Advancing Analytics",
+    email_domain="advancinganalytics",
+)
+
+
+@event.listens_for(Tenant.__table__, "after_create")
+def _add_default_tenant(target, connection, **kwargs):
+    connection.execute(
+        insert(target).values(
+            slug=DEFAULT_TENANT.slug,
+            name=DEFAULT_TENANT.name,
+            email_domain=DEFAULT_TENANT.email_domain,
+        )
+    )
+
+
+_current: ContextVar[Optional[TenantContext]] = ContextVar("tenant", default=None)
+
+
+def _no_tenant() -> Optional[TenantContext]:
+    return None
+
+
+# Set by the app, to find the tenant of code not run under use_tenant, such as callbacks
+_fallback: Callable[[], Optional[TenantContext]] = _no_tenant
+
+
+def set_tenant_fallback(fallback: Callable[[], Optional[TenantContext]]) -> None:
+    global _fallback
+    _fallback = fallback
+
+
+def current_tenant() -> TenantContext:
+    """The tenant set by :func:`use_tenant`, else the fallback's, else the default."""
+    return _current.get() or _fallback() or DEFAULT_TENANT
+
+
+@contextmanager
+def use_tenant(tenant: TenantContext) -> Iterator[TenantContext]:
+    """Read and write ``tenant``'s rows within the block."""
+    token = _current.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current.reset(token)
+
+
+class TenantScoped:
+    """Mixin for tables whose rows belong to a tenant.
+
+    New rows take the current tenant, and ORM queries only see its rows, unless run
+    with the ``all_tenants`` execution option. Tenant-aware indexes lead with
+    ``tenant_id`` and are declared by each table.
+    """
+
+    tenant_id: Mapped[int] = mapped_column(
+        ForeignKey("tenants.id", ondelete="CASCADE"),
+        nullable=False,
+        default=lambda: current_tenant().id,
+    )
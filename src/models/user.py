@@ -1,31 +1,37 @@
 from functools import total_ordering
 from typing import TYPE_CHECKING, List, Optional, Type
 
-from email_validator import validate_email
+from sqlalchemy import Index, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 
 from src.models.base import Base
 from src.models.claan import Claan
+from src.models.tenant import TenantScoped, current_tenant
 
 if TYPE_CHECKING:
     from src.models.record import Record
 
 
 @total_ordering
-class User(Base):
+class User(TenantScoped, Base):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     long_name: Mapped[str] = mapped_column(nullable=False)
     name: Mapped[str] = mapped_column(nullable=False)
-    email: Mapped[str] = mapped_column(nullable=False, unique=True)
-    claan: Mapped[Claan] = mapped_column(nullable=True, index=True)
+    email: Mapped[str] = mapped_column(nullable=False)
+    claan: Mapped[Claan] = mapped_column(nullable=True)
     active: Mapped[bool] = mapped_column(nullable=False, default=True)
 
     records: Mapped[List["Record"]] = relationship(
         back_populates="user", cascade="all, delete", passive_deletes=True
     )
 
+    __table_args__ = (
+        UniqueConstraint("tenant_id", "email"),
+        Index("user_tenant_claan_idx", "tenant_id", claan),
+    )
+
     def __init__(
         self,
         long_name: str,
@@ -69,8 +75,10 @@ class User(Base):
 
     @validates("email")
     def validate_email(self, key, value):
+        from email_validator import validate_email
+
         email = validate_email(value)
-        if "advancinganalytics" in email.domain:
+        if current_tenant().email_domain in email.domain:
             return email.normalized
         else:
             raise ValueError("Email failed validation")
@@ -0,0 +1,168 @@
+"""Resized image variants, served as static files.
+
+Images in ``assets/images`` are resized to each of :data:`WIDTHS`, as WebP with a PNG
+fallback, and written to ``static/images``, which Streamlit serves at
+``app/static/images`` with ``server.enableStaticServing``. Variants are built on first
+use, or ahead of time by running this module, and rebuilt when the source changes.
+
+Pages render images with :func:`show_image`, giving the width of the column the image
+sits in, so browsers download a variant that fits rather than the full-size source,
+and cache it under a URL that doesn't change between reruns.
+"""
+
+import argparse
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+import streamlit as st
+
+from src.utils.logger import LOGGER
+
+IMAGES_DIR = Path("assets/images")
+STATIC_DIR = Path("static/images")
+STATIC_URL = "app/static/images"
+# Widths in pixels. Sources narrower than the widest are also kept at full size
+WIDTHS = (160, 320, 640, 1280)
+FORMATS = ("webp", "png")
+
+
+@dataclass(frozen=True)
+class ImageVariant:
+    name: str
+    width: int
+    format: str
+
+    @property
+    def filename(self) -> str:
+        return f"{self.name}-{self.width}.{self.format}"
+
+    @property
+    def path(self) -> Path:
+        return STATIC_DIR / self.filename
+
+    @property
+    def url(self) -> str:
+        return f"{STATIC_URL}/{self.filename}"
+
+
+def build_variants(name: str) -> Tuple[ImageVariant, ...]:
+    """Write the variants of ``assets/images/<name>.png`` that are missing or older than it.
+
+    Returns no variants if the source image doesn't exist.
+    """
+    source = IMAGES_DIR / f"{name}.png"
+    if not source.exists():
+        return ()
+
+    # Only needed when variants are built, and slow to import
+    from PIL import Image
+
+    STATIC_DIR.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as image:
+        widths = [width for width in WIDTHS if width < image.width]
+        if image.width <= WIDTHS[-1]:
+            widths.append(image.width)
+        variants = tuple(
+            ImageVariant(name=name, width=width, format=format)
+            for width in widths
+            for format in FORMATS
+        )
+
+        for variant in variants:
+            if (
+                variant.path.exists()
+                and variant.path.stat().st_mtime >= source.stat().st_mtime
+            ):
+                continue
+            height = round(image.height * variant.width / image.width)
+            resized = image.resize((variant.width, height), Image.Resampling.LANCZOS)
+            if variant.format == "webp":
+                resized.save(variant.path, "WEBP", quality=85)
+            else:
+                resized.save(variant.path, "PNG", optimize=True)
+            LOGGER.debug(f"Built image variant `{variant.path}`")
+
+    return variants
+
+
+@lru_cache(maxsize=None)
+def get_variants(name: str) -> Tuple[ImageVariant, ...]:
+    """Variants of an image, built once per process."""
+    return build_variants(name)
+
+
+def pick_variant(
+    variants: Tuple[ImageVariant, ...], width: int, format: str
+) -> Optional[ImageVariant]:
+    """The narrowest variant in ``format`` at least ``width`` wide, else the widest."""
+    candidates = sorted(
+        (variant for variant in variants if variant.format == format),
+        key=lambda variant: variant.width,
+    )
+    for variant in candidates:
+        if variant.width >= width:
+            return variant
+
+    return candidates[-1] if candidates else None
+
+
+@lru_cache(maxsize=None)
+def image_html(name: str, width: int, alt: str = "") -> Optional[str]:
+    """An ``<img>`` of ``name`` for a column ``width`` CSS pixels wide.
+
+    Offers the variant fitting ``width`` and one for high density screens, as WebP,
+    falling back to PNG for browsers without it.
+    """
+    variants = get_variants(name)
+    if not variants:
+        return None
+
+    sources = {}
+    for format in FORMATS:
+        standard = pick_variant(variants, width, format)
+        dense = pick_variant(variants, 2 * width, format)
+        sources[format] = f"{standard.url} 1x, {dense.url} 2x"
+    fallback = pick_variant(variants, width, "png")
+
+    return (
+        f'<picture><source type="image/webp" srcset="{sources["webp"]}">'
+        f'<img src="{fallback.url}" srcset="{sources["png"]}" alt="{alt}" '
+        f'loading="lazy" style="width: 100%; height: auto"></picture>'
+    )
+
+
+def show_image(name: str, width: int, alt: str = "") -> None:
+    """Render the variant of ``assets/images/<name>.png`` for a column ``width`` CSS pixels wide.
+
+    Renders nothing if the image doesn't exist.
+    """
+    html = image_html(name, width, alt)
+    if html is not None:
+        st.markdown(html, unsafe_allow_html=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the static image variants ahead of serving the app."
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Images in assets/images to build, without extension. All of them by default.",
+    )
+    args = parser.parse_args()
+
+    names = args.names or sorted(path.stem for path in IMAGES_DIR.glob("*.png"))
+    for name in names:
+        variants = build_variants(name)
+        if not variants:
+            LOGGER.warning(f"No image `{IMAGES_DIR / name}.png`")
+            continue
+        size = sum(variant.path.stat().st_size for variant in variants)
+        LOGGER.info(f"{name}: {len(variants)} variants, {size / 1024:.0f}KiB")
+
+
+if __name__ == "__main__":
+    main()
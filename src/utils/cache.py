@@ -0,0 +1,295 @@
+"""Process-wide, tag-invalidated cache for the data loaders.
+
+Loaders are wrapped with :func:`cached` and declare the tags their result depends
+on. Write paths then call :meth:`TaggedCache.invalidate` with the tags they touched,
+dropping exactly the entries that could now be stale.
+
+Every tenant has its own entries: keys and tags include the current tenant, so a
+tenant's writes only invalidate its own entries.
+
+A loader that was running while its tags were invalidated may have read the data
+from before the write, so its result isn't cached.
+
+Like ``st.cache_data``, arguments whose name starts with an underscore (such as
+``_session``) are left out of the cache key. Unlike it, values are not copied on
+the way in or out, so cached values must be treated as read-only.
+
+Tags used by the loaders:
+
+.. code-block:: text
+
+    users, tasks, records, season, prices   whole-table dependencies
+    portfolios                              every portfolio's cash or vote
+    portfolio:<id>                          one portfolio's cash or vote
+    holdings                                owned share counts for every portfolio
+    instrument:<id>                         unowned share count for one instrument
+    ipo:<CLAAN>                             shares still in IPO for a Claan's company
+    claan:<CLAAN>                           a Claan's company funds, escrow and records
+    market                                  anything that reads market tables
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import wraps
+from inspect import signature
+from threading import RLock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from src.models.tenant import current_tenant
+from src.utils.logger import LOGGER
+from src.utils.tracing import span
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+# A tag within one tenant's entries
+_TenantTag = Tuple[int, str]
+
+
+@dataclass
+class _Entry:
+    value: Any
+    tags: Set[_TenantTag]
+    expires: Optional[float]
+
+
+class TaggedCache:
+    """Thread-safe LRU cache where entries can be dropped by tag.
+
+    Tags are the current tenant's, so setting and invalidating them for one tenant
+    leaves the others' entries alone.
+
+    :param max_entries: Entries beyond this count are evicted, least recently used first.
+    """
+
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._tags: Dict[_TenantTag, Set[Hashable]] = {}
+        self._stats: Dict[str, CacheStats] = {}
+        self._lock = RLock()
+        # Bumped by every invalidation, which records it against the tags it dropped,
+        # the tenant None standing for every tenant
+        self._generation = 0
+        self._invalidated: Dict[Tuple[Optional[int], str], int] = {}
+        self._cleared: Dict[Optional[int], int] = {}
+
+    def _stats_for(self, key: Hashable) -> CacheStats:
+        return self._stats.setdefault(key[0], CacheStats())
+
+    def _drop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def generation(self) -> int:
+        """The current generation, to pass to :meth:`set` as ``since`` once loaded."""
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, tags: Set[_TenantTag], since: int) -> bool:
+        tenant_ids = {tenant_id for tenant_id, _ in tags}
+        return (
+            any(
+                self._cleared.get(tenant_id, -1) > since
+                for tenant_id in (None, *tenant_ids)
+            )
+            or any(self._invalidated.get(tag, -1) > since for tag in tags)
+            or any(self._invalidated.get((None, tag), -1) > since for _, tag in tags)
+        )
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """Return ``(found, value)`` for ``key``, counting a hit or miss."""
+        with self._lock:
+            stats = self._stats_for(key)
+            entry = self._entries.get(key)
+            if entry is not None and (
+                entry.expires is None or entry.expires > monotonic()
+            ):
+                self._entries.move_to_end(key)
+                stats.hits += 1
+                return True, entry.value
+            if entry is not None:
+                self._drop(key)
+            stats.misses += 1
+            return False, None
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tags: Iterable[str] = (),
+        ttl: Optional[float] = None,
+        since: Optional[int] = None,
+    ) -> bool:
+        """Cache ``value`` under ``key``, returning whether it was.
+
+        :param since: The :meth:`generation` when ``value`` started loading. If any of
+            ``tags`` were invalidated since, ``value`` may predate the write, so isn't
+            cached.
+        """
+        with self._lock:
+            tenant_id = current_tenant().id
+            tags = {(tenant_id, tag) for tag in tags}
+            if since is not None and self._invalidated_since(tags, since):
+                LOGGER.debug(f"Not caching {key[0]}, invalidated while loading")
+                return False
+
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = _Entry(
+                value=value,
+                tags=tags,
+                expires=monotonic() + ttl if ttl is not None else None,
+            )
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._stats_for(oldest).evictions += 1
+                self._drop(oldest)
+
+            return True
+
+    def invalidate(self, *tags: str, all_tenants: bool = False) -> int:
+        """Drop every entry carrying any of ``tags``, returning how many were dropped.
+
+        :param all_tenants: Drop every tenant's entries with the tags, not only the
+            current tenant's.
+        """
+        with self._lock:
+            if all_tenants:
+                tenant_tags = [key for key in self._tags if key[1] in tags]
+            else:
+                tenant_id = current_tenant().id
+                tenant_tags = [(tenant_id, tag) for tag in tags]
+            self._generation += 1
+            for tag in tags:
+                self._invalidated[(None if all_tenants else tenant_id, tag)] = (
+                    self._generation
+                )
+            keys = set().union(*(self._tags.get(tag, set()) for tag in tenant_tags))
+            for key in keys:
+                self._stats_for(key).invalidations += 1
+                self._drop(key)
+
+        if keys:
+            LOGGER.debug(f"Invalidated {len(keys)} cache entries for tags {tags}")
+        return len(keys)
+
+    def clear(self, tenant_id: Optional[int] = None) -> None:
+        """Drop every entry, or only those of the tenant with ``tenant_id``."""
+        with self._lock:
+            self._generation += 1
+            self._cleared[tenant_id] = self._generation
+            if tenant_id is None:
+                self._entries.clear()
+                self._tags.clear()
+                return
+            for key in [
+                key
+                for key, entry in self._entries.items()
+                if any(tag[0] == tenant_id for tag in entry.tags)
+            ]:
+                self._drop(key)
+
+    def stats(self) -> Dict[str, CacheStats]:
+        """Per-loader hit, miss, eviction and invalidation counts."""
+        with self._lock:
+            return {
+                name: CacheStats(**vars(stats)) for name, stats in self._stats.items()
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+CACHE = TaggedCache()
+
+
+def cached(
+    tags: Iterable[str] | Callable[..., Iterable[str]] = (),
+    ttl: Optional[float | timedelta] = None,
+    cache: TaggedCache = CACHE,
+):
+    """Cache a loader's result in ``cache``, tagged for invalidation.
+
+    :param tags: Tags for every entry, or a callable returning them. A callable is given
+        the loader's cache key arguments and its ``result`` as keyword arguments.
+    :param ttl: Optional lifetime in seconds, or as a :class:`timedelta`, after which an entry is reloaded.
+    """
+    if isinstance(ttl, timedelta):
+        ttl = ttl.total_seconds()
+
+    def decorator(func):
+        func_signature = signature(func)
+        name = func.__qualname__
+
+        def make_key(args, kwargs) -> tuple:
+            bound = func_signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return (
+                name,
+                current_tenant().id,
+                tuple(
+                    (arg, value)
+                    for arg, value in bound.arguments.items()
+                    if not arg.startswith("_")
+                ),
+            )
+
+        @wraps(func)
+        def _wrapper(*args, **kwargs):
+            with span(name) as loader:
+                key = make_key(args, kwargs)
+                with span("cache lookup"):
+                    found, value = cache.get(key)
+                loader.set("cache.hit", found)
+                if found:
+                    return value
+
+                generation = cache.generation()
+                value = func(*args, **kwargs)
+                entry_tags = (
+                    tags(**dict(key[2]), result=value) if callable(tags) else tags
+                )
+                cache.set(
+                    key,
+                    value,
+                    tags={f"fn:{name}", *entry_tags},
+                    ttl=ttl,
+                    since=generation,
+                )
+                return value
+
+        def clear() -> None:
+            """Drop every entry for this loader, for every tenant."""
+            cache.invalidate(f"fn:{name}", all_tenants=True)
+
+        def prime(value: Any, *args, **kwargs) -> None:
+            """Cache ``value`` as the loader's result for these arguments, without calling it.
+
+            For write paths that know the loader's new result, to save its reload.
+            """
+            key = make_key(args, kwargs)
+            entry_tags = tags(**dict(key[2]), result=value) if callable(tags) else tags
+            cache.set(key, value, tags={f"fn:{name}", *entry_tags}, ttl=ttl)
+
+        _wrapper.clear = clear
+        _wrapper.prime = prime
+        return _wrapper
+
+    return decorator
@@ -1,19 +1,24 @@
-import pathlib
+from dataclasses import replace
+from typing import Callable
 
-import pandas as pd
 import streamlit as st
 
 from src.models.claan import Claan
+from src.models.dto import UserDTO
 from src.models.market.portfolio import BoardVote
-from src.utils.data.scores import get_historical_data, get_scores, submit_record
-from src.utils.data.seasons import get_fortnight_info
+from src.models.tenant import current_tenant
+from src.utils.assets import show_image
+from src.utils.data.pricing import get_quote_ladders
+from src.utils.data.scores import get_historical_data, submit_record
+from src.utils.data.seasons import get_fortnight_info, get_fortnight_start
 from src.utils.data.stocks import (
     buy_share,
-    get_corporate_data,
+    get_holdings_matrix,
     get_instruments,
     get_ipo_count,
-    get_owned_shares,
     get_portfolio,
+    get_position,
+    get_position_state,
     get_shares_for_sale,
     sell_share,
     update_vote,
@@ -21,15 +26,29 @@ from src.utils.data.stocks import (
 from src.utils.data.tasks import get_active_tasks
 from src.utils.data.users import get_claan_users
 from src.utils.database import Database
+from src.utils.jobs import sync_jobs
 from src.utils.logger import LOGGER
+from src.utils.market_rules import buy_rejection, sell_rejection
+from src.utils.snapshot import get_portal_snapshot
+from src.utils.tenancy import get_password, select_tenant
+from src.utils.tracing import span, trace_rerun, traced
 
 
 class ClaanPage:
     def __init__(self, claan: Claan) -> None:
         self.claan = claan
 
+        with trace_rerun(claan.value):
+            with span("init_page"):
+                self.init_page()
+            with span("load_data"):
+                self.load_data()
+            with span("build_page"):
+                self.build_page()
+
+    def init_page(self) -> None:
         st.set_page_config(
-            page_title=claan.value,
+            page_title=self.claan.value,
             page_icon=self.claan.get_icon(),
             layout="wide",
         )
@@ -52,6 +71,15 @@ class ClaanPage:
         if st.session_state["db_session"].in_transaction():
             st.session_state["db_session"].rollback()
 
+        select_tenant(_session=st.session_state["db_session"])
+        sync_jobs(_session=st.session_state["db_session"])
+
+    def load_data(self) -> None:
+        """Load any market or Claan data missing from the session state.
+
+        Called by fragments as well as the full page, as event subscribers may have
+        dropped keys since the page last ran.
+        """
         if "active_tasks" not in st.session_state:
             LOGGER.info("Loading `active_tasks`")
             st.session_state["active_tasks"] = get_active_tasks(
@@ -70,11 +98,11 @@ class ClaanPage:
                 for user in st.session_state[f"users_{self.claan.name}"]
             }
 
-        # if f"owned_shares_{self.claan.name}" not in st.session_state:
-        LOGGER.info(f"Loading `owned_shares_{self.claan.name}`")
-        st.session_state[f"owned_shares_{self.claan.name}"] = get_owned_shares(
-            _session=st.session_state["db_session"], claan=self.claan
-        )
+        if "holdings" not in st.session_state:
+            LOGGER.info("Loading `holdings`")
+            st.session_state["holdings"] = get_holdings_matrix(
+                _session=st.session_state["db_session"]
+            )
 
         if f"ipo_{self.claan.name}" not in st.session_state:
             LOGGER.info(f"Loading `ipo_{self.claan.name}`")
@@ -82,17 +110,8 @@ class ClaanPage:
                 st.session_state["db_session"], self.claan
             )
 
-        if "scores" not in st.session_state:
-            LOGGER.info("Loading `scores`")
-            st.session_state["scores"] = get_scores(
-                _session=st.session_state["db_session"]
-            )
-
-        if f"data_{self.claan.name}" not in st.session_state:
-            LOGGER.info(f"Loading `data_{self.claan.name}`")
-            st.session_state[f"data_{self.claan.name}"] = get_corporate_data(
-                _session=st.session_state["db_session"], claan=self.claan
-            )
+        # Shared by every session, so read on every run rather than kept in session state
+        self.corporate_data = get_portal_snapshot().corporate[self.claan]
 
         if f"historical_{self.claan.name}" not in st.session_state:
             LOGGER.info(f"Loading `historical_{self.claan.name}`")
@@ -112,21 +131,65 @@ class ClaanPage:
                 _session=st.session_state["db_session"]
             )
 
+        if "quote_ladders" not in st.session_state:
+            LOGGER.info("Loading `quote_ladders`")
+            st.session_state["quote_ladders"] = get_quote_ladders(
+                _session=st.session_state["db_session"]
+            )
+
         if "for_sale_count" not in st.session_state:
             LOGGER.info("Loading `for_sale_count`")
             st.session_state["for_sale_count"] = {
-                instrument: get_shares_for_sale(
+                instrument.id: get_shares_for_sale(
                     _session=st.session_state["db_session"],
                     instrument_id=instrument.id,
                 )
                 for instrument in st.session_state["instruments"]
             }
 
-        self.build_page()
+    def trade(
+        self,
+        trade: Callable[..., bool],
+        user_id: int,
+        portfolio_id: int,
+        instrument_id: int,
+    ) -> None:
+        """Button callback for :func:`buy_share` and :func:`sell_share`.
+
+        Runs before the trading panel fragment reruns, so it renders the new values.
+        """
+        if trade(
+            _session=st.session_state["db_session"],
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+        ):
+            self.refresh_position(user_id, portfolio_id, instrument_id)
+
+    def refresh_position(self, user_id: int, portfolio_id: int, instrument_id: int):
+        """Patch the session state with the values a trade changed, from one query."""
+        position = get_position(
+            _session=st.session_state["db_session"],
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+        )
+
+        portfolios = st.session_state[f"portfolios_{self.claan.name}"]
+        portfolios[user_id] = replace(portfolios[user_id], cash=position.cash)
+        st.session_state["holdings"] = st.session_state["holdings"].with_owned(
+            portfolio_id, instrument_id, position.owned
+        )
+        st.session_state["for_sale_count"][instrument_id] = position.for_sale
+        # Instruments are shared with the cache, so are replaced rather than modified
+        st.session_state["instruments"] = [
+            replace(instrument, price=position.price)
+            if instrument.id == instrument_id
+            else instrument
+            for instrument in st.session_state["instruments"]
+        ]
 
     def check_password(self) -> bool:
         def password_entered():
-            if st.session_state["password"] == st.secrets["passwords"][self.claan.name]:
+            if st.session_state["password"] == get_password(self.claan.name):
                 st.session_state[f"{self.claan.name}_password_correct"] = True
                 del st.session_state["password"]
             else:
@@ -151,6 +214,149 @@ class ClaanPage:
         else:
             return True
 
+    @st.fragment
+    def task_form(self) -> None:
+        with st.form(key="form_submit_task", border=True):
+            st.header("Tasks")
+
+            st.radio(
+                label="Tasks",
+                options=st.session_state["active_tasks"],
+                format_func=lambda task: f"${task.reward.value}: {task.description}",
+                key="task_selection",
+            )
+
+            st.form_submit_button(
+                label="Submit",
+                on_click=traced(submit_record),
+                kwargs={
+                    "_session": st.session_state["db_session"],
+                },
+            )
+
+    @st.fragment
+    @traced
+    def trading_panel(self, user: UserDTO) -> None:
+        """Stock market and wallet, rerun on their own after a trade or vote."""
+        self.load_data()
+        portfolio = st.session_state[f"portfolios_{self.claan.name}"][user.id]
+        # Read fresh each rerun, as it's cached and primed by every trade
+        state = get_position_state(
+            _session=st.session_state["db_session"],
+            portfolio_id=portfolio.id,
+            fortnight_start=get_fortnight_start(
+                _session=st.session_state["db_session"]
+            ),
+        )
+
+        col_left, col_right = st.columns(2)
+        with col_left:
+            with st.container(border=True):
+                st.header("Stock Market")
+                instruments = st.session_state["instruments"]
+                cols = st.columns(int(len(instruments) / 2))
+                cols += cols
+                cols = zip(instruments, cols)
+
+                for instrument, col in cols:
+                    with col:
+                        with st.container(border=True):
+                            st.metric(
+                                label=instrument.ticker,
+                                value=f"${instrument.price}",
+                            )
+                            st.metric(
+                                label="Owned",
+                                value=st.session_state["holdings"].owned(
+                                    portfolio.id, instrument.id
+                                ),
+                            )
+                            st.metric(
+                                label="For sale",
+                                value=st.session_state["for_sale_count"][instrument.id],
+                            )
+                            ladder = st.session_state["quote_ladders"].get(
+                                instrument.id
+                            )
+                            if ladder:
+                                st.caption(
+                                    "Buy "
+                                    + " · ".join(
+                                        f"{count}: ${cost}"
+                                        for count, cost in enumerate(ladder.buy, 1)
+                                    )
+                                )
+                            if ladder and ladder.sell:
+                                st.caption(
+                                    "Sell "
+                                    + " · ".join(
+                                        f"{count}: ${proceeds}"
+                                        for count, proceeds in enumerate(ladder.sell, 1)
+                                    )
+                                )
+                            buy_refused = buy_rejection(
+                                state.owned_count(instrument.id),
+                                instrument.id in state.sold,
+                                state.cash,
+                                instrument.price,
+                            )
+                            st.button(
+                                label="BUY",
+                                key=f"share_buy_{instrument.id}",
+                                on_click=traced(self.trade),
+                                args=(buy_share, user.id, portfolio.id, instrument.id),
+                                disabled=buy_refused is not None,
+                                help=buy_refused.value if buy_refused else None,
+                            )
+                            sell_refused = sell_rejection(
+                                state.owned_count(instrument.id)
+                            )
+                            st.button(
+                                label="SELL",
+                                key=f"share_sell_{instrument.id}",
+                                on_click=traced(self.trade),
+                                args=(sell_share, user.id, portfolio.id, instrument.id),
+                                disabled=sell_refused is not None,
+                                help=sell_refused.value if sell_refused else None,
+                            )
+
+                st.write("Limited to 5 shares of each Company")
+                st.write(
+                    "After selling a share, you can't buy that share again until next fortnight"
+                )
+
+        with col_right:
+            st.session_state["portfolio"] = portfolio
+            with st.form(key="form_wallet"):
+                st.header("Wallet")
+                st.metric(
+                    label="Wallet Cash",
+                    value=f"${round(portfolio.cash or 0.0, 2)}",
+                )
+                st.metric(
+                    label="Current Vote",
+                    value=str(portfolio.board_vote).title(),
+                )
+                st.radio(
+                    label="Board Vote",
+                    key="portfolio_vote",
+                    options=list(BoardVote),
+                    format_func=lambda vote_type: str(vote_type).title(),
+                    index=list(BoardVote).index(portfolio.board_vote),
+                )
+                st.form_submit_button(
+                    label="Update Vote",
+                    on_click=traced(update_vote),
+                    kwargs={
+                        "_session": st.session_state["db_session"],
+                        "_portfolio": portfolio,
+                        "_claan": self.claan,
+                    },
+                )
+                df_shares = st.session_state["holdings"].wallet(portfolio.id)
+                df_shares["Price"] = df_shares["Price"].map(lambda price: f"${price}")
+                st.dataframe(data=df_shares, use_container_width=True)
+
     def build_page(self):
         if not self.check_password():
             return
@@ -160,7 +366,7 @@ class ClaanPage:
             header_left, header_right = st.columns((3, 1))
 
             with header_left:
-                st.subheader("Advancing Analytics")
+                st.subheader(current_tenant().name)
                 st.title(self.claan.value)
                 st.write(
                     f"Welcome to the {self.claan.value} Claan Area! Here you can log tasks!"
@@ -171,7 +377,7 @@ class ClaanPage:
                 with col_1:
                     st.metric(
                         label="Banked Funds",
-                        value=f"${float(st.session_state[f"data_{self.claan.name}"]["funds"] or 0.0)}",
+                        value=f"${float(self.corporate_data['funds'] or 0.0)}",
                     )
                     st.metric(
                         label="Fortnight Number",
@@ -181,7 +387,7 @@ class ClaanPage:
                 with col_2:
                     st.metric(
                         "In Escrow",
-                        value=f"${float(st.session_state[f"data_{self.claan.name}"]["escrow"] or 0.0)}",
+                        value=f"${float(self.corporate_data['escrow'] or 0.0)}",
                     )
                     st.metric(
                         label="Started",
@@ -190,7 +396,7 @@ class ClaanPage:
                 with col_3:
                     st.metric(
                         "Tasks Completed",
-                        value=st.session_state[f"data_{self.claan.name}"]["task_count"],
+                        value=self.corporate_data["task_count"],
                     )
                     st.metric(
                         label="Ends",
@@ -201,11 +407,8 @@ class ClaanPage:
                         "Share in IPO", value=st.session_state[f"ipo_{self.claan.name}"]
                     )
             with header_right:
-                claan_img = pathlib.Path(
-                    f"./assets/images/{self.claan.name.lower()}.png"
-                )
-                if claan_img.exists():
-                    st.image(str(claan_img))
+                # A quarter of the wide layout
+                show_image(self.claan.name.lower(), width=400, alt=self.claan.value)
 
         st.divider()
 
@@ -221,141 +424,8 @@ class ClaanPage:
             )
 
             if user:
-                portfolio = st.session_state[f"portfolios_{self.claan.name}"][user.id]
-
-                col_left, col_right = st.columns(2)
-                with col_left:
-                    with st.form(key="form_submit_task", border=True):
-                        st.header("Tasks")
-
-                        st.radio(
-                            label="Tasks",
-                            options=st.session_state["active_tasks"],
-                            format_func=lambda task: f"${task.reward.value}: {task.description}",
-                            key="task_selection",
-                        )
-
-                        st.form_submit_button(
-                            label="Submit",
-                            on_click=submit_record,
-                            kwargs={
-                                "_session": st.session_state["db_session"],
-                            },
-                        )
-
-                    with st.container(border=True):
-                        st.header("Stock Market")
-                        st.write(
-                            "Owned shares update is bugged - please refresh after buying or selling to see numbers."
-                        )
-                        instruments = st.session_state["instruments"]
-                        cols = st.columns(int(len(instruments) / 2))
-                        cols += cols
-                        cols = zip(instruments, cols)
-
-                        for instrument, col in cols:
-                            with col:
-                                with st.container(border=True):
-                                    st.metric(
-                                        label=instrument.ticker,
-                                        value=f"${instrument.price}",
-                                    )
-                                    st.metric(
-                                        label="Owned",
-                                        value=st.session_state[
-                                            f"owned_shares_{self.claan.name}"
-                                        ][portfolio.id][instrument.company.claan][
-                                            "owned_count"
-                                        ],
-                                    )
-                                    st.metric(
-                                        label="For sale",
-                                        value=st.session_state["for_sale_count"][
-                                            instrument
-                                        ],
-                                    )
-                                    if st.button(
-                                        label="BUY",
-                                        key=f"share_buy_{instrument}",
-                                    ):
-                                        if buy_share(
-                                            _session=st.session_state["db_session"],
-                                            portfolio=st.session_state[
-                                                f"portfolios_{self.claan.name}"
-                                            ][user.id],
-                                            instrument=instrument,
-                                        ):
-                                            st.rerun()
-                                    if st.button(
-                                        label="SELL",
-                                        key=f"share_sell_{instrument}",
-                                    ):
-                                        if sell_share(
-                                            _session=st.session_state["db_session"],
-                                            portfolio=st.session_state[
-                                                f"portfolios_{self.claan.name}"
-                                            ][user.id],
-                                            instrument=instrument,
-                                        ):
-                                            st.rerun()
-
-                        st.write("Limited to 5 shares of each Company")
-                        st.write(
-                            "After selling a share, you can't buy that share again until next fortnight"
-                        )
-
-                with col_right:
-                    st.session_state["portfolio"] = portfolio = st.session_state[
-                        f"portfolios_{self.claan.name}"
-                    ][user.id]
-                    with st.form(key="form_wallet"):
-                        st.header("Wallet")
-                        st.metric(
-                            label="Wallet Cash",
-                            value=f"${round(portfolio.cash or 0.0, 2)}",
-                        )
-                        st.metric(
-                            label="Current Vote",
-                            value=str(portfolio.board_vote).title(),
-                        )
-                        st.radio(
-                            label="Board Vote",
-                            key="portfolio_vote",
-                            options=list(BoardVote),
-                            format_func=lambda vote_type: str(vote_type).title(),
-                            index=list(BoardVote).index(portfolio.board_vote),
-                        )
-                        st.form_submit_button(
-                            label="Update Vote",
-                            on_click=update_vote,
-                            kwargs={
-                                "_session": st.session_state["db_session"],
-                                "_portfolio": portfolio,
-                                "_claan": self.claan,
-                            },
-                        )
-                        df_shares = pd.DataFrame.from_dict(
-                            data=st.session_state[f"owned_shares_{self.claan.name}"][
-                                portfolio.id
-                            ],
-                            orient="index",
-                        )
-                        df_shares.index.name = "Company"
-                        df_shares["price"] = df_shares["price"].map(
-                            lambda price: f"${price}"
-                        )
-                        df_shares.index = df_shares.index.map(
-                            lambda claan: claan.name.title().replace("_", " ")
-                        )
-                        df_shares = df_shares[["ticker", "owned_count", "price"]]
-                        df_shares = df_shares.rename(
-                            columns={
-                                "owned_count": "Shares Owned",
-                                "price": "Price",
-                                "ticker": "Ticker",
-                            }
-                        )
-                        st.dataframe(data=df_shares, use_container_width=True)
+                self.task_form()
+                self.trading_panel(user)
 
         with st.expander("Record History"):
             if st.button(
@@ -363,24 +433,21 @@ class ClaanPage:
                 key="history_button_refresh",
                 help="Click to refresh historical data",
             ):
-                get_historical_data.clear(claan=self.claan)
+                get_historical_data.clear()
                 st.session_state[f"historical_{self.claan.name}"] = get_historical_data(
                     _session=st.session_state["db_session"], claan=self.claan
                 )
 
-            df_historical = pd.DataFrame.from_records(
-                columns=("Name", "Task", "Reward", "Timestamp"),
-                data=st.session_state[f"historical_{self.claan.name}"],
-            )
-            if "_sa_instance_state" in df_historical.columns:
-                df_historical.drop("_sa_instance_state", inplace=True, axis=1)
-            if "Reward" in df_historical.columns:
-                df_historical["Reward"] = df_historical["Reward"].apply(
-                    lambda x: f"${x}"
-                )
-
             st.dataframe(
-                data=df_historical,
+                data=st.session_state[f"historical_{self.claan.name}"],
                 use_container_width=True,
                 hide_index=True,
+                column_config={
+                    "name": "Name",
+                    "task": "Task",
+                    "reward": st.column_config.NumberColumn("Reward", format="$%d"),
+                    "timestamp": st.column_config.DatetimeColumn(
+                        "Timestamp", format="YYYY-MM-DD HH:mm"
+                    ),
+                },
             )
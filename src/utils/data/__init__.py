@@ -0,0 +1,2 @@
+# Register the data layer's event subscribers on first import
+from src.utils.data import subscribers  # noqa: F401
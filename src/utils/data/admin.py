@@ -0,0 +1,113 @@
+"""Aggregate loaders for the admin page.
+
+Everything here is computed with grouped queries, so the admin page never loads
+every share or user row just to count them. Row-level tables are loaded a page at
+a time.
+"""
+
+from typing import Tuple
+
+import pandas as pd
+from sqlalchemy import Select, func, select
+from sqlalchemy.orm import Session
+
+from src.models.claan import Claan
+from src.models.market.company import Company
+from src.models.market.instrument import Instrument
+from src.models.market.share import Share
+from src.models.task import Task
+from src.models.task_reward import TaskReward
+from src.models.user import User
+from src.utils.cache import cached
+from src.utils.data.frames import to_frame
+from src.utils.data.scores import get_scores
+from src.utils.data.tasks import TASK_COLUMNS
+from src.utils.data.users import USER_COLUMNS
+from src.utils.database import read_only
+
+
+@cached(
+    tags=lambda result: (
+        [f"instrument:{id}" for id in result.index] + ["holdings", "market"]
+    ),
+    ttl=600,
+)
+@read_only
+def get_share_summary(_session: Session) -> pd.DataFrame:
+    """Return total, IPO, owned and unowned share counts per instrument, indexed by instrument id."""
+    query = (
+        select(
+            Instrument.id,
+            Instrument.ticker,
+            Company.claan,
+            func.count(Share.id).label("total"),
+            func.count(Share.id).filter(Share.ipo).label("ipo"),
+            func.count(Share.owner_id).label("owned"),
+        )
+        .join(Company)
+        .outerjoin(Share)
+        .group_by(Instrument.id, Instrument.ticker, Company.claan)
+        .order_by(Instrument.id)
+    )
+    summary = pd.DataFrame(
+        _session.execute(query).all(),
+        columns=["id", "ticker", "claan", "total", "ipo", "owned"],
+    ).set_index("id")
+    summary["unowned"] = summary["total"] - summary["owned"]
+
+    return summary
+
+
+@cached(tags=["users", "records", "season"], ttl=600)
+@read_only
+def get_claan_summary(_session: Session) -> pd.DataFrame:
+    """Return user counts and season scores per Claan, indexed by Claan."""
+    query = select(
+        User.claan,
+        func.count(User.id).label("users"),
+        func.count(User.id).filter(User.active).label("active"),
+    ).group_by(User.claan)
+    counts = {
+        claan: (users, active) for claan, users, active in _session.execute(query)
+    }
+    scores = get_scores(_session=_session)
+
+    summary = pd.DataFrame(
+        [(claan, *counts.get(claan, (0, 0)), scores[claan]) for claan in Claan],
+        columns=["claan", "users", "active", "score"],
+    ).set_index("claan")
+
+    return summary
+
+
+def _page(
+    _session: Session, query: Select, page: int, page_size: int, dtypes: dict
+) -> Tuple[pd.DataFrame, int]:
+    total = _session.scalar(select(func.count()).select_from(query.subquery()))
+    rows = to_frame(
+        _session.execute(query.limit(page_size).offset(page * page_size)), dtypes
+    )
+
+    return rows, total
+
+
+@cached(tags=["users"])
+@read_only
+def get_users_page(
+    _session: Session, page: int = 0, page_size: int = 50
+) -> Tuple[pd.DataFrame, int]:
+    """Return one page of users, ordered by name, and the total user count."""
+    query = select(*USER_COLUMNS).order_by(User.name, User.id)
+
+    return _page(_session, query, page, page_size, dtypes={"claan": Claan})
+
+
+@cached(tags=["tasks"])
+@read_only
+def get_tasks_page(
+    _session: Session, page: int = 0, page_size: int = 50
+) -> Tuple[pd.DataFrame, int]:
+    """Return one page of tasks, ordered by reward, and the total task count."""
+    query = select(*TASK_COLUMNS).order_by(Task.reward, Task.id)
+
+    return _page(_session, query, page, page_size, dtypes={"reward": TaskReward})
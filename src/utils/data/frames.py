@@ -0,0 +1,50 @@
+"""Typed DataFrames built straight from query results.
+
+Loaders for tabular views return frames from :func:`to_frame` rather than rows, so a
+cached frame is built once per data version and pages hand it to ``st.dataframe`` as
+it is. Enum columns become ordered categoricals of their values, and display
+formatting is left to the page's column config.
+"""
+
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Dict, Optional, Type
+
+from sqlalchemy import Result
+
+if TYPE_CHECKING:
+    # Only loaded when a table is, as it's slow to import
+    import pandas as pd
+
+
+def enum_dtype(enum: Type[Enum]) -> "pd.CategoricalDtype":
+    """An ordered categorical of ``enum``'s values, in definition order."""
+    import pandas as pd
+
+    return pd.CategoricalDtype([member.value for member in enum], ordered=True)
+
+
+def to_frame(
+    result: Result, dtypes: Optional[Dict[str, Any | Type[Enum]]] = None
+) -> "pd.DataFrame":
+    """Build a frame from the rows of ``result``, with columns named by its labels.
+
+    :param dtypes: Dtype of each column to convert. An :class:`Enum` subclass converts
+        members to a categorical of their values, with ``None`` as missing.
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+    if dtypes is None:
+        dtypes = {}
+    for column, dtype in dtypes.items():
+        if isinstance(dtype, type) and issubclass(dtype, Enum):
+            values = [
+                None if member is None else member.value for member in frame[column]
+            ]
+            frame[column] = pd.Series(
+                values, index=frame.index, dtype=enum_dtype(dtype)
+            )
+        else:
+            frame[column] = frame[column].astype(dtype)
+
+    return frame
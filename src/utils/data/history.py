@@ -0,0 +1,177 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from src.models.market.checkpoint import Checkpoint
+from src.models.market.company import Company
+from src.models.market.instrument import Instrument
+from src.models.market.portfolio import Portfolio
+from src.models.market.share import Share
+from src.models.market.transaction import Operation, Transaction
+from src.models.user import User
+from src.utils.cache import cached
+from src.utils.data.pricing import curve_for, get_curves
+from src.utils.database import read_only
+from src.utils.market_rules import price_after_sale, price_after_trade
+
+
+class NoCheckpointError(Exception):
+    pass
+
+
+@dataclass
+class MarketState:
+    """Market state as of ``timestamp``, rebuilt from ``checkpoint_id`` plus later transactions."""
+
+    timestamp: datetime
+    checkpoint_id: int
+    prices: Dict[int, float] = field(default_factory=dict)
+    holdings: Dict[int, Dict[int, int]] = field(default_factory=dict)
+    portfolio_cash: Dict[int, float] = field(default_factory=dict)
+    company_cash: Dict[int, float] = field(default_factory=dict)
+
+    def portfolio_value(self, portfolio_id: int) -> float:
+        """Cash plus the market value of every share held by the portfolio."""
+        shares_value = sum(
+            self.prices.get(instrument_id, 0.0) * count
+            for instrument_id, count in self.holdings.get(portfolio_id, {}).items()
+        )
+        return round(self.portfolio_cash.get(portfolio_id, 0.0) + shares_value, 2)
+
+
+def write_checkpoint(_session: Session, fortnight: Optional[int] = None) -> Checkpoint:
+    """Snapshot current prices, holdings and cash into a new :class:`Checkpoint`.
+
+    The checkpoint is flushed, not committed, so it lands in the same transaction as
+    whatever state change prompted it.
+    """
+    prices = _session.execute(select(Instrument.id, Instrument.price)).all()
+    portfolio_cash = _session.execute(select(Portfolio.id, Portfolio.cash)).all()
+    company_cash = _session.execute(select(Company.id, Company.cash)).all()
+    owned = _session.execute(
+        select(Share.owner_id, Share.instrument_id, func.count(Share.id))
+        .where(Share.owner_id.is_not(None))
+        .group_by(Share.owner_id, Share.instrument_id)
+    ).all()
+
+    holdings: Dict[str, Dict[str, int]] = defaultdict(dict)
+    for owner_id, instrument_id, count in owned:
+        holdings[str(owner_id)][str(instrument_id)] = count
+
+    checkpoint = Checkpoint(
+        prices={str(id): price for id, price in prices},
+        holdings=dict(holdings),
+        portfolio_cash={str(id): cash for id, cash in portfolio_cash},
+        company_cash={str(id): cash for id, cash in company_cash},
+        fortnight=fortnight,
+    )
+    _session.add(checkpoint)
+    _session.flush()
+
+    return checkpoint
+
+
+@read_only
+def get_market_state(_session: Session, timestamp: datetime) -> MarketState:
+    """Rebuild market state as of ``timestamp``.
+
+    Starts from the latest checkpoint at or before ``timestamp`` and replays the
+    transactions recorded between the two.
+
+    Raises :class:`NoCheckpointError` if ``timestamp`` is before the first checkpoint.
+    """
+    checkpoint_query = (
+        select(Checkpoint)
+        .where(Checkpoint.timestamp <= timestamp)
+        .order_by(Checkpoint.timestamp.desc())
+        .limit(1)
+    )
+    checkpoint = _session.execute(checkpoint_query).scalar_one_or_none()
+    if checkpoint is None:
+        raise NoCheckpointError(f"No market checkpoint exists before {timestamp}")
+
+    state = MarketState(
+        timestamp=timestamp,
+        checkpoint_id=checkpoint.id,
+        prices={int(id): price for id, price in checkpoint.prices.items()},
+        holdings={
+            int(portfolio_id): {int(id): count for id, count in owned.items()}
+            for portfolio_id, owned in checkpoint.holdings.items()
+        },
+        portfolio_cash={
+            int(id): cash for id, cash in checkpoint.portfolio_cash.items()
+        },
+        company_cash={int(id): cash for id, cash in checkpoint.company_cash.items()},
+    )
+
+    transactions_query = (
+        select(
+            Transaction.operation,
+            Transaction.value,
+            Transaction.instrument_id,
+            Transaction.portfolio_id,
+            Transaction.company_id,
+        )
+        .where(Transaction.timestamp > checkpoint.timestamp)
+        .where(Transaction.timestamp <= timestamp)
+        .order_by(Transaction.timestamp, Transaction.id)
+    )
+    # Prices on a curve move with the number of shares held
+    curves = get_curves(_session=_session, day=timestamp.date())
+    supply: Dict[int, int] = defaultdict(int)
+    for owned in state.holdings.values():
+        for id, count in owned.items():
+            supply[id] += count
+
+    for operation, value, instrument_id, portfolio_id, company_id in _session.execute(
+        transactions_query
+    ):
+        if company_id is not None:
+            delta = value if operation == Operation.CREDIT else -value
+            state.company_cash[company_id] = round(
+                state.company_cash.get(company_id, 0.0) + delta, 2
+            )
+            continue
+
+        holdings = state.holdings.setdefault(portfolio_id, {})
+        cash = state.portfolio_cash.get(portfolio_id, 0.0)
+        match operation:
+            case Operation.BUY:
+                cash -= value
+                holdings[instrument_id] = holdings.get(instrument_id, 0) + 1
+                curve = curve_for(curves, instrument_id)
+                state.prices[instrument_id] = (
+                    float(price_after_trade(curve, value, supply[instrument_id], 1))
+                    if curve is not None
+                    else value
+                )
+                supply[instrument_id] += 1
+            case Operation.SELL:
+                cash += value
+                holdings[instrument_id] = holdings.get(instrument_id, 0) - 1
+                # On a curve, the seller is paid the new price
+                state.prices[instrument_id] = (
+                    value
+                    if curve_for(curves, instrument_id) is not None
+                    else float(price_after_sale(value))
+                )
+                supply[instrument_id] -= 1
+            case Operation.CREDIT:
+                cash += value
+            case Operation.DEBIT:
+                cash -= value
+        state.portfolio_cash[portfolio_id] = round(cash, 2)
+
+    return state
+
+
+@cached(tags=["users", "market"], ttl=600)
+@read_only
+def get_portfolio_labels(_session: Session) -> Dict[int, str]:
+    """Returns a mapping of portfolio id to the owning user's name."""
+    query = select(Portfolio.id, User.name).join(User)
+    return {portfolio_id: name for portfolio_id, name in _session.execute(query)}
@@ -0,0 +1,132 @@
+"""Set-based ledger postings and share issuance.
+
+A :class:`PostingSpec` describes many postings at once: which portfolios or companies
+to post to, how much each receives, and the operation. :func:`post` applies it as one
+``INSERT ... SELECT`` into transactions and one ``UPDATE`` of balances, so the number
+of round trips doesn't grow with the roster.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Type
+
+from sqlalchemy import (
+    CTE,
+    ColumnElement,
+    Float,
+    Integer,
+    Numeric,
+    Select,
+    cast,
+    func,
+    insert,
+    literal,
+    select,
+    update,
+)
+from sqlalchemy.orm import Session
+
+from src.models.market.company import Company
+from src.models.market.portfolio import Portfolio
+from src.models.market.share import Share
+from src.models.market.transaction import OPERATION_SIGNS, Operation, Transaction
+from src.models.tenant import current_tenant
+
+
+@dataclass(frozen=True)
+class PostingSpec:
+    """Postings of ``operation`` to every holder selected by ``targets``.
+
+    :param holder: :class:`Portfolio` or :class:`Company`, whose cash is updated.
+    :param targets: Select of holder ids, labelled ``id``. May join or group by other
+        tables, for ``amount`` to use.
+    :param amount: Amount posted to each target, a constant or an SQL expression over
+        the columns available to ``targets``. Rounded to the cent.
+    """
+
+    operation: Operation
+    holder: Type[Portfolio] | Type[Company]
+    targets: Select
+    amount: float | ColumnElement[float]
+
+    def postings(self) -> CTE:
+        amount = self.amount
+        if not isinstance(amount, ColumnElement):
+            amount = literal(amount, Float)
+        # Queries nested in an INSERT aren't limited to the tenant, so limit this one.
+        # Through a subquery, as filtering on the holder would add it unjoined to the
+        # targets' FROM, repeating every target once per holder.
+        holders = (
+            select(self.holder.id)
+            .where(self.holder.tenant_id == current_tenant().id)
+            .correlate(None)
+        )
+        return (
+            self.targets.add_columns(round_cents(amount).label("value"))
+            .where(self.targets.selected_columns.id.in_(holders))
+            .cte("postings")
+        )
+
+
+@dataclass(frozen=True)
+class PostingResult:
+    postings: int
+    total: float
+
+
+def round_cents(amount: ColumnElement[float]) -> ColumnElement[float]:
+    return cast(func.round(cast(amount, Numeric), 2), Float)
+
+
+def numbers(count: int) -> CTE:
+    """A table ``n`` of the integers 1 to ``count``, for expanding counts into rows."""
+    numbers = select(literal(1, Integer).label("n")).cte("numbers", recursive=True)
+    return numbers.union_all(
+        select((numbers.c.n + 1).label("n")).where(numbers.c.n < count)
+    )
+
+
+def post(_session: Session, spec: PostingSpec) -> PostingResult:
+    """Apply a posting spec, returning the number of postings and their total.
+
+    Flushes but doesn't commit, so postings can be part of a larger transaction.
+    """
+    postings = spec.postings()
+    holder_column = "portfolio_id" if spec.holder is Portfolio else "company_id"
+
+    count, total = _session.execute(
+        select(func.count(), func.coalesce(func.sum(postings.c.value), 0.0))
+    ).one()
+    if count == 0:
+        return PostingResult(postings=0, total=0.0)
+
+    _session.execute(
+        insert(Transaction).from_select(
+            ["value", "operation", "timestamp", holder_column],
+            select(
+                postings.c.value,
+                literal(spec.operation, Transaction.operation.type),
+                literal(datetime.now(), Transaction.timestamp.type),
+                postings.c.id,
+            ),
+        )
+    )
+
+    sign = OPERATION_SIGNS[spec.operation]
+    _session.execute(
+        update(spec.holder)
+        .where(spec.holder.id == postings.c.id)
+        .values(cash=round_cents(spec.holder.cash + sign * postings.c.value))
+        .execution_options(synchronize_session="fetch")
+    )
+    _session.flush()
+
+    return PostingResult(postings=count, total=float(total))
+
+
+def issue_shares(_session: Session, instrument_id: int, amount: int) -> int:
+    """Add ``amount`` unowned IPO shares to an instrument with one ``INSERT ... SELECT``."""
+    new_shares = select(literal(instrument_id, Integer)).select_from(numbers(amount))
+    result = _session.execute(insert(Share).from_select(["instrument_id"], new_shares))
+
+    return result.rowcount
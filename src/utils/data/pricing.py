@@ -0,0 +1,169 @@
+"""Optional bonding-curve pricing of instruments.
+
+Instruments with a :class:`PricingCurve` in the current season are priced by it:
+buying moves the price up the curve and selling moves it back down, in place of the
+fixed sale step. Instruments without one keep the fixed steps. Either way,
+``Instrument.price`` is the cost of the next share, and quote ladders for larger
+trades are computed in O(1) from it and the number of shares held.
+"""
+
+from datetime import date
+from typing import Dict, Optional
+
+import streamlit as st
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from src.models.market.instrument import Instrument
+from src.models.market.pricing_curve import CurveKind, PricingCurve
+from src.models.market.share import Share
+from src.models.season import Season
+from src.utils.cache import cached
+from src.utils.data.seasons import get_season_start
+from src.utils.database import read_only
+from src.utils.events import BUS, PricingChanged
+from src.utils.logger import LOGGER
+from src.utils.market_rules import (
+    ConstantProductCurve,
+    Curve,
+    LinearCurve,
+    QuoteLadder,
+    quote_ladder,
+)
+
+
+def to_rule(curve: PricingCurve) -> Curve:
+    match curve.kind:
+        case CurveKind.LINEAR:
+            return LinearCurve(slope=curve.slope)
+        case CurveKind.CONSTANT_PRODUCT:
+            return ConstantProductCurve(virtual_shares=curve.virtual_shares)
+
+
+@cached(tags=["pricing", "season"], ttl=600)
+@read_only
+def get_curves(
+    _session: Session, day: Optional[date] = None
+) -> Dict[Optional[int], Curve]:
+    """Returns the curves of the season in force on ``day``, today by default, by instrument id.
+
+    The season-wide curve, if any, is under ``None``.
+    """
+    season_start = (
+        select(func.max(Season.start_date))
+        .where(Season.start_date <= (day or date.today()))
+        .scalar_subquery()
+    )
+    query = (
+        select(PricingCurve)
+        .join(Season, PricingCurve.season_id == Season.id)
+        .where(Season.start_date == season_start)
+    )
+
+    return {
+        curve.instrument_id: to_rule(curve)
+        for curve in _session.execute(query).scalars()
+    }
+
+
+def curve_for(
+    curves: Dict[Optional[int], Curve], instrument_id: int
+) -> Optional[Curve]:
+    """The instrument's own curve, else the season-wide one, else ``None``."""
+    return curves.get(instrument_id, curves.get(None))
+
+
+def get_supply(_session: Session, instrument_id: int) -> int:
+    """Returns the number of the instrument's shares held by portfolios."""
+    query = (
+        select(func.count(Share.id))
+        .where(Share.instrument_id == instrument_id)
+        .where(Share.owner_id.is_not(None))
+    )
+
+    return _session.execute(query).scalar_one()
+
+
+@cached(tags=["prices", "holdings", "pricing", "market"], ttl=600)
+@read_only
+def get_quote_ladders(_session: Session) -> Dict[int, QuoteLadder]:
+    """Returns buy and sell quotes for 1 to 5 shares of every instrument, by instrument id."""
+    supply_query = (
+        select(Share.instrument_id, func.count(Share.id))
+        .where(Share.owner_id.is_not(None))
+        .group_by(Share.instrument_id)
+    )
+    supply = dict(_session.execute(supply_query).all())
+    curves = get_curves(_session=_session)
+
+    return {
+        instrument_id: quote_ladder(
+            curve_for(curves, instrument_id), price, supply.get(instrument_id, 0)
+        )
+        for instrument_id, price in _session.execute(
+            select(Instrument.id, Instrument.price)
+        )
+    }
+
+
+def set_pricing_curve(_session: Session) -> None:
+    """Set, or with no kind remove, the current season's curve for the selected instrument."""
+    if st.session_state.keys() < {
+        "curve_instrument",
+        "curve_kind",
+        "curve_slope",
+        "curve_virtual_shares",
+    }:
+        LOGGER.error(
+            "`set_pricing_curve` called but required keys not in session state"
+        )
+        st.warning(
+            "Something went wrong, curve could not be set, please report this issue."
+        )
+        return
+
+    instrument = st.session_state["curve_instrument"]
+    instrument_id = instrument.id if instrument is not None else None
+    kind: Optional[CurveKind] = st.session_state["curve_kind"]
+    if kind == CurveKind.CONSTANT_PRODUCT:
+        # The pool must outnumber the shares that could ever be held
+        shares_query = select(func.count(Share.id)).group_by(Share.instrument_id)
+        if instrument_id is not None:
+            shares_query = shares_query.where(Share.instrument_id == instrument_id)
+        most_shares = max(_session.execute(shares_query).scalars(), default=0)
+        if st.session_state["curve_virtual_shares"] < most_shares + 2:
+            st.error(f"Virtual shares must be at least {most_shares + 2}")
+            return
+
+    season_id = _session.execute(
+        select(Season.id).where(
+            Season.start_date == get_season_start(_session=_session)
+        )
+    ).scalar_one()
+
+    # Deleted rather than updated, as the unique constraint doesn't cover null instruments
+    _session.execute(
+        delete(PricingCurve)
+        .where(PricingCurve.season_id == season_id)
+        .where(
+            PricingCurve.instrument_id.is_(None)
+            if instrument_id is None
+            else PricingCurve.instrument_id == instrument_id
+        )
+    )
+    if kind is not None:
+        _session.add(
+            PricingCurve(
+                season_id=season_id,
+                kind=kind,
+                instrument_id=instrument_id,
+                slope=float(st.session_state["curve_slope"]),
+                virtual_shares=int(st.session_state["curve_virtual_shares"]),
+            )
+        )
+    _session.commit()
+    LOGGER.info(
+        f"Set {kind.name if kind else 'no'} curve for instrument {instrument_id} in season {season_id}"
+    )
+
+    BUS.publish(PricingChanged(instrument_id=instrument_id))
@@ -1,5 +1,5 @@
 from datetime import date
-from typing import Dict
+from typing import TYPE_CHECKING, Dict
 
 import streamlit as st
 from sqlalchemy import func, select
@@ -9,12 +9,19 @@ from src.models.claan import Claan
 from src.models.record import Record
 from src.models.task import Task
 from src.models.user import User
+from src.utils.cache import cached
+from src.utils.data.frames import to_frame
 from src.utils.data.seasons import get_fortnight_start, get_season_start
-from src.utils.data.stocks import get_corporate_data
+from src.utils.database import read_only
+from src.utils.events import BUS, RecordSubmitted
 from src.utils.logger import LOGGER
 
+if TYPE_CHECKING:
+    import pandas as pd
 
-@st.cache_data(ttl=600)
+
+@cached(tags=["records", "season"], ttl=600)
+@read_only
 def get_scores(_session: Session) -> Dict[Claan, int]:
     season_start = get_season_start(_session=_session)
 
@@ -32,7 +39,8 @@ def get_scores(_session: Session) -> Dict[Claan, int]:
     return scores
 
 
-@st.cache_data(ttl=600)
+@cached(tags=lambda claan, result: [f"claan:{claan.name}", "season"], ttl=600)
+@read_only
 def get_claan_data(_session: Session, claan: Claan):
     """Returns some stats about the given Claan.
 
@@ -65,10 +73,20 @@ def get_claan_data(_session: Session, claan: Claan):
     }
 
 
-@st.cache_data(ttl=43200)
-def get_historical_data(_session: Session, claan: Claan) -> None:
+@cached(
+    tags=lambda claan, result: [f"claan:{claan.name}", "season", "users", "tasks"],
+    ttl=43200,
+)
+@read_only
+def get_historical_data(_session: Session, claan: Claan) -> "pd.DataFrame":
+    """Return the Claan's records this season, newest first, as a typed frame."""
     query = (
-        select(User.name, Task.description, Record.score, Record.timestamp)
+        select(
+            User.name,
+            Task.description.label("task"),
+            Record.score.label("reward"),
+            Record.timestamp,
+        )
         .select_from(User)
         .join(Record)
         .join(Task)
@@ -76,9 +94,16 @@ def get_historical_data(_session: Session, claan: Claan) -> None:
         .where(Record.timestamp >= get_season_start(_session=_session))
         .order_by(Record.timestamp.desc())
     )
-    records = _session.execute(query).all()
 
-    return records
+    return to_frame(
+        _session.execute(query),
+        dtypes={
+            "name": "string",
+            "task": "category",
+            "reward": "int64",
+            "timestamp": "datetime64[us]",
+        },
+    )
 
 
 def submit_record(_session: Session) -> Record:
@@ -124,16 +149,13 @@ def submit_record(_session: Session) -> Record:
 
     st.success(f"Task logged! ${record.score} added to escrow")
 
-    if "scores" in st.session_state:
-        LOGGER.info("Reloading `scores`")
-        get_scores.clear()
-        st.session_state["scores"] = get_scores(_session=_session)
-
-    if f"data_{record_claan.name}" in st.session_state:
-        LOGGER.info("Reloading `data`")
-        get_corporate_data.clear(claan=record_claan)
-        st.session_state[f"data_{record_claan.name}"] = get_corporate_data(
-            _session=_session, claan=record_claan
+    BUS.publish(
+        RecordSubmitted(
+            record_id=record.id,
+            user_id=record.user_id,
+            claan=record_claan,
+            score=record.score,
         )
+    )
 
     return record
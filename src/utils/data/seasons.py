@@ -2,14 +2,16 @@ from datetime import date, timedelta
 from math import floor
 from typing import Dict, Optional
 
-import streamlit as st
 from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
 from src.models.season import Season
+from src.utils.cache import cached
+from src.utils.database import read_only
 
 
-@st.cache_data(ttl=timedelta(weeks=2))
+@cached(tags=["season"], ttl=timedelta(weeks=2))
+@read_only
 def get_season_start(_session: Session) -> date:
     query = select(func.max(Season.start_date))
     result = _session.execute(query).scalar_one()
@@ -17,7 +19,8 @@ def get_season_start(_session: Session) -> date:
     return result
 
 
-@st.cache_data(ttl=timedelta(days=1))
+@cached(tags=["season"], ttl=timedelta(days=1))
+@read_only
 def get_fortnight_number(
     _session: Session,
     timestamp: Optional[date] = None,
@@ -40,7 +43,8 @@ def get_fortnight_number(
     return fortnight_number
 
 
-@st.cache_data(ttl=timedelta(days=1))
+@cached(tags=["season"], ttl=timedelta(days=1))
+@read_only
 def get_fortnight_start(
     _session: Session,
     timestamp: Optional[date] = None,
@@ -61,7 +65,8 @@ def get_fortnight_start(
     return fortnight_start
 
 
-@st.cache_data(ttl=timedelta(days=1))
+@cached(tags=["season"], ttl=timedelta(days=1))
+@read_only
 def get_fortnight_info(_session: Session) -> Dict[str, int | date]:
     """Returns a dict containing fortnight information.
 
@@ -81,3 +86,12 @@ def get_fortnight_info(_session: Session) -> Dict[str, int | date]:
         "start_date": start_date,
         "end_date": end_date,
     }
+
+
+@cached(tags=["season"], ttl=timedelta(days=1))
+@read_only
+def get_seasons(_session: Session) -> Dict[int, str]:
+    """Returns the name of every season by id, oldest first."""
+    query = select(Season.id, Season.name).order_by(Season.start_date)
+
+    return dict(_session.execute(query).all())
@@ -1,13 +1,21 @@
-from datetime import datetime
+from dataclasses import dataclass, replace
+from datetime import date, datetime
 from decimal import Decimal, FloatOperation, getcontext
-from typing import Dict, List
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Callable, Collection, Dict, List, Optional, Tuple
 
 import streamlit as st
-from sqlalchemy import func, inspect, select, update
+from sqlalchemy import func, select, update
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 
 from src.models.claan import Claan
+from src.models.dto import (
+    InstrumentDTO,
+    PortfolioDTO,
+    PositionDTO,
+    PositionStateDTO,
+)
 from src.models.market.company import Company
 from src.models.market.instrument import Instrument
 from src.models.market.portfolio import BoardVote, Portfolio
@@ -16,10 +24,39 @@ from src.models.market.transaction import Operation, Transaction
 from src.models.record import Record
 from src.models.task import Task
 from src.models.user import User
-from src.utils.data.seasons import get_fortnight_start
+from src.utils.cache import cached
+from src.utils.data.history import write_checkpoint
+from src.utils.data.ledger import PostingSpec, issue_shares, post
+from src.utils.data.pricing import curve_for, get_curves, get_supply
+from src.utils.data.seasons import get_fortnight_number, get_fortnight_start
 from src.utils.data.users import add_user as users_add_user
-from src.utils.database import Database
+from src.utils.database import Database, for_update, read_only
+from src.utils.events import (
+    BUS,
+    CreditIssued,
+    EscrowProcessed,
+    PortfolioOpened,
+    SharesIssued,
+    ShareTraded,
+    VoteChanged,
+)
 from src.utils.logger import LOGGER
+from src.utils.market_rules import (
+    OPENING_CASH,
+    Rejection,
+    buy_rejection,
+    payout_wins,
+    price_after_payout,
+    price_after_sale,
+    price_after_trade,
+    price_after_withhold,
+    sell_proceeds,
+    sell_rejection,
+)
+
+if TYPE_CHECKING:
+    # Only loaded when holdings are, as they're slow to import
+    import pandas as pd
 
 
 class ShareAlreadyOwnedError(Exception):
@@ -34,27 +71,37 @@ class CannotAffordError(Exception):
     pass
 
 
-@st.cache_data(ttl=600)
-def get_portfolio(_session: Session, user_id: int) -> Portfolio:
-    portfolio_query = select(Portfolio).where(Portfolio.user_id == user_id)
-    portfolio = _session.execute(portfolio_query).scalars().one()
+@cached(
+    tags=lambda user_id, result: [f"portfolio:{result.id}", "portfolios", "market"],
+    ttl=600,
+)
+@read_only
+def get_portfolio(_session: Session, user_id: int) -> PortfolioDTO:
+    portfolio_query = select(
+        Portfolio.id,
+        Portfolio.user_id,
+        Portfolio.company_id,
+        Portfolio.cash,
+        Portfolio.board_vote,
+    ).where(Portfolio.user_id == user_id)
+    portfolio = PortfolioDTO(*_session.execute(portfolio_query).one())
 
     return portfolio
 
 
-def update_vote(_session: Session, _portfolio: Portfolio, _claan: Claan) -> None:
+def update_vote(_session: Session, _portfolio: PortfolioDTO, _claan: Claan) -> None:
     portfolio = _session.get(Portfolio, _portfolio.id)
     portfolio.board_vote = st.session_state["portfolio_vote"]
     _session.commit()
     st.toast("Vote updated")
 
-    get_portfolio.clear(user_id=_portfolio.user_id)
-    st.session_state[f"portfolios_{_claan.name}"][_portfolio.user_id] = get_portfolio(
-        _session=_session, user_id=_portfolio.user_id
+    BUS.publish(
+        VoteChanged(portfolio_id=portfolio.id, claan=_claan, vote=portfolio.board_vote)
     )
 
 
-@st.cache_data(ttl=600)
+@cached(tags=lambda claan, result: [f"claan:{claan.name}", "market", "prices"], ttl=600)
+@read_only
 def get_corporate_data(_session: Session, claan: Claan) -> Dict[str, float]:
     company_query = select(Company).where(Company.claan == claan)
     company = _session.execute(company_query).scalar_one()
@@ -94,108 +141,115 @@ def get_corporate_data(_session: Session, claan: Claan) -> Dict[str, float]:
     }
 
 
-@st.cache_data(ttl=600)
-def get_owned_shares(_session: Session, claan: Claan) -> Dict[int, Dict[Claan, int]]:
-    """Returns count of owned shares for each user in a Claan.
+@dataclass(frozen=True)
+class HoldingsMatrix:
+    """Owned share counts for every portfolio (rows) and instrument (columns).
 
-    Return format is a set of nested dicts in the following format:
+    Instrument tickers, prices and Claans are column vectors aligned with ``counts``.
+    """
+
+    counts: "pd.DataFrame"
+    portfolio_claans: "pd.Series"
+    tickers: "pd.Series"
+    prices: "pd.Series"
+    instrument_claans: "pd.Series"
+
+    def for_claan(self, claan: Claan) -> "pd.DataFrame":
+        """Rows of ``counts`` for portfolios belonging to a Claan's members."""
+        return self.counts[self.portfolio_claans == claan]
 
-    .. return-format::
+    def owned(self, portfolio_id: int, instrument_id: int) -> int:
+        return int(self.counts.at[portfolio_id, instrument_id])
 
-        .. code-block:: python
+    def wallet(self, portfolio_id: int) -> "pd.DataFrame":
+        """A portfolio's shares, one row per Company."""
+        import pandas as pd
 
+        wallet = pd.DataFrame(
             {
-                <portfolio_id>: {
-                    <claan_1>: {
-                        "owned_count": <owned_count>,
-                        "ticker": <instrument_ticker>,
-                        "price": <instrument_price>,
-                    },
-                    ...
-                },
-                ...
+                "Ticker": self.tickers,
+                "Shares Owned": self.counts.loc[portfolio_id],
+                "Price": self.prices,
             }
-    """
-    # Collect relevant portfolios
-    portfolios_query = select(Portfolio).join(User).where(User.claan == claan)
-    portfolios = _session.execute(portfolios_query).scalars().all()
-
-    # Build empty result dict using portfolios
-    result = {
-        portfolio.id: {
-            user_claan: {
-                "owned_count": 0,
-            }
-            for user_claan in Claan
-        }
-        for portfolio in portfolios
-    }
+        )
+        wallet.index = self.instrument_claans.map(
+            lambda claan: claan.name.title().replace("_", " ")
+        )
+        wallet.index.name = "Company"
+        return wallet
+
+    def with_owned(
+        self, portfolio_id: int, instrument_id: int, owned: int
+    ) -> "HoldingsMatrix":
+        """Return a copy with one count replaced, leaving the cached matrix untouched."""
+        counts = self.counts.copy()
+        counts.at[portfolio_id, instrument_id] = owned
+        return replace(self, counts=counts)
+
+
+@cached(tags=["holdings", "prices", "market"], ttl=600)
+@read_only
+def get_holdings_matrix(_session: Session) -> HoldingsMatrix:
+    """Return owned share counts for the whole market, from one grouped query."""
+    import numpy as np
+    import pandas as pd
+
+    portfolios_query = (
+        select(Portfolio.id, User.claan).join(User).order_by(Portfolio.id)
+    )
+    portfolios = pd.DataFrame(
+        _session.execute(portfolios_query).all(), columns=["id", "claan"]
+    ).set_index("id")
 
-    # Parse instrument details
     instruments_query = (
-        select(Instrument.ticker, Instrument.price, Company.claan)
+        select(Instrument.id, Instrument.ticker, Instrument.price, Company.claan)
         .join(Company)
         .order_by(Instrument.id)
     )
-    instruments = _session.execute(instruments_query).all()
-    for row in instruments:
-        (ticker, share_price, share_claan) = row._tuple()
-        for portfolio_id, data in result.items():
-            for user_claan, data in data.items():
-                result[portfolio_id][share_claan]["ticker"] = ticker
-                result[portfolio_id][share_claan]["price"] = share_price
-
-    # Get owned share counts
-    sq_owned_shares = (
-        select(Share.owner_id, Company.claan)
-        .select_from(Share)
-        .join(Instrument)
-        .join(Company)
+    instruments = pd.DataFrame(
+        _session.execute(instruments_query).all(),
+        columns=["id", "ticker", "price", "claan"],
+    ).set_index("id")
+
+    owned_query = (
+        select(Share.owner_id, Share.instrument_id, func.count(Share.id))
         .where(Share.owner_id.is_not(None))
-    ).subquery()
-    owned_shares_query = (
-        select(
-            Portfolio.id.label("portfolio_id"),
-            sq_owned_shares.c.claan.label("claan"),
-            func.count(sq_owned_shares.c.claan).label("owned_count"),
-        )
-        .select_from(Portfolio)
-        .join(User, onclause=User.id == Portfolio.user_id)
-        .outerjoin(
-            sq_owned_shares,
-            onclause=Portfolio.id == sq_owned_shares.c.owner_id,
-        )
-        .group_by(
-            Portfolio.id,
-            sq_owned_shares.c.claan,
-        )
-        .where(User.claan == claan)
-        .order_by(Portfolio.id)
+        .group_by(Share.owner_id, Share.instrument_id)
+    )
+    owned = np.array(_session.execute(owned_query).all(), dtype="int64").reshape(-1, 3)
+
+    counts = np.zeros((len(portfolios), len(instruments)), dtype="int64")
+    rows = portfolios.index.get_indexer(owned[:, 0])
+    cols = instruments.index.get_indexer(owned[:, 1])
+    counts[rows, cols] = owned[:, 2]
+
+    return HoldingsMatrix(
+        counts=pd.DataFrame(
+            counts,
+            index=portfolios.index.rename("portfolio_id"),
+            columns=instruments.index.rename("instrument_id"),
+        ),
+        portfolio_claans=portfolios["claan"],
+        tickers=instruments["ticker"],
+        prices=instruments["price"],
+        instrument_claans=instruments["claan"],
     )
-    owned_shares = _session.execute(owned_shares_query).all()
-
-    # Parse share query results
-    for row in owned_shares:
-        (portfolio_id, share_claan, owned_count) = row._tuple()
-        if not portfolio_id or not share_claan or not owned_count:
-            LOGGER.warning("Return from owned shares shows 'None' value, skipping")
-            continue
-        result[portfolio_id][share_claan]["owned_count"] = owned_count
-
-    return result
 
 
-def issue_company_share(_session: Session, instrument: Instrument) -> None:
+def issue_company_share(_session: Session, instrument: InstrumentDTO) -> None:
     amount_to_issue = st.session_state["issue_amount"]
 
-    new_shares = []
-    for _ in range(0, amount_to_issue):
-        new_shares.append(Share(instrument=instrument.id, owner=None))
-
-    _session.add_all(new_shares)
+    issue_shares(_session, instrument_id=instrument.id, amount=amount_to_issue)
 
     if not _session.in_nested_transaction():
         _session.commit()
+        BUS.publish(
+            SharesIssued(
+                instrument_id=instrument.id,
+                claan=instrument.claan,
+                amount=amount_to_issue,
+            )
+        )
     else:
         _session.flush()
 
@@ -217,32 +271,16 @@ def delete_unowned_company_share(_session: Session, instrument: Instrument) -> N
 
     if not _session.in_nested_transaction():
         _session.commit()
+        BUS.publish(
+            SharesIssued(instrument_id=instrument.id, claan=instrument.claan, amount=-1)
+        )
 
 
-def grant_share_to_user(_session: Session, portfolio: Portfolio) -> None:
-    instrument_query = (
-        select(Instrument)
-        .join(Company)
-        .join(Portfolio)
-        .where(Portfolio.id == portfolio.id)
-    )
-    instrument = _session.execute(instrument_query).scalar_one()
-
-    share_query = (
-        select(Share)
-        .where(Share.owner_id.is_(None))
-        .where(Share.instrument_id == instrument.id)
-    )
-    share = _session.execute(share_query).scalars().first()
-
-    share.owner_id = portfolio.id
-    share.ipo = False
-
-    if not _session.in_nested_transaction():
-        _session.commit()
-
-
-@st.cache_data(ttl=600)
+@cached(
+    tags=lambda instrument_id, result: [f"instrument:{instrument_id}", "market"],
+    ttl=600,
+)
+@read_only
 def get_shares_for_sale(_session: Session, instrument_id: int) -> int:
     share_query = (
         select(func.count(Share.id))
@@ -254,14 +292,38 @@ def get_shares_for_sale(_session: Session, instrument_id: int) -> int:
     return count
 
 
-def get_all_shares(_session: Session) -> List[Share]:
-    shares_query = select(Share)
-    shares = _session.execute(shares_query).scalars().all()
+def get_position(
+    _session: Session, portfolio_id: int, instrument_id: int
+) -> PositionDTO:
+    """Read a portfolio's cash and holding, and an instrument's price and unowned count, in one query.
+
+    Not cached, as it's used to refresh the screen straight after a trade.
+    """
+    owned = (
+        select(func.count(Share.id))
+        .where(Share.owner_id == portfolio_id)
+        .where(Share.instrument_id == instrument_id)
+        .scalar_subquery()
+    )
+    for_sale = (
+        select(func.count(Share.id))
+        .where(Share.owner_id.is_(None))
+        .where(Share.instrument_id == instrument_id)
+        .scalar_subquery()
+    )
+    price = select(Instrument.price).where(Instrument.id == instrument_id)
+    position_query = select(
+        Portfolio.cash, owned, for_sale, price.scalar_subquery()
+    ).where(Portfolio.id == portfolio_id)
+    position = PositionDTO(
+        portfolio_id, instrument_id, *_session.execute(position_query).one()
+    )
 
-    return shares
+    return position
 
 
-@st.cache_data(ttl=600)
+@cached(tags=lambda claan, result: [f"ipo:{claan.name}", "market"], ttl=600)
+@read_only
 def get_ipo_count(_session: Session, claan: Claan) -> int:
     ipo_query = (
         select(func.count(Share.ipo))
@@ -276,57 +338,139 @@ def get_ipo_count(_session: Session, claan: Claan) -> int:
     return ipo
 
 
-def buy_share(_session: Session, portfolio: Portfolio, instrument: Instrument) -> bool:
-    if inspect(instrument).detached:
-        LOGGER.warning("Input instrument detached from session")
-        instrument = _session.merge(instrument)
-    if inspect(portfolio).detached:
-        LOGGER.warning("Input portfolio detached from session")
-        portfolio = _session.merge(portfolio)
+@cached(
+    tags=lambda portfolio_id, fortnight_start, result: [
+        f"portfolio:{portfolio_id}",
+        "portfolios",
+        "market",
+    ],
+    ttl=600,
+)
+@read_only
+def get_position_state(
+    _session: Session, portfolio_id: int, fortnight_start: date
+) -> PositionStateDTO:
+    """Read everything the trading rules need about a portfolio, to check trades without a query.
+
+    Kept up to date by this process's trades, which prime the cache with the state
+    they leave. Keyed by fortnight, so sales stop counting once it ends. Trades
+    check the rules again inside their transaction, so a stale state at worst
+    offers a trade that is then refused.
+    """
+    cash = _session.execute(
+        select(Portfolio.cash).where(Portfolio.id == portfolio_id)
+    ).scalar_one()
+    owned_query = (
+        select(Share.instrument_id, func.count(Share.id))
+        .where(Share.owner_id == portfolio_id)
+        .group_by(Share.instrument_id)
+    )
+    sold_query = (
+        select(Transaction.instrument_id)
+        .distinct()
+        .where(Transaction.portfolio_id == portfolio_id)
+        .where(Transaction.operation == Operation.SELL)
+        .where(Transaction.timestamp >= fortnight_start)
+    )
 
-    with _session.begin_nested() as nested:
-        LOGGER.info("--- User Purchasing Share ---")
-        LOGGER.info(f"\tUser: {portfolio.user.name}")
-        LOGGER.info(f"\tCash: ${portfolio.cash}")
-        LOGGER.info(f"\tShare: 1x {instrument.ticker} @ {instrument.price}")
-
-        fortnight_start = get_fortnight_start(_session=_session)
-        sold_already_query = (
-            select(func.count(Transaction.id))
-            .where(Transaction.timestamp >= fortnight_start)
-            .where(Transaction.portfolio_id == portfolio.id)
-            .where(Transaction.instrument_id == instrument.id)
-            .where(Transaction.operation == Operation.SELL)
-        )
-        sold_already = _session.execute(sold_already_query).scalar_one() != 0
+    return PositionStateDTO(
+        portfolio_id=portfolio_id,
+        fortnight_start=fortnight_start,
+        cash=cash,
+        owned=MappingProxyType(dict(_session.execute(owned_query).tuples().all())),
+        sold=frozenset(_session.execute(sold_query).scalars()),
+    )
 
-        if sold_already:
-            LOGGER.warning(
-                f"User {portfolio.user.name} attempted to buy shares having already sold them this fortnight."
-            )
-            st.error(
-                "You've already sold shares in this company, so you can't buy more until next fortnight."
-            )
-            return False
 
-        owned_count = len(
-            [share for share in portfolio.shares if share.instrument == instrument]
+def lock_position(
+    _session: Session, portfolio_id: int, instrument_id: int, fortnight_start: date
+) -> Tuple[Portfolio, int, bool]:
+    """Lock a portfolio for a trade, returning it with its holding of an instrument and whether it sold any this fortnight.
+
+    One query, whose values hold until the transaction ends, so the rules can be
+    checked again inside it.
+    """
+    owned = (
+        select(func.count(Share.id))
+        .where(Share.owner_id == portfolio_id)
+        .where(Share.instrument_id == instrument_id)
+        .scalar_subquery()
+    )
+    sold = (
+        select(Transaction.id)
+        .where(Transaction.portfolio_id == portfolio_id)
+        .where(Transaction.instrument_id == instrument_id)
+        .where(Transaction.operation == Operation.SELL)
+        .where(Transaction.timestamp >= fortnight_start)
+        .exists()
+    )
+    query = select(Portfolio, owned, sold).where(Portfolio.id == portfolio_id)
+    portfolio, owned_count, sold_already = _session.execute(
+        for_update(_session, query).execution_options(populate_existing=True)
+    ).one()
+
+    return portfolio, owned_count, bool(sold_already)
+
+
+def _reject(portfolio_id: int, ticker: str, rejection: Rejection) -> bool:
+    LOGGER.warning(f"Portfolio {portfolio_id} can't trade {ticker}: {rejection.name}")
+    st.error(rejection.value)
+    return False
+
+
+def buy_share(_session: Session, portfolio_id: int, instrument_id: int) -> bool:
+    """Buy 1 share of the given instrument for the given portfolio.
+
+    The rules are checked against the cached position state first, so a refused
+    trade costs no query, then again against the locked portfolio in the transaction.
+    """
+    instrument = _session.get(Instrument, instrument_id)
+    fortnight_start = get_fortnight_start(_session=_session)
+    state = get_position_state(
+        _session=_session, portfolio_id=portfolio_id, fortnight_start=fortnight_start
+    )
+    rejection = buy_rejection(
+        state.owned_count(instrument_id),
+        instrument_id in state.sold,
+        state.cash,
+        instrument.price,
+    )
+    if rejection is not None:
+        return _reject(portfolio_id, instrument.ticker, rejection)
+
+    with _session.begin_nested() as nested:
+        portfolio, owned_count, sold_already = lock_position(
+            _session, portfolio_id, instrument_id, fortnight_start
+        )
+        LOGGER.opt(lazy=True).debug(
+            "{user} (cash: ${cash}, owns {owned}) buying 1x {ticker} @ {price}",
+            user=lambda: portfolio.user.name,
+            cash=lambda: portfolio.cash,
+            owned=lambda: owned_count,
+            ticker=lambda: instrument.ticker,
+            price=lambda: instrument.price,
         )
-        LOGGER.warning(f"User owns: {owned_count}")
 
-        if owned_count >= 5:
-            LOGGER.warning(
-                f"User {portfolio.user.name} attempted to buy shares in a company when they already own 5."
-            )
-            st.error("Can't own more than 5 shares of a single Company")
-            return False
+        curve = curve_for(get_curves(_session=_session), instrument.id)
+        if curve is not None:
+            # Trades on a curve move the price, so concurrent ones are serialised
+            instrument = _session.execute(
+                for_update(
+                    _session, select(Instrument).where(Instrument.id == instrument.id)
+                ).execution_options(populate_existing=True)
+            ).scalar_one()
+            capacity = curve.capacity()
+            if capacity is not None and get_supply(_session, instrument.id) >= capacity:
+                LOGGER.warning(
+                    f"User {portfolio.user.name} attempted to buy share but the curve's pool is empty."
+                )
+                st.error("No shares left to buy!")
+                return False
+        price = instrument.price
 
-        if instrument.price > portfolio.cash:
-            LOGGER.warning(
-                f"User {portfolio.user.name} attempted to buy a share they can't afford (cash: ${portfolio.cash}, price: ${instrument.price})"
-            )
-            st.error("You don't have enough cash to buy that!")
-            return False
+        rejection = buy_rejection(owned_count, sold_already, portfolio.cash, price)
+        if rejection is not None:
+            return _reject(portfolio_id, instrument.ticker, rejection)
 
         share_ipo_query = (
             select(Share)
@@ -339,7 +483,7 @@ def buy_share(_session: Session, portfolio: Portfolio, instrument: Instrument) -
         try:
             share = _session.execute(share_ipo_query).scalar_one()
         except NoResultFound:
-            LOGGER.info("No shares found in IPO, will check non-IPO shares.")
+            LOGGER.debug("No shares found in IPO, will check non-IPO shares.")
             share_query = (
                 select(Share)
                 .where(Share.instrument == instrument)
@@ -356,11 +500,17 @@ def buy_share(_session: Session, portfolio: Portfolio, instrument: Instrument) -
                 return False
 
         LOGGER.info(
-            f"User {portfolio.user.name} buying {instrument.ticker}, successful. Saving..."
+            "Portfolio {portfolio_id} bought 1x {ticker} @ {price}",
+            portfolio_id=portfolio.id,
+            ticker=instrument.ticker,
+            price=price,
         )
+        if curve is not None:
+            supply = get_supply(_session, instrument.id)
+            instrument.price = float(price_after_trade(curve, price, supply, 1))
         _session.add(
             Transaction(
-                value=instrument.price,
+                value=price,
                 operation=Operation.BUY,
                 instrument=instrument,
                 portfolio=portfolio,
@@ -370,120 +520,171 @@ def buy_share(_session: Session, portfolio: Portfolio, instrument: Instrument) -
         )
         share.owner_id = portfolio.id
         share.ipo = False
-        portfolio.cash -= instrument.price
+        portfolio.cash -= price
 
         nested.commit()
 
-    get_portfolio.clear(user_id=portfolio.user_id)
-    if f"portfolios_{portfolio.company.claan.name}" in st.session_state:
-        LOGGER.info(f"Refreshing portfolios for {portfolio.company.claan.value}")
-        st.session_state[f"portfolios_{portfolio.company.claan.name}"][
-            portfolio.user_id
-        ] = get_portfolio(_session=_session, user_id=portfolio.user_id)
-
-    get_owned_shares.clear(claan=portfolio.user.claan)
-    if f"owned_shares_{portfolio.user.claan.name}" in st.session_state:
-        LOGGER.info(f"Refreshing owned shares for {portfolio.user.claan.value}")
-        st.session_state[f"owned_shares_{portfolio.user.claan.name}"] = (
-            get_owned_shares(_session=_session, claan=portfolio.user.claan)
-        )
+    _session.commit()
 
-    get_shares_for_sale.clear(instrument_id=instrument.id)
-    if "for_sale_count" in st.session_state:
-        LOGGER.info(f"Refreshing shares for sale count for {instrument.ticker}")
-        st.session_state["for_sale_count"][instrument] = get_shares_for_sale(
-            _session=st.session_state["db_session"], instrument_id=instrument.id
+    BUS.publish(
+        ShareTraded(
+            portfolio_id=portfolio.id,
+            instrument_id=instrument.id,
+            operation=Operation.BUY,
+            price=price,
+            portfolio_claan=portfolio.company.claan,
+            instrument_claan=instrument.company.claan,
         )
-
-    _session.commit()
+    )
+    # Primed after publishing, as subscribers invalidate the portfolio's cached state
+    get_position_state.prime(
+        state.with_trade(
+            instrument_id, cash=portfolio.cash, owned=owned_count + 1, sold=sold_already
+        ),
+        _session=_session,
+        portfolio_id=portfolio_id,
+        fortnight_start=fortnight_start,
+    )
     return True
 
 
-def sell_share(_session: Session, portfolio: Portfolio, instrument: Instrument) -> bool:
-    if inspect(instrument).detached:
-        LOGGER.warning("Input instrument detached from session")
-        instrument = _session.merge(instrument)
-    if inspect(portfolio).detached:
-        LOGGER.warning("Input portfolio detached from session")
-        portfolio = _session.merge(portfolio)
+def sell_share(_session: Session, portfolio_id: int, instrument_id: int) -> bool:
+    """Sell 1 share of the given instrument from the given portfolio.
+
+    Checked against the cached position state first, then inside the transaction.
+    """
+    instrument = _session.get(Instrument, instrument_id)
+    fortnight_start = get_fortnight_start(_session=_session)
+    state = get_position_state(
+        _session=_session, portfolio_id=portfolio_id, fortnight_start=fortnight_start
+    )
+    rejection = sell_rejection(state.owned_count(instrument_id))
+    if rejection is not None:
+        return _reject(portfolio_id, instrument.ticker, rejection)
 
-    """Sell 1 share of the given instrument from the given portfolio."""
     with _session.begin_nested() as nested:
-        LOGGER.info("--- User Selling Share ---")
-        LOGGER.info(f"\tUser: {portfolio.user.name}")
-        LOGGER.info(f"\tShare: 1x {instrument.ticker} @ {instrument.price}")
+        portfolio, owned_count, _ = lock_position(
+            _session, portfolio_id, instrument_id, fortnight_start
+        )
+        LOGGER.opt(lazy=True).debug(
+            "{user} selling 1x {ticker} @ {price}",
+            user=lambda: portfolio.user.name,
+            ticker=lambda: instrument.ticker,
+            price=lambda: instrument.price,
+        )
 
-        owned_share_query = (
+        rejection = sell_rejection(owned_count)
+        if rejection is not None:
+            return _reject(portfolio_id, instrument.ticker, rejection)
+        owned_share = _session.execute(
             select(Share)
             .where(Share.instrument_id == instrument.id)
             .where(Share.owner_id == portfolio.id)
             .limit(1)
-        )
-        try:
-            owned_share = _session.execute(owned_share_query).scalar_one()
-        except NoResultFound:
-            LOGGER.warning(
-                f"User {portfolio.user.name} attempted to sell a share they don't own."
+        ).scalar_one()
+
+        curve = curve_for(get_curves(_session=_session), instrument.id)
+        if curve is not None:
+            # Trades on a curve move the price, so concurrent ones are serialised
+            instrument = _session.execute(
+                for_update(
+                    _session, select(Instrument).where(Instrument.id == instrument.id)
+                ).execution_options(populate_existing=True)
+            ).scalar_one()
+            # The seller is paid the price of the share below, which becomes the price
+            value = float(
+                sell_proceeds(
+                    curve, instrument.price, get_supply(_session, instrument.id)
+                )
             )
-            st.error("You don't any shares of this company to sell.")
-            return False
+            new_price = value
+        else:
+            value = instrument.price
+            new_price = float(price_after_sale(instrument.price))
 
         new_transaction = Transaction(
-            value=instrument.price,
+            value=value,
             operation=Operation.SELL,
             instrument=instrument,
             portfolio=portfolio,
             company=None,
             timestamp=None,
         )
-        LOGGER.warning(new_transaction.id)
         _session.add(new_transaction)
 
         owned_share.owner_id = None
-        portfolio.cash += instrument.price
-        instrument.price = round(instrument.price - float(0.1), 2)
+        portfolio.cash += value
+        instrument.price = new_price
 
         nested.commit()
 
-    get_portfolio.clear(user_id=portfolio.user_id)
-    if f"portfolios_{portfolio.company.claan.name}" in st.session_state:
-        LOGGER.info(f"Refreshing portfolios for {portfolio.company.claan.value}")
-        st.session_state[f"portfolios_{portfolio.company.claan.name}"][
-            portfolio.user_id
-        ] = get_portfolio(_session=_session, user_id=portfolio.user_id)
-
-    get_owned_shares.clear(claan=portfolio.user.claan)
-    if f"owned_shares_{portfolio.user.claan.name}" in st.session_state:
-        LOGGER.info(f"Refreshing owned shares for {portfolio.user.claan.value}")
-        st.session_state[f"owned_shares_{portfolio.user.claan.name}"] = (
-            get_owned_shares(_session=_session, claan=portfolio.user.claan)
-        )
+    _session.commit()
 
-    get_shares_for_sale.clear(instrument_id=instrument.id)
-    if "for_sale_count" in st.session_state:
-        LOGGER.info(f"Refreshing shares for sale count for {instrument.ticker}")
-        st.session_state["for_sale_count"][instrument] = get_shares_for_sale(
-            _session=st.session_state["db_session"], instrument_id=instrument.id
+    BUS.publish(
+        ShareTraded(
+            portfolio_id=portfolio.id,
+            instrument_id=instrument.id,
+            operation=Operation.SELL,
+            price=new_transaction.value,
+            portfolio_claan=portfolio.company.claan,
+            instrument_claan=instrument.company.claan,
         )
-
-    _session.commit()
+    )
+    get_position_state.prime(
+        state.with_trade(
+            instrument_id, cash=portfolio.cash, owned=owned_count - 1, sold=True
+        ),
+        _session=_session,
+        portfolio_id=portfolio_id,
+        fortnight_start=fortnight_start,
+    )
     return True
 
 
-def get_instruments(_session: Session) -> List[Instrument]:
-    instruments_query = select(Instrument).order_by(Instrument.id)
-    instruments = _session.execute(instruments_query).scalars().all()
+@cached(tags=["prices", "market"])
+@read_only
+def get_instruments(_session: Session) -> List[InstrumentDTO]:
+    instruments_query = (
+        select(
+            Instrument.id,
+            Instrument.ticker,
+            Instrument.price,
+            Instrument.enabled,
+            Instrument.company_id,
+            Company.claan,
+        )
+        .join(Company)
+        .order_by(Instrument.id)
+    )
+    instruments = [InstrumentDTO(*row) for row in _session.execute(instruments_query)]
 
     return instruments
 
 
-def process_escrow(_session: Session) -> None:
-    from src.utils.data.scores import get_scores
+def process_escrow(
+    _session: Session,
+    fortnight: Optional[int] = None,
+    skip: Collection[Claan] = (),
+    on_company: Optional[Callable[[Claan, int, int], None]] = None,
+) -> List[Claan]:
+    """Pay out or withhold each company's escrow by board vote, then write a market checkpoint.
+
+    Each company is committed on its own, so a retried run passes the Claans already
+    processed as ``skip`` rather than paying them out twice.
 
-    companies_query = select(Company)
+    :param fortnight: Fortnight the checkpoint is written for, by default the current one.
+    :param on_company: Called with each Claan once committed, and the count of
+        companies processed and in total.
+    :return: Claans whose escrow was paid out.
+    """
+    companies_query = select(Company).order_by(Company.id)
     companies = _session.execute(companies_query).scalars().all()
 
-    for company in companies:
+    payouts = []
+    for processed, company in enumerate(companies, start=1):
+        if company.claan in skip:
+            continue
+
         LOGGER.info(f"Processing escrow for {company.claan.value.title()}")
         votes_query = (
             select(
@@ -494,8 +695,6 @@ def process_escrow(_session: Session) -> None:
             .group_by(Portfolio.board_vote)
         )
         votes = _session.execute(votes_query).all()
-        users_query = select(User).where(User.claan == company.claan)
-        users = _session.execute(users_query).scalars().all()
 
         results = {vote_type: 0 for vote_type in BoardVote}
 
@@ -506,44 +705,35 @@ def process_escrow(_session: Session) -> None:
         LOGGER.info(
             f"{company.claan.name} votes:\n\tPayout: {results[BoardVote.PAYOUT]}\n\tWithhold: {results[BoardVote.WITHOLD]}"
         )
-        if results[BoardVote.PAYOUT] >= results[BoardVote.WITHOLD]:
+        if payout_wins(results[BoardVote.PAYOUT], results[BoardVote.WITHOLD]):
             payout(_session, company)
+            payouts.append(company.claan)
         else:
             withhold(_session, company)
 
-        LOGGER.info("Clearing relevant function caches and reloading data")
+        _session.commit()
+        if on_company is not None:
+            on_company(company.claan, processed, len(companies))
 
-        get_scores.clear()
-        if "scores" in st.session_state:
-            st.session_state["scores"] = get_scores(_session=_session)
+    LOGGER.info("Writing market checkpoint")
+    if fortnight is None:
+        fortnight = get_fortnight_number(_session=_session)
+    write_checkpoint(_session=_session, fortnight=fortnight)
+    _session.commit()
 
-        get_corporate_data.clear(claan=company.claan)
-        if f"data_{company.claan.name}" in st.session_state:
-            st.session_state[f"data_{company.claan.name}"] = get_corporate_data(
-                _session=_session, claan=company.claan
-            )
+    BUS.publish(EscrowProcessed(fortnight=fortnight, payouts=tuple(payouts)))
 
-        for user in users:
-            get_portfolio.clear(user_id=user.id)
-        if f"porfolios_{company.claan.name}" in st.session_state:
-            st.session_state[f"portfolios_{company.claan.name}"] = {
-                user.id: get_portfolio(_session=_session, user_id=user.id)
-                for user in users
-            }
+    return payouts
 
-        get_owned_shares.clear(claan=company.claan)
-        if f"owned_shares_{company.claan.name}" in st.session_state:
-            st.session_state[f"owned_shares_{company.claan.name}"] = {
-                portfolio_id: {
-                    claan: {key: value for key, value in data.items()}
-                    for claan, data in data.items()
-                }
-                for portfolio_id, data in get_owned_shares(
-                    _session=_session, claan=company.claan
-                ).items()
-            }
 
-        _session.commit()
+def get_escrow(_session: Session, company: Company) -> int:
+    """Sum of a company's Claan's record scores still held in escrow."""
+    escrow_query = (
+        select(func.coalesce(func.sum(Record.score), 0))
+        .where(Record.claan == company.claan)
+        .where(Record.escrow)
+    )
+    return _session.execute(escrow_query).scalar_one()
 
 
 def payout(_session: Session, company: Company) -> None:
@@ -556,78 +746,65 @@ def payout(_session: Session, company: Company) -> None:
     with _session.begin_nested() as nested:
         instrument_query = select(Instrument).where(Instrument.company_id == company.id)
         instrument = _session.execute(instrument_query).scalar_one()
-        records_query = (
-            select(Record).where(Record.claan == company.claan).where(Record.escrow)
-        )
-        records = _session.execute(records_query).scalars().all()
-
-        amount_in_escrow = sum([Decimal(record.score) for record in records])
+        amount_in_escrow = Decimal(get_escrow(_session, company))
 
         shares_query = (
-            select(Share)
+            select(
+                func.count(Share.id),
+                func.count(Share.id).filter(Share.ipo),
+            )
             .join(Instrument)
-            .join(Company)
-            .where(Company.claan == company.claan)
+            .where(Instrument.company_id == company.id)
+        )
+        total_share_count, ipo_share_count = map(
+            Decimal, _session.execute(shares_query).one()
         )
-        shares = _session.execute(shares_query).scalars().all()
-
-        total_share_count = Decimal(len(shares))
-        ipo_share_count = Decimal(len([share for share in shares if share.ipo]))
 
         cash_per_share = round(amount_in_escrow / total_share_count, 2)
         cash_to_company = round(cash_per_share * ipo_share_count, 2)
 
-        LOGGER.info(f"Total share count: {total_share_count}")
-        LOGGER.info(f"Shares in IPO: {ipo_share_count}")
-        LOGGER.info(f"Cash per share: ${cash_per_share}")
-        LOGGER.info(f"Cash to company: ${cash_to_company}")
-
-        owned_shares_query = (
-            select(Portfolio, func.count(Share.owner_id))
-            .select_from(Share)
-            .join(Instrument, Instrument.id == Share.instrument_id)
-            .join(Company, onclause=Company.id == Instrument.company_id)
-            .join(Portfolio, onclause=Portfolio.id == Share.owner_id)
-            .where(Instrument.company == company)
-            .group_by(Portfolio)
+        LOGGER.debug(
+            "{} shares, {} in IPO, ${} per share, ${} to company",
+            total_share_count,
+            ipo_share_count,
+            cash_per_share,
+            cash_to_company,
         )
-        owned_shares = _session.execute(owned_shares_query).all()
 
         ##-- Perform data updates --##
-        new_transactions = []
-
-        LOGGER.info("Adding shareholder dividend transactions...")
-        for row in owned_shares:
-            (portfolio, owned_count) = row._tuple()
-            new_transactions.append(
-                Transaction(
-                    value=float(cash_per_share * owned_count),
-                    operation=Operation.CREDIT,
-                    instrument=None,
-                    portfolio=portfolio,
-                    company=None,
-                    timestamp=None,
-                )
-            )
-            portfolio.cash += float(cash_per_share * owned_count)
-            _session.flush()
+        LOGGER.debug("Adding shareholder dividend transactions...")
+        shareholders = (
+            select(Share.owner_id.label("id"))
+            .join(Instrument)
+            .where(Instrument.company_id == company.id)
+            .where(Share.owner_id.is_not(None))
+            .group_by(Share.owner_id)
+        )
+        dividends = post(
+            _session,
+            PostingSpec(
+                operation=Operation.CREDIT,
+                holder=Portfolio,
+                targets=shareholders,
+                amount=func.count(Share.id) * float(cash_per_share),
+            ),
+        )
+        LOGGER.info(
+            "Paid ${:.2f} to {} shareholders", dividends.total, dividends.postings
+        )
 
-        LOGGER.info("Adding Claan vault transaction...")
-        new_transactions.append(
-            Transaction(
-                value=float(cash_to_company),
+        LOGGER.debug("Adding Claan vault transaction...")
+        post(
+            _session,
+            PostingSpec(
                 operation=Operation.CREDIT,
-                instrument=None,
-                timestamp=None,
-                company=company,
-                portfolio=None,
-            )
+                holder=Company,
+                targets=select(Company.id).where(Company.id == company.id),
+                amount=float(cash_to_company),
+            ),
         )
-        company.cash += float(cash_to_company)
-        _session.add_all(new_transactions)
-        _session.flush()
 
-        LOGGER.info("Emptying escrow...")
+        LOGGER.debug("Emptying escrow...")
         update_records_query = (
             update(Record)
             .where(Record.claan == company.claan)
@@ -637,13 +814,12 @@ def payout(_session: Session, company: Company) -> None:
         _session.execute(update_records_query)
         _session.flush()
 
-        if float(cash_per_share) >= instrument.price:
-            LOGGER.info("Payout high enough, increasing share price...")
-            instrument.price += 10
+        new_price = float(price_after_payout(instrument.price, float(cash_per_share)))
+        if new_price != instrument.price:
+            LOGGER.debug("Payout high enough, increasing share price...")
+            instrument.price = new_price
             _session.flush()
 
-        print("")
-
 
 def withhold(_session: Session, company: Company) -> None:
     decimal_context = getcontext()
@@ -656,34 +832,25 @@ def withhold(_session: Session, company: Company) -> None:
         instrument_query = select(Instrument).where(Instrument.company_id == company.id)
         instrument = _session.execute(instrument_query).scalar_one()
 
-        records_query = (
-            select(Record).where(Record.claan == company.claan).where(Record.escrow)
-        )
-        records = _session.execute(records_query).scalars().all()
-        amount_in_escrow = sum([Decimal(record.score) for record in records])
-        LOGGER.info(f"Amount in escrow: {amount_in_escrow}")
+        amount_in_escrow = Decimal(get_escrow(_session, company))
+        LOGGER.debug("Amount in escrow: {}", amount_in_escrow)
 
-        LOGGER.info("Adding Claan vault transaction")
-        _session.add(
-            Transaction(
-                value=float(amount_in_escrow),
+        LOGGER.debug("Adding Claan vault transaction")
+        post(
+            _session,
+            PostingSpec(
                 operation=Operation.CREDIT,
-                instrument=None,
-                timestamp=None,
-                company=company,
-                portfolio=None,
-            )
+                holder=Company,
+                targets=select(Company.id).where(Company.id == company.id),
+                amount=float(amount_in_escrow),
+            ),
         )
-        company.cash += float(amount_in_escrow)
-        _session.flush()
 
-        LOGGER.info("Decreasing share price...")
-        instrument.price -= 10
-        if instrument.price < 10:
-            instrument.price = 10
+        LOGGER.debug("Decreasing share price...")
+        instrument.price = float(price_after_withhold(instrument.price))
         _session.flush()
 
-        LOGGER.info("Emptying escrow...")
+        LOGGER.debug("Emptying escrow...")
         update_records_query = (
             update(Record)
             .where(Record.claan == company.claan)
@@ -693,39 +860,24 @@ def withhold(_session: Session, company: Company) -> None:
         _session.execute(update_records_query)
         _session.flush()
 
-        print("")
-
 
 def issue_credit(_session: Session, value: float):
     LOGGER.info(f"Issuing credit of ${value:.2f} to every portfolio.")
     with _session.begin_nested():
-        portfolios = _session.execute(select(Portfolio)).scalars().all()
-
-        new_transactions = []
-        for portfolio in portfolios:
-            new_transactions.append(
-                Transaction(
-                    value=value,
-                    operation=Operation.CREDIT,
-                    instrument=None,
-                    portfolio=portfolio,
-                    company=None,
-                    timestamp=None,
-                )
-            )
-            portfolio.cash = round(portfolio.cash + value, 2)
-        _session.add_all(new_transactions)
-
-    get_portfolio.clear()
-    for claan in Claan:
-        if f"portfolios_{claan.name}" in st.session_state:
-            st.session_state[f"portfolios_{claan.name}"] = {
-                user.id: get_portfolio(_session=_session, user_id=user.id)
-                for user in st.session_state[f"users_{claan.name}"]
-            }
+        result = post(
+            _session,
+            PostingSpec(
+                operation=Operation.CREDIT,
+                holder=Portfolio,
+                targets=select(Portfolio.id),
+                amount=value,
+            ),
+        )
 
     _session.commit()
-    LOGGER.info("Complete credit issue")
+
+    BUS.publish(CreditIssued(value=value, portfolios=result.postings))
+    LOGGER.info(f"Complete credit issue, ${result.total:.2f} in total")
 
 
 def add_user(_session: Session) -> User:
@@ -735,12 +887,29 @@ def add_user(_session: Session) -> User:
     company = _session.execute(company_query).scalar_one()
 
     portfolio = Portfolio(user, company)
-    portfolio.cash = 50.0
+    portfolio.cash = OPENING_CASH
     _session.add(portfolio)
+    _session.flush()
+
+    # Opening balance goes through the ledger so the portfolio reconciles
+    _session.add(
+        Transaction(
+            value=portfolio.cash,
+            operation=Operation.CREDIT,
+            instrument=None,
+            portfolio=portfolio,
+            company=None,
+            timestamp=None,
+        )
+    )
 
     _session.commit()
 
+    BUS.publish(
+        PortfolioOpened(portfolio_id=portfolio.id, user_id=user.id, claan=user.claan)
+    )
+
 
 if __name__ == "__main__":
     session = Database.get_session()
-    get_owned_shares(_session=session, claan=Claan.WAVE_RIDERS)
+    get_holdings_matrix(_session=session).for_claan(Claan.WAVE_RIDERS)
@@ -0,0 +1,156 @@
+"""Data layer subscribers for the domain events in :mod:`src.utils.events`.
+
+Cache invalidation, session state eviction, pinning reads to the primary and marking
+the portal snapshot stale run synchronously, as all are cheap and must be done before
+the next rerun reads them. Evicted session state keys are reloaded lazily by the
+pages, which load any key missing from the session state, and the snapshot is rebuilt
+by :mod:`src.utils.snapshot` on a thread of its own.
+
+The audit log runs in the background.
+"""
+
+from typing import Iterable, List
+
+import streamlit as st
+
+from src.models.claan import Claan
+from src.models.market.transaction import Operation
+from src.utils.cache import CACHE
+from src.utils.data.history import get_portfolio_labels
+from src.utils.events import (
+    BUS,
+    CreditIssued,
+    EscrowProcessed,
+    Event,
+    PortfolioOpened,
+    PricingChanged,
+    RecordSubmitted,
+    SharesIssued,
+    ShareTraded,
+    TasksChanged,
+    UsersChanged,
+    VoteChanged,
+)
+from src.utils.logger import LOGGER
+from src.utils.snapshot import SESSION_GENERATION, SNAPSHOTS
+
+
+def _market_keys(claans: Iterable[Claan] = Claan) -> List[str]:
+    keys = ["instruments", "for_sale_count", "holdings", "quote_ladders"]
+    for claan in claans:
+        keys += [f"ipo_{claan.name}", f"portfolios_{claan.name}"]
+    return keys
+
+
+def invalidate_cache(event: Event) -> None:
+    match event:
+        case RecordSubmitted(claan=claan):
+            CACHE.invalidate("records", f"claan:{claan.name}")
+        case ShareTraded():
+            # Both move the price, buying only on a curve, which the Claan's data shows
+            CACHE.invalidate(
+                f"portfolio:{event.portfolio_id}",
+                "holdings",
+                f"instrument:{event.instrument_id}",
+                f"ipo:{event.instrument_claan.name}",
+                f"claan:{event.instrument_claan.name}",
+                "prices",
+            )
+        case SharesIssued():
+            CACHE.invalidate(
+                f"instrument:{event.instrument_id}", f"ipo:{event.claan.name}"
+            )
+        case VoteChanged():
+            CACHE.invalidate(f"portfolio:{event.portfolio_id}")
+        case EscrowProcessed():
+            CACHE.invalidate("market", "records")
+        case PricingChanged():
+            CACHE.invalidate("pricing")
+        case CreditIssued():
+            CACHE.invalidate("portfolios")
+        case PortfolioOpened():
+            CACHE.invalidate("holdings")
+            get_portfolio_labels.clear()
+        case UsersChanged(cascade=cascade):
+            CACHE.invalidate("users", *(["market", "records"] if cascade else []))
+        case TasksChanged(cascade=cascade):
+            CACHE.invalidate("tasks", *(["records"] if cascade else []))
+
+
+def pin_primary(event: Event) -> None:
+    """Read from the primary until the replica has caught up with the write behind ``event``."""
+    from src.utils.database import Database
+
+    Database.pin_primary()
+
+
+def forget_session_state(event: Event) -> None:
+    match event:
+        case RecordSubmitted(claan=claan):
+            keys = [f"historical_{claan.name}"]
+        # The trading panel patches its own portfolio, holdings, price and unowned
+        # count from the trade, so only data shown elsewhere on the page is dropped
+        case ShareTraded(operation=Operation.BUY):
+            keys = [f"ipo_{event.instrument_claan.name}", "quote_ladders"]
+        case ShareTraded(operation=Operation.SELL):
+            keys = ["quote_ladders"]
+        case SharesIssued():
+            keys = ["for_sale_count", f"ipo_{event.claan.name}"]
+        case VoteChanged():
+            keys = [f"portfolios_{event.claan.name}"]
+        case EscrowProcessed():
+            keys = _market_keys()
+        case PricingChanged():
+            keys = ["quote_ladders"]
+        case CreditIssued():
+            keys = [f"portfolios_{claan.name}" for claan in Claan]
+        case PortfolioOpened():
+            keys = [
+                "holdings",
+                f"portfolios_{event.claan.name}",
+            ]
+        case UsersChanged(cascade=cascade):
+            keys = ["users"] + [f"users_{claan.name}" for claan in Claan]
+            if cascade:
+                keys += _market_keys()
+        case TasksChanged(cascade=cascade):
+            keys = ["tasks", "active_tasks"]
+            if cascade:
+                keys += [f"historical_{claan.name}" for claan in Claan]
+        case _:
+            return
+
+    for key in keys:
+        st.session_state.pop(key, None)
+
+
+def invalidate_snapshot(event: Event) -> None:
+    """Rebuild the portal snapshot, which this session waits for so it sees its write."""
+    match event:
+        case (
+            RecordSubmitted()
+            | ShareTraded()
+            | EscrowProcessed()
+            | UsersChanged(cascade=True)
+            | TasksChanged(cascade=True)
+        ):
+            pass
+        case _:
+            return
+
+    st.session_state[SESSION_GENERATION] = SNAPSHOTS.invalidate()
+
+
+def log_event(event: Event) -> None:
+    LOGGER.info("Event: {}", event)
+
+
+def register() -> None:
+    BUS.subscribe(Event, pin_primary)
+    BUS.subscribe(Event, invalidate_cache)
+    BUS.subscribe(Event, forget_session_state)
+    BUS.subscribe(Event, invalidate_snapshot)
+    BUS.subscribe(Event, log_event, background=True)
+
+
+register()
@@ -4,23 +4,37 @@ import streamlit as st
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
+from src.models.dto import TaskDTO
 from src.models.task import Task
-from src.utils.data.users import get_users
+from src.utils.cache import cached
+from src.utils.database import read_only
+from src.utils.events import BUS, TasksChanged
 from src.utils.logger import LOGGER
 
+TASK_COLUMNS = (
+    Task.id,
+    Task.description,
+    Task.reward,
+    Task.ephemeral,
+    Task.active,
+    Task.last,
+)
 
-@st.cache_data()
-def get_tasks(_session: Session) -> List[Task]:
-    query = select(Task).order_by(Task.reward.asc())
-    result = _session.execute(query).scalars().all()
+
+@cached(tags=["tasks"])
+@read_only
+def get_tasks(_session: Session) -> List[TaskDTO]:
+    query = select(*TASK_COLUMNS).order_by(Task.reward.asc())
+    result = [TaskDTO(*row) for row in _session.execute(query)]
 
     return result
 
 
-@st.cache_data()
-def get_active_tasks(_session: Session) -> List[Task]:
-    query = select(Task).where(Task.active).order_by(Task.reward)
-    result = _session.execute(query).scalars().all()
+@cached(tags=["tasks"])
+@read_only
+def get_active_tasks(_session: Session) -> List[TaskDTO]:
+    query = select(*TASK_COLUMNS).where(Task.active).order_by(Task.reward)
+    result = [TaskDTO(*row) for row in _session.execute(query)]
 
     return result
 
@@ -48,9 +62,7 @@ def add_task(_session: Session) -> Task:
     _session.add(task)
     _session.commit()
 
-    if "tasks" in st.session_state:
-        get_tasks.clear()
-        st.session_state["tasks"] = get_tasks(_session=_session)
+    BUS.publish(TasksChanged())
 
     return task
 
@@ -66,13 +78,8 @@ def delete_task(_session: Session) -> None:
     _session.delete(task)
     _session.commit()
 
-    if "tasks" in st.session_state:
-        get_tasks.clear()
-        st.session_state["tasks"] = get_users(_session=_session)
-
-    if "active_task" in st.session_state and task in st.session_state["active_quest"]:
-        get_active_tasks.clear()
-        st.session_state["active_quest"] = get_active_tasks(_session=_session)
+    # Deleting a task cascades to its records
+    BUS.publish(TasksChanged(cascade=True))
 
 
 def set_active_task(_session: Session) -> None:
@@ -98,11 +105,4 @@ def set_active_task(_session: Session) -> None:
 
     _session.commit()
 
-    if "active_tasks" in st.session_state:
-        LOGGER.info("Reloading `active_tasks`")
-        get_active_tasks.clear()
-        st.session_state["active_tasks"] = get_active_tasks(_session=_session)
-    if "tasks" in st.session_state:
-        LOGGER.info("Reloading `tasks`")
-        get_tasks.clear()
-        st.session_state["tasks"] = get_tasks(_session=_session)
+    BUS.publish(TasksChanged())
@@ -5,22 +5,37 @@ from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from src.models.claan import Claan
+from src.models.dto import UserDTO
 from src.models.user import User
+from src.utils.cache import cached
+from src.utils.database import read_only
+from src.utils.events import BUS, UsersChanged
 from src.utils.logger import LOGGER
 
+USER_COLUMNS = (
+    User.id,
+    User.name,
+    User.long_name,
+    User.email,
+    User.claan,
+    User.active,
+)
 
-@st.cache_data()
-def get_users(_session: Session) -> List[User]:
-    query = select(User).order_by(User.name.asc())
-    result = _session.execute(query).scalars().all()
+
+@cached(tags=["users"])
+@read_only
+def get_users(_session: Session) -> List[UserDTO]:
+    query = select(*USER_COLUMNS).order_by(User.name.asc())
+    result = [UserDTO(*row) for row in _session.execute(query)]
 
     return result
 
 
-@st.cache_data()
-def get_claan_users(_session: Session, claan: Claan) -> List[User]:
-    query = select(User).where(User.claan == claan).order_by(User.name)
-    result = _session.execute(query).scalars().all()
+@cached(tags=["users"])
+@read_only
+def get_claan_users(_session: Session, claan: Claan) -> List[UserDTO]:
+    query = select(*USER_COLUMNS).where(User.claan == claan).order_by(User.name)
+    result = [UserDTO(*row) for row in _session.execute(query)]
 
     return result
 
@@ -49,18 +64,7 @@ def add_user(_session: Session) -> User:
     _session.add(user)
     _session.commit()
 
-    if "users" in st.session_state:
-        LOGGER.info("Reloading `users`")
-        get_users.clear()
-        st.session_state["users"] = get_users(_session=_session)
-
-    if f"users_{user.claan.name}" in st.session_state:
-        LOGGER.info(f"Reloading `users_{user.claan.name}`")
-        get_claan_users.clear(claan=user.claan)
-        if f"users_{user.claan.name}" in st.session_state:
-            st.session_state[f"users_{user.claan.name}"] = get_claan_users(
-                _session=_session, claan=user.claan
-            )
+    BUS.publish(UsersChanged())
 
     return user
 
@@ -91,20 +95,8 @@ def update_user(_session: Session) -> User:
 
     _session.commit()
 
-    if "users" in st.session_state:
-        LOGGER.info("Reloading `users`")
-        get_users.clear()
-        st.session_state["users"] = get_users(_session=_session)
-
-    if f"users_{st.session_state["update_user_claan"].name}" in st.session_state:
-        LOGGER.info(f"Reload `users_{st.session_state["update_user_claan"].name}")
-        get_claan_users.clear(claan=st.session_state["update_user_claan"])
-        if f"users_{st.session_state["update_user_claan"].name}" in st.session_state:
-            st.session_state[f"users_{st.session_state["update_user_claan"]}"] = (
-                get_claan_users(
-                    _session=_session, claan=st.session_state["update_user_claan"]
-                )
-            )
+    # A Claan change moves the user between Claan lists and portfolios between holdings
+    BUS.publish(UsersChanged(cascade=True))
 
 
 def delete_user(_session: Session) -> None:
@@ -118,14 +110,5 @@ def delete_user(_session: Session) -> None:
     _session.delete(user)
     _session.commit()
 
-    if "users" in st.session_state:
-        LOGGER.info("Reloading `users`")
-        get_users.clear()
-        st.session_state["users"] = get_users(_session=_session)
-
-    if f"users_{target.claan.name}" in st.session_state:
-        LOGGER.info(f"Reloading `users_{target.claan.name}`")
-        get_claan_users.clear(claan=target.claan)
-        st.session_state[f"users_{target.claan.name}"] = get_claan_users(
-            _session=_session, claan=target.claan
-        )
+    # Deleting a user cascades to their portfolio, records and transactions
+    BUS.publish(UsersChanged(cascade=True))
@@ -1,42 +1,336 @@
 from datetime import date
+from functools import wraps
+from inspect import signature
 from pathlib import Path
+from threading import Lock, RLock
+from time import monotonic
 from typing import Optional
 
-import streamlit as st
 import toml
-from faker import Faker
-from sqlalchemy import create_engine, func, select
+from sqlalchemy import (
+    Select,
+    create_engine,
+    delete,
+    event,
+    false,
+    func,
+    select,
+    text,
+)
 from sqlalchemy.engine import URL
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
+# Limits every session's queries to the current tenant
+import src.utils.tenancy  # noqa: F401
 from src.models.base import Base
 from src.models.task_reward import TaskReward
 from src.utils.logger import LOGGER
+from src.utils.tracing import trace_sql
+
+SECRETS_PATH = Path("./.streamlit/secrets.toml")
+
+# Seconds behind the primary the replica reports, or 0 when it's caught up or isn't a standby
+REPLICA_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+    """
+)
+
+
+def _memoised(func):
+    """Cache ``func``'s result per arguments for the life of the process.
+
+    For the engines and sessionmakers, which background threads such as event
+    subscribers and the snapshot builder also use. ``st.cache_resource`` needs a
+    Streamlit runtime, and starts threads of its own.
+    """
+    results = {}
+    lock = RLock()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key not in results:
+                results[key] = func(*args, **kwargs)
+            return results[key]
+
+    def clear() -> None:
+        with lock:
+            results.clear()
+
+    wrapper.clear = clear
+    return wrapper
+
+
+def _load_secrets(secrets_path: Path) -> dict:
+    if not secrets_path.exists():
+        raise FileNotFoundError(
+            "Secrets file not found. If no file path was provided, default path not found."
+        )
+
+    return toml.load(secrets_path)
+
+
+# Applied to every embedded SQLite connection, and overridable per database in secrets
+SQLITE_PRAGMAS = {
+    # Readers don't block the writer, or each other
+    "journal_mode": "WAL",
+    # Safe with WAL, only the last commits can be lost on power failure
+    "synchronous": "NORMAL",
+    # Enforce the ON DELETE CASCADE the models rely on, as Postgres does
+    "foreign_keys": "ON",
+    # Milliseconds to wait for the write lock before failing
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    # Negative is in KiB, so 64MB of page cache per connection
+    "cache_size": -65536,
+}
+
+
+def create_sqlite_engine(
+    database: str = ":memory:", pool_size: int = 5, **pragmas
+) -> Engine:
+    """Create an engine for an embedded SQLite database, for running without a database server.
+
+    File databases use WAL and a connection pool, so Streamlit's threads and the
+    background event subscribers can read while one writes. An in-memory database
+    is private to its connection, so the engine shares a single connection instead,
+    which only suits one session at a time.
+
+    :param database: Path to the database file, created if missing, or ``:memory:``.
+    :param pragmas: Overrides for :data:`SQLITE_PRAGMAS`.
+    """
+    in_memory = database in ("", ":memory:")
+    if in_memory:
+        pool_options = {"poolclass": StaticPool}
+    else:
+        pool_options = {
+            "poolclass": QueuePool,
+            "pool_size": pool_size,
+            "max_overflow": pool_size * 2,
+        }
+
+    engine = create_engine(
+        URL.create("sqlite", database=database),
+        connect_args={"check_same_thread": False},
+        echo=False,
+        **pool_options,
+    )
+    settings = {**SQLITE_PRAGMAS, **pragmas}
+    if in_memory:
+        del settings["journal_mode"]
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        # Leave transactions to SQLAlchemy rather than the driver, so savepoints work
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in settings.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    trace_sql(engine)
+    return engine
+
+
+def _connection_url(connection_info: dict) -> URL:
+    connection_info = dict(connection_info)
+    connection_info["drivername"] = connection_info.pop("dialect")
+    return URL.create(**connection_info)
+
+
+def _create_engine(connection_info: dict) -> Engine:
+    if connection_info.get("dialect", "").startswith("sqlite"):
+        options = {
+            key: value for key, value in connection_info.items() if key != "dialect"
+        }
+        return create_sqlite_engine(**options)
+
+    engine = create_engine(_connection_url(connection_info), echo=False)
+    trace_sql(engine)
+    return engine
 
 
 class Database:
+    """Engines and sessions for the primary database, and an optional read replica.
+
+    The primary is ``[connections.postgresql]`` in ``.streamlit/secrets.toml``, or
+    for an embedded database with no server, ``[connections.sqlite]``:
+
+    .. code-block:: toml
+
+        [connections.sqlite]
+        database = "claans.db"
+        pool_size = 5             # optional
+        cache_size = -131072      # optional, any pragma in SQLITE_PRAGMAS
+
+    The replica is configured in ``.streamlit/secrets.toml`` alongside the primary,
+    with the same keys plus optional routing settings:
+
+    .. code-block:: toml
+
+        [connections.replica]
+        dialect = "postgresql+psycopg2"
+        host = "replica.example.com"
+        # ...
+        max_lag = 5.0             # seconds behind the primary before reads fall back to it
+        lag_check_interval = 5.0  # seconds between lag checks
+
+    Loaders wrapped with :func:`read_only` run on the replica, unless it's lagging by
+    more than ``max_lag`` or a write committed in the last ``max_lag`` seconds, in which
+    case they stay on the primary so they see the write. Everything else, including
+    writes and the reads straight after a trade, always uses the primary.
+    """
+
+    # Set by use_engine, in place of the engine from secrets
+    _engine: Optional[Engine] = None
+    _routing_lock = Lock()
+    # monotonic() before which reads stay on the primary, moved on by every write
+    _primary_until: float = 0.0
+    _lag_checked: float = float("-inf")
+    _lag: float = 0.0
+
+    @classmethod
+    @_memoised
+    def get_engine(cls, secrets_path: Optional[Path] = SECRETS_PATH) -> Engine:
+        if cls._engine is not None:
+            return cls._engine
+
+        connections: dict = _load_secrets(secrets_path).get("connections")
+        if "postgresql" in connections:
+            connection_info = connections["postgresql"]
+        else:
+            connection_info = {"dialect": "sqlite", **connections["sqlite"]}
+
+        return _create_engine(connection_info)
+
+    @classmethod
+    def use_engine(cls, engine: Engine) -> None:
+        """Use ``engine`` for the primary instead of the one configured in secrets.
+
+        For scripts that bring their own database, such as an in-memory SQLite one.
+        """
+        cls._engine = engine
+        for method in (cls.get_engine, cls.get_sessionmaker, cls.get_session):
+            method.clear()
+
     @classmethod
-    @st.cache_resource
-    def get_engine(
-        cls, secrets_path: Optional[Path] = Path("./.streamlit/secrets.toml")
-    ) -> Engine:
+    @_memoised
+    def get_replica_settings(cls, secrets_path: Optional[Path] = SECRETS_PATH) -> dict:
+        """Return the ``[connections.replica]`` secrets, or an empty dict if there's no replica."""
         if not secrets_path.exists():
-            raise FileNotFoundError(
-                "Secrets file not found. If no file path was provided, default path not found."
-            )
+            return {}
+
+        return dict(toml.load(secrets_path).get("connections", {}).get("replica", {}))
 
-        secrets = toml.load(secrets_path)
-        connection_info: dict = secrets.get("connections").get("postgresql")
-        connection_info["drivername"] = connection_info.pop("dialect")
-        url = URL.create(**connection_info)
+    @classmethod
+    @_memoised
+    def get_read_engine(cls) -> Optional[Engine]:
+        """Return the read replica's engine, or ``None`` if none is configured."""
+        settings = cls.get_replica_settings()
+        if not settings:
+            return None
 
-        engine = create_engine(url, echo=False)
+        connection_info = {
+            key: value
+            for key, value in settings.items()
+            if key not in ("max_lag", "lag_check_interval")
+        }
+        engine = _create_engine(connection_info)
+        LOGGER.info(f"Routing read-only loaders to replica {engine.url!r}")
 
         return engine
 
     @classmethod
-    @st.cache_resource
+    @_memoised
+    def get_read_sessionmaker(cls) -> Optional[sessionmaker]:
+        engine = cls.get_read_engine()
+        if engine is None:
+            return None
+
+        return sessionmaker(bind=engine, expire_on_commit=False)
+
+    @classmethod
+    def replica_max_lag(cls) -> float:
+        return float(cls.get_replica_settings().get("max_lag", 5.0))
+
+    @classmethod
+    def replica_lag(cls) -> float:
+        """Return the replica's lag in seconds, checked at most every ``lag_check_interval``.
+
+        An unreachable replica counts as infinitely behind.
+        """
+        interval = float(cls.get_replica_settings().get("lag_check_interval", 5.0))
+        with cls._routing_lock:
+            if monotonic() - cls._lag_checked < interval:
+                return cls._lag
+            cls._lag_checked = monotonic()
+
+        engine = cls.get_read_engine()
+        try:
+            if engine.dialect.name == "postgresql":
+                with engine.connect() as connection:
+                    lag = float(connection.scalar(REPLICA_LAG_QUERY))
+            else:
+                lag = 0.0
+        except Exception:
+            LOGGER.exception("Replica lag check failed, reading from the primary")
+            lag = float("inf")
+
+        if lag > cls.replica_max_lag():
+            LOGGER.warning(f"Replica is {lag:.1f}s behind, reading from the primary")
+        cls._lag = lag
+        return lag
+
+    @classmethod
+    def pin_primary(cls) -> None:
+        """Keep reads on the primary until the replica has had time to apply a write just committed.
+
+        Loader results are cached for every session, so this applies to the whole
+        process rather than only the session that wrote.
+        """
+        if cls.get_read_engine() is None:
+            return
+        with cls._routing_lock:
+            cls._primary_until = max(
+                cls._primary_until, monotonic() + cls.replica_max_lag()
+            )
+
+    @classmethod
+    def use_replica(cls) -> bool:
+        if cls.get_read_engine() is None:
+            return False
+        if monotonic() < cls._primary_until:
+            return False
+
+        return cls.replica_lag() <= cls.replica_max_lag()
+
+    @classmethod
+    @_memoised
+    def get_sessionmaker(cls, engine: Optional[Engine] = None) -> sessionmaker:
+        """Return a :class:`sqlalchemy.orm.session.sessionmaker` for sessions used off the script thread.
+
+        The session from :meth:`get_session` is shared by every rerun, so background
+        work, such as event subscribers, must open and close its own session instead.
+        """
+        if engine is None:
+            engine = cls.get_engine()
+
+        return sessionmaker(bind=engine, expire_on_commit=False)
+
+    @classmethod
+    @_memoised
     def get_session(cls, engine: Optional[Engine] = None) -> Session:
         """Return a :class:`sqlalchemy.orm.session.Session` object.
 
@@ -61,10 +355,51 @@ class Database:
         return maker()
 
 
+def for_update(_session: Session, query: Select, skip_locked: bool = False) -> Select:
+    """Return ``query`` locking the rows it selects until the transaction ends.
+
+    SQLite has no row locks, so there the transaction takes the database's write lock
+    instead, by starting a write that matches no rows. Other writers wait for it as
+    they would for the rows, while readers carry on under WAL. ``skip_locked`` has no
+    equivalent, so on SQLite a second claimant waits rather than skipping ahead.
+    """
+    if _session.get_bind().dialect.name != "sqlite":
+        return query.with_for_update(skip_locked=skip_locked)
+
+    _session.execute(delete(query.get_final_froms()[0]).where(false()))
+    return query
+
+
+def read_only(func):
+    """Run a loader on the read replica, when :meth:`Database.use_replica` allows it.
+
+    The loader's ``_session`` is swapped for a short-lived replica session. Loaders
+    called by a loader already on the replica reuse its session.
+    """
+    func_signature = signature(func)
+
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        bound = func_signature.bind(*args, **kwargs)
+        read_engine = Database.get_read_engine()
+        if read_engine is None or bound.arguments["_session"].get_bind() is read_engine:
+            return func(*args, **kwargs)
+        if not Database.use_replica():
+            return func(*args, **kwargs)
+
+        with Database.get_read_sessionmaker()() as session:
+            bound.arguments["_session"] = session
+            return func(*bound.args, **bound.kwargs)
+
+    return _wrapper
+
+
 def initialise() -> None:
-    from src.models import Claan, Record, Season, Task, User
+    from faker import Faker
+
+    from src.models import Claan, Job, Record, Season, Task, User
 
-    _tables = [Claan, Record, Season, Task, User]
+    _tables = [Claan, Job, Record, Season, Task, User]
     Base.metadata.create_all(bind=Database.get_engine())
 
     with Database.get_session() as session, session.begin():
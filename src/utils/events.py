@@ -0,0 +1,172 @@
+"""In-process domain event bus.
+
+Write paths publish an event once their transaction has committed, and side effects
+such as cache invalidation, session state refreshes and notifications subscribe to
+it. This keeps the write functions down to their business logic and the commit.
+
+Subscribers run either synchronously, on the publishing thread, or in the
+background on a shared thread pool. Synchronous subscribers run on Streamlit's script
+thread so may use ``st.session_state``. Background subscribers may not, and must
+open their own database session.
+
+Every event carries the tenant it was published for, and subscribers run for that
+tenant, so their queries and cache invalidations only touch its data.
+
+Subscriptions for the data layer are registered in :mod:`src.utils.data.subscribers`.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from src.models.claan import Claan
+from src.models.market.portfolio import BoardVote
+from src.models.market.transaction import Operation
+from src.models.tenant import TenantContext, current_tenant, use_tenant
+from src.utils.logger import LOGGER
+
+
+@dataclass(frozen=True)
+class Event:
+    timestamp: datetime = field(default_factory=datetime.now, kw_only=True)
+    tenant: TenantContext = field(default_factory=current_tenant, kw_only=True)
+
+
+@dataclass(frozen=True)
+class RecordSubmitted(Event):
+    record_id: int
+    user_id: int
+    claan: Claan
+    score: int
+
+
+@dataclass(frozen=True)
+class ShareTraded(Event):
+    portfolio_id: int
+    instrument_id: int
+    operation: Operation
+    price: float
+    # Claan of the trading portfolio, and of the company whose share was traded
+    portfolio_claan: Claan
+    instrument_claan: Claan
+
+
+@dataclass(frozen=True)
+class SharesIssued(Event):
+    instrument_id: int
+    claan: Claan
+    # Negative when unowned shares are deleted
+    amount: int
+
+
+@dataclass(frozen=True)
+class VoteChanged(Event):
+    portfolio_id: int
+    claan: Claan
+    vote: BoardVote
+
+
+@dataclass(frozen=True)
+class EscrowProcessed(Event):
+    fortnight: int
+    payouts: Tuple[Claan, ...]
+
+
+@dataclass(frozen=True)
+class CreditIssued(Event):
+    value: float
+    portfolios: int
+
+
+@dataclass(frozen=True)
+class PortfolioOpened(Event):
+    portfolio_id: int
+    user_id: int
+    claan: Claan
+
+
+@dataclass(frozen=True)
+class UsersChanged(Event):
+    # Whether portfolios, records or transactions were affected too, as by a delete or Claan change
+    cascade: bool = False
+
+
+@dataclass(frozen=True)
+class TasksChanged(Event):
+    # Whether records were affected too, as by a delete
+    cascade: bool = False
+
+
+@dataclass(frozen=True)
+class PricingChanged(Event):
+    # None for the season-wide curve
+    instrument_id: Optional[int] = None
+
+
+Handler = Callable[[Event], None]
+
+
+class EventBus:
+    def __init__(self, max_workers: int = 4):
+        self._sync: Dict[Type[Event], List[Handler]] = defaultdict(list)
+        self._background: Dict[Type[Event], List[Handler]] = defaultdict(list)
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = Lock()
+
+    def subscribe(
+        self,
+        event_type: Type[Event],
+        handler: Handler,
+        background: bool = False,
+    ) -> None:
+        """Call ``handler`` with every published event of ``event_type``, or a subclass of it.
+
+        :param background: Run the handler on the bus's thread pool instead of the publishing thread.
+        """
+        handlers = self._background if background else self._sync
+        with self._lock:
+            if handler not in handlers[event_type]:
+                handlers[event_type].append(handler)
+
+    def _handlers(self, handlers: Dict[Type[Event], List[Handler]], event: Event):
+        with self._lock:
+            return [
+                handler
+                for event_type in type(event).__mro__
+                for handler in handlers.get(event_type, [])
+            ]
+
+    def _run(self, handler: Handler, event: Event) -> None:
+        try:
+            with use_tenant(event.tenant):
+                handler(event)
+        except Exception:
+            LOGGER.exception(
+                f"Subscriber {handler.__qualname__} failed handling {type(event).__name__}"
+            )
+
+    def publish(self, event: Event) -> None:
+        """Run synchronous subscribers, then queue background subscribers.
+
+        Subscriber errors are logged, never raised, as the change they react to has
+        already been committed.
+        """
+        for handler in self._handlers(self._sync, event):
+            self._run(handler, event)
+
+        background = self._handlers(self._background, event)
+        if background:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self._max_workers, thread_name_prefix="events"
+                    )
+            for handler in background:
+                self._executor.submit(self._run, handler, event)
+
+
+BUS = EventBus()
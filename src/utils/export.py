@@ -0,0 +1,344 @@
+"""Streaming export of season history to CSV or Parquet.
+
+Records, transactions and portfolio snapshots are read with server-side cursors, a
+chunk of rows at a time, and each chunk is written before the next is fetched, so
+memory stays constant however many seasons are exported. Portfolio snapshots are
+taken from the market checkpoints, with a row per portfolio and instrument held.
+
+Available as a download on the admin page, and from the command line; run with
+``python -m src.utils.export --help`` for the available options.
+"""
+
+import argparse
+import csv
+import io
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from enum import Enum
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Date, Select, select
+from sqlalchemy.orm import Session
+
+from src.models.market.checkpoint import Checkpoint
+from src.models.market.transaction import Transaction
+from src.models.record import Record
+from src.models.season import Season
+from src.models.task import Task
+from src.models.user import User
+from src.utils.database import Database
+from src.utils.logger import LOGGER
+
+CHUNK_SIZE = 5000
+FORMATS = ("csv", "parquet")
+
+Chunk = Sequence[Tuple]
+
+
+class ExportError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Period:
+    """Half-open ``[start, end)`` range of a season, unbounded when ``None``."""
+
+    start: Optional[date] = None
+    end: Optional[date] = None
+
+    def where(self, query: Select, column) -> Select:
+        # Date columns compare against dates, as SQLite compares them as text
+        def bound(day: date) -> date | datetime:
+            return (
+                day
+                if isinstance(column.type, Date)
+                else datetime.combine(day, time.min)
+            )
+
+        if self.start is not None:
+            query = query.where(column >= bound(self.start))
+        if self.end is not None:
+            query = query.where(column < bound(self.end))
+        return query
+
+
+@dataclass(frozen=True)
+class Dataset:
+    # Column names and types, one of int, float, str, bool, date or datetime
+    columns: Tuple[Tuple[str, str], ...]
+    chunks: Callable[[Session, Period, int], Iterator[Chunk]]
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.columns]
+
+
+def get_period(_session: Session, season_id: Optional[int] = None) -> Period:
+    """The range of ``season_id``, up to the start of the next season, or all time if ``None``."""
+    if season_id is None:
+        return Period()
+
+    season = _session.get(Season, season_id)
+    if season is None:
+        raise ExportError(f"Season {season_id} doesn't exist")
+    next_start = _session.execute(
+        select(Season.start_date)
+        .where(Season.start_date > season.start_date)
+        .order_by(Season.start_date)
+        .limit(1)
+    ).scalar_one_or_none()
+
+    return Period(start=season.start_date, end=next_start)
+
+
+def stream(_session: Session, query: Select, chunk_size: int) -> Iterator[Chunk]:
+    """Yield ``query``'s rows ``chunk_size`` at a time, from a server-side cursor."""
+    result = _session.execute(query.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield [tuple(row) for row in partition]
+
+
+def record_chunks(
+    _session: Session, period: Period, chunk_size: int
+) -> Iterator[Chunk]:
+    query = (
+        select(
+            Record.id,
+            Record.timestamp,
+            Record.claan,
+            User.id,
+            User.name,
+            Task.id,
+            Task.description,
+            Record.score,
+            Record.escrow,
+        )
+        .join(User, Record.user_id == User.id)
+        .join(Task, Record.task_id == Task.id)
+        .order_by(Record.timestamp, Record.id)
+    )
+    yield from stream(_session, period.where(query, Record.timestamp), chunk_size)
+
+
+def transaction_chunks(
+    _session: Session, period: Period, chunk_size: int
+) -> Iterator[Chunk]:
+    query = select(
+        Transaction.id,
+        Transaction.timestamp,
+        Transaction.operation,
+        Transaction.value,
+        Transaction.instrument_id,
+        Transaction.portfolio_id,
+        Transaction.company_id,
+    ).order_by(Transaction.timestamp, Transaction.id)
+    yield from stream(_session, period.where(query, Transaction.timestamp), chunk_size)
+
+
+def snapshot_chunks(
+    _session: Session, period: Period, chunk_size: int
+) -> Iterator[Chunk]:
+    """Flatten checkpoints into a row per portfolio and instrument held.
+
+    Portfolios holding no shares get one row with no instrument, so their cash is kept.
+    """
+    query = select(Checkpoint).order_by(Checkpoint.timestamp, Checkpoint.id)
+    # Checkpoints hold the whole market, so are fetched a few at a time
+    result = _session.execute(
+        period.where(query, Checkpoint.timestamp).execution_options(yield_per=10)
+    ).scalars()
+
+    chunk = []
+    for checkpoint in result:
+        for portfolio_id, cash in checkpoint.portfolio_cash.items():
+            held = checkpoint.holdings.get(portfolio_id) or {None: 0}
+            for instrument_id, count in held.items():
+                chunk.append(
+                    (
+                        checkpoint.id,
+                        checkpoint.timestamp,
+                        checkpoint.fortnight,
+                        int(portfolio_id),
+                        cash,
+                        int(instrument_id) if instrument_id is not None else None,
+                        count,
+                        checkpoint.prices.get(instrument_id),
+                    )
+                )
+        # Checkpoints are only read once, so don't keep them in the identity map
+        _session.expunge(checkpoint)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+DATASETS: Dict[str, Dataset] = {
+    "records": Dataset(
+        columns=(
+            ("id", "int"),
+            ("timestamp", "date"),
+            ("claan", "str"),
+            ("user_id", "int"),
+            ("user", "str"),
+            ("task_id", "int"),
+            ("task", "str"),
+            ("score", "int"),
+            ("escrow", "bool"),
+        ),
+        chunks=record_chunks,
+    ),
+    "transactions": Dataset(
+        columns=(
+            ("id", "int"),
+            ("timestamp", "datetime"),
+            ("operation", "str"),
+            ("value", "float"),
+            ("instrument_id", "int"),
+            ("portfolio_id", "int"),
+            ("company_id", "int"),
+        ),
+        chunks=transaction_chunks,
+    ),
+    "portfolios": Dataset(
+        columns=(
+            ("checkpoint_id", "int"),
+            ("timestamp", "datetime"),
+            ("fortnight", "int"),
+            ("portfolio_id", "int"),
+            ("cash", "float"),
+            ("instrument_id", "int"),
+            ("shares", "int"),
+            ("price", "float"),
+        ),
+        chunks=snapshot_chunks,
+    ),
+}
+
+
+def _plain(value):
+    """Enums are exported by name."""
+    return value.name if isinstance(value, Enum) else value
+
+
+def write_csv(dataset: Dataset, chunks: Iterator[Chunk], file: IO[bytes]) -> int:
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(dataset.names)
+
+    rows = 0
+    for chunk in chunks:
+        writer.writerows([_plain(value) for value in row] for row in chunk)
+        rows += len(chunk)
+    # Leave ``file`` open for the caller
+    text.detach()
+
+    return rows
+
+
+def write_parquet(dataset: Dataset, chunks: Iterator[Chunk], file: IO[bytes]) -> int:
+    """Write each chunk as a row group of a single Parquet file."""
+    # Only needed for Parquet exports, and slow to import
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "str": pa.string(),
+        "bool": pa.bool_(),
+        "date": pa.date32(),
+        "datetime": pa.timestamp("us"),
+    }
+    schema = pa.schema([(name, types[type]) for name, type in dataset.columns])
+
+    rows = 0
+    with pq.ParquetWriter(file, schema) as writer:
+        for chunk in chunks:
+            columns = zip(*([_plain(value) for value in row] for row in chunk))
+            writer.write_batch(
+                pa.RecordBatch.from_arrays(
+                    [
+                        pa.array(column, type=type)
+                        for column, type in zip(columns, schema.types)
+                    ],
+                    schema=schema,
+                )
+            )
+            rows += len(chunk)
+
+    return rows
+
+
+WRITERS = {"csv": write_csv, "parquet": write_parquet}
+
+
+def export(
+    _session: Session,
+    dataset: str,
+    format: str,
+    file: IO[bytes],
+    season_id: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """Stream ``dataset`` for ``season_id``, or every season, to ``file``. Returns the row count."""
+    if dataset not in DATASETS:
+        raise ExportError(
+            f"Unknown dataset `{dataset}`, expected one of {list(DATASETS)}"
+        )
+    if format not in WRITERS:
+        raise ExportError(f"Unknown format `{format}`, expected one of {FORMATS}")
+
+    period = get_period(_session, season_id)
+    spec = DATASETS[dataset]
+    rows = WRITERS[format](spec, spec.chunks(_session, period, chunk_size), file)
+    LOGGER.info(f"Exported {rows} {dataset} rows as {format}")
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export season history to CSV or Parquet files."
+    )
+    parser.add_argument(
+        "datasets",
+        nargs="*",
+        default=list(DATASETS),
+        help=f"Datasets to export, of {', '.join(DATASETS)}. All of them by default.",
+    )
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument(
+        "--season", type=int, default=None, help="Season id, every season by default."
+    )
+    parser.add_argument(
+        "--output", type=Path, default=Path("."), help="Directory to write to."
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    unknown = set(args.datasets) - set(DATASETS)
+    if unknown:
+        parser.error(f"unknown datasets {', '.join(sorted(unknown))}")
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    suffix = f"_s{args.season}" if args.season is not None else ""
+    sessionmaker = Database.get_read_sessionmaker() or Database.get_sessionmaker()
+    with sessionmaker() as session:
+        for dataset in args.datasets:
+            path = args.output / f"{dataset}{suffix}.{args.format}"
+            with path.open("wb") as file:
+                export(
+                    session,
+                    dataset,
+                    args.format,
+                    file,
+                    season_id=args.season,
+                    chunk_size=args.chunk_size,
+                )
+            LOGGER.info(f"Wrote `{path}`")
+
+
+if __name__ == "__main__":
+    main()
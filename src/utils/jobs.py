@@ -0,0 +1,497 @@
+"""Background jobs for fortnight close and heavy admin actions.
+
+The admin page queues a :class:`~src.models.job.Job` instead of running escrow, credit,
+initialisation or the stock game bootstrap in its own button callback. A separate
+worker process, started with ``python -m src.utils.jobs``, claims and runs them.
+
+Workers claim jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``, so several can poll the
+same table without claiming the same job, and hold a Postgres advisory lock per job
+type while it runs, so no two jobs of one type run at once. On SQLite claims are
+serialised by the database write lock instead, but there are no advisory locks, so
+only run one worker.
+
+A failed job goes back to pending, with a backoff, until it has used its attempts.
+The worker also queues each fortnight's escrow to run at the fortnight's end, keyed by
+fortnight so a manual run from the admin page and the scheduled one can't both run.
+
+One worker serves every tenant. It claims jobs of all tenants, runs each for its own
+tenant, and schedules the fortnight close of every tenant with a season.
+"""
+
+import argparse
+import os
+import socket
+import threading
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime, time, timedelta
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Connection, func, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from src.models.claan import Claan
+from src.models.job import Job, JobStatus, JobType
+from src.models.tenant import Tenant, current_tenant, use_tenant
+from src.utils.database import Database, for_update, initialise
+from src.utils.events import (
+    BUS,
+    CreditIssued,
+    EscrowProcessed,
+    Event,
+    TasksChanged,
+    UsersChanged,
+)
+from src.utils.logger import LOGGER
+from src.utils.tenancy import get_tenants, to_context
+
+# First key of the two-key advisory locks, the second being the job type
+ADVISORY_LOCK_NAMESPACE = 7406
+# Pending jobs looked at per claim, in case the oldest are of a type already running
+CLAIM_BATCH = 10
+RETRY_BACKOFF = timedelta(seconds=30)
+# Running jobs with no heartbeat for this long are assumed to belong to a dead worker
+STALE_AFTER = timedelta(minutes=15)
+# Seconds between the worker's heartbeats for the job it's running
+HEARTBEAT_INTERVAL = 60.0
+POLL_INTERVAL = 5.0
+# How often the app checks for jobs finished since it last looked
+SYNC_INTERVAL = 10.0
+
+
+@dataclass
+class JobContext:
+    """Passed to a job handler to report progress on its job's row.
+
+    Progress is written in a session of its own and committed straight away, so the
+    admin page can show it while the handler's own transaction is still open.
+    ``state`` is saved with progress, and is how a retried job knows what its failed
+    attempt had already committed.
+    """
+
+    job_id: int
+    params: Dict[str, Any]
+    state: Dict[str, Any]
+    sessions: sessionmaker = field(repr=False)
+
+    def report(self, done: int, total: int, message: Optional[str] = None) -> None:
+        progress = done / total if total else 1.0
+        LOGGER.info(f"Job {self.job_id}: {progress:.0%} {message or ''}")
+        with self.sessions() as session:
+            session.execute(
+                update(Job)
+                .where(Job.id == self.job_id)
+                .values(
+                    progress=progress,
+                    message=message,
+                    heartbeat=datetime.now(),
+                    params={**self.params, "state": self.state},
+                )
+            )
+            session.commit()
+
+
+# Handlers get the worker's session and their job's context, and return the job's result
+Handler = Callable[[Session, JobContext], Optional[Dict[str, Any]]]
+
+
+def _process_escrow(_session: Session, context: JobContext) -> Dict[str, Any]:
+    from src.utils.data.stocks import process_escrow
+
+    processed = context.state.setdefault("processed", [])
+    payouts = context.state.setdefault("payouts", [])
+
+    def on_company(claan: Claan, done: int, total: int) -> None:
+        processed.append(claan.name)
+        # One more step for the checkpoint
+        context.report(done, total + 1, f"Processed {claan.value}")
+
+    payouts += [
+        claan.name
+        for claan in process_escrow(
+            _session,
+            fortnight=context.params.get("fortnight"),
+            skip={Claan[name] for name in processed},
+            on_company=on_company,
+        )
+    ]
+
+    return {"fortnight": context.params.get("fortnight"), "payouts": payouts}
+
+
+def _issue_credit(_session: Session, context: JobContext) -> Dict[str, Any]:
+    from src.models.market.portfolio import Portfolio
+    from src.utils.data.stocks import issue_credit
+
+    issue_credit(_session, value=context.params["value"])
+
+    return {
+        "value": context.params["value"],
+        "portfolios": _session.scalar(select(func.count(Portfolio.id))),
+    }
+
+
+def _initialise(_session: Session, context: JobContext) -> None:
+    initialise()
+
+
+def _stock_game(_session: Session, context: JobContext) -> None:
+    from src.utils.stock_game import main
+
+    main()
+
+
+HANDLERS: Dict[JobType, Handler] = {
+    JobType.PROCESS_ESCROW: _process_escrow,
+    JobType.ISSUE_CREDIT: _issue_credit,
+    JobType.INITIALISE: _initialise,
+    JobType.STOCK_GAME: _stock_game,
+}
+
+
+def enqueue(
+    _session: Session,
+    type: JobType,
+    params: Optional[Dict[str, Any]] = None,
+    run_after: Optional[datetime] = None,
+    key: Optional[str] = None,
+) -> Job:
+    """Queue a job, returning it.
+
+    If a job with ``key`` already exists, it's returned instead of queueing another.
+    A pending one is brought forward to ``run_after``. A failed one is left failed, to
+    be retried with :func:`retry` once its error has been looked at.
+    """
+    if key is not None:
+        existing = _session.execute(
+            select(Job).where(Job.key == key)
+        ).scalar_one_or_none()
+        if existing is not None:
+            if existing.status == JobStatus.PENDING:
+                existing.run_after = min(
+                    existing.run_after, run_after or datetime.now()
+                )
+                _session.commit()
+            return existing
+
+    job = Job(type=type, params=params, run_after=run_after, key=key)
+    _session.add(job)
+    try:
+        _session.commit()
+    except IntegrityError:
+        # Queued by someone else since the check above
+        _session.rollback()
+        return _session.execute(select(Job).where(Job.key == key)).scalar_one()
+
+    LOGGER.info(f"Queued {job} to run after {job.run_after}")
+    return job
+
+
+def retry(_session: Session, job_id: int) -> None:
+    """Put a failed job back to pending, with all its attempts again."""
+    _session.execute(
+        update(Job)
+        .where(Job.id == job_id)
+        .where(Job.status == JobStatus.FAILED)
+        .values(
+            status=JobStatus.PENDING,
+            attempts=0,
+            run_after=datetime.now(),
+            finished=None,
+        )
+    )
+    _session.commit()
+
+
+def get_jobs(_session: Session, limit: int = 20) -> List[Job]:
+    """Return the most recently queued jobs, newest first."""
+    query = select(Job).order_by(Job.created.desc(), Job.id.desc()).limit(limit)
+    return list(_session.execute(query).scalars().all())
+
+
+def escrow_key(fortnight: int) -> str:
+    return f"process_escrow:{fortnight}"
+
+
+def credit_key(fortnight: int, value: float) -> str:
+    """Key of a credit of ``value`` in ``fortnight``, so a repeated click doesn't pay twice."""
+    return f"issue_credit:{fortnight}:{value:.2f}"
+
+
+def schedule_fortnight_close(_session: Session) -> Optional[Job]:
+    """Queue the current fortnight's escrow to run when the fortnight ends.
+
+    Returns ``None`` without queueing anything if the tenant has no season yet.
+    """
+    from src.utils.data.seasons import get_fortnight_info, get_season_start
+
+    if get_season_start(_session=_session) is None:
+        return None
+
+    info = get_fortnight_info(_session=_session)
+    return enqueue(
+        _session,
+        JobType.PROCESS_ESCROW,
+        params={"fortnight": info["fortnight_number"]},
+        run_after=datetime.combine(info["end_date"], time.min),
+        key=escrow_key(info["fortnight_number"]),
+    )
+
+
+def _job_events(job: Job) -> List[Event]:
+    """Events for the app to publish for a job run by the worker."""
+    result = job.result or {}
+    match job.type:
+        case JobType.PROCESS_ESCROW:
+            return [
+                EscrowProcessed(
+                    fortnight=result.get("fortnight"),
+                    payouts=tuple(Claan[name] for name in result.get("payouts", [])),
+                )
+            ]
+        case JobType.ISSUE_CREDIT:
+            return [
+                CreditIssued(
+                    value=result.get("value", 0.0),
+                    portfolios=result.get("portfolios", 0),
+                )
+            ]
+        case JobType.INITIALISE:
+            return [UsersChanged(), TasksChanged()]
+        case JobType.STOCK_GAME:
+            return [UsersChanged(cascade=True)]
+    return []
+
+
+# By tenant, as each tenant's pages only see its own jobs
+_last_sync: Dict[int, Dict[str, Any]] = {}
+
+
+def sync_jobs(_session: Session) -> None:
+    """Publish the events of jobs the worker finished since the app last looked.
+
+    The worker publishes events in its own process, so the app's caches and session
+    state only learn of a job's changes through here. Called on every page run, but
+    only queries every :data:`SYNC_INTERVAL` seconds.
+    """
+    last_sync = _last_sync.setdefault(
+        current_tenant().id, {"checked": 0.0, "finished": None}
+    )
+    if monotonic() - last_sync["checked"] < SYNC_INTERVAL:
+        return
+    last_sync["checked"] = monotonic()
+
+    if last_sync["finished"] is None:
+        # Jobs finished before the app started are already reflected in what it loads
+        last_sync["finished"] = datetime.now()
+        return
+
+    query = (
+        select(Job)
+        .where(Job.status == JobStatus.SUCCEEDED)
+        .where(Job.finished > last_sync["finished"])
+        .order_by(Job.finished)
+    )
+    for job in _session.execute(query).scalars():
+        last_sync["finished"] = job.finished
+        for event in _job_events(job):
+            BUS.publish(event)
+
+
+class Worker:
+    def __init__(self, engine: Engine, name: Optional[str] = None):
+        self.engine = engine
+        self.sessions = sessionmaker(bind=engine, expire_on_commit=False)
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.postgres = engine.dialect.name == "postgresql"
+        # Advisory locks are held by a connection, so the worker keeps one for them
+        self._lock_connection: Optional[Connection] = (
+            engine.connect() if self.postgres else None
+        )
+
+    def _try_lock(self, type: JobType) -> bool:
+        if self._lock_connection is None:
+            return True
+        locked = self._lock_connection.scalar(
+            select(func.pg_try_advisory_lock(ADVISORY_LOCK_NAMESPACE, type.value))
+        )
+        self._lock_connection.commit()
+        return bool(locked)
+
+    def _unlock(self, type: JobType) -> None:
+        if self._lock_connection is None:
+            return
+        self._lock_connection.scalar(
+            select(func.pg_advisory_unlock(ADVISORY_LOCK_NAMESPACE, type.value))
+        )
+        self._lock_connection.commit()
+
+    def recover_stale(self, _session: Session) -> None:
+        """Put running jobs with no recent heartbeat back to pending."""
+        result = _session.execute(
+            update(Job)
+            .where(Job.status == JobStatus.RUNNING)
+            .where(Job.heartbeat < datetime.now() - STALE_AFTER)
+            .values(status=JobStatus.PENDING, error="Worker stopped responding")
+            .execution_options(all_tenants=True)
+        )
+        _session.commit()
+        if result.rowcount:
+            LOGGER.warning(f"Requeued {result.rowcount} stale jobs")
+
+    def claim(self, _session: Session) -> Optional[Job]:
+        """Claim the oldest due job whose type isn't already running elsewhere."""
+        query = (
+            select(Job)
+            .where(Job.status == JobStatus.PENDING)
+            .where(Job.run_after <= datetime.now())
+            .order_by(Job.run_after, Job.id)
+            .limit(CLAIM_BATCH)
+            .execution_options(all_tenants=True)
+        )
+        query = for_update(_session, query, skip_locked=True)
+        for job in _session.execute(query).scalars().all():
+            if not self._try_lock(job.type):
+                continue
+
+            now = datetime.now()
+            job.status = JobStatus.RUNNING
+            job.attempts += 1
+            job.started = now
+            job.heartbeat = now
+            job.error = None
+            _session.commit()
+            LOGGER.info(f"{self.name} claimed {job}, attempt {job.attempts}")
+            return job
+
+        _session.rollback()
+        return None
+
+    def run(self, job: Job) -> None:
+        with self.sessions() as session:
+            tenant = to_context(session.get(Tenant, job.tenant_id))
+        with use_tenant(tenant):
+            self._run(job)
+
+    def _heartbeat(self, job_id: int, stop: threading.Event) -> None:
+        """Keep a running job's heartbeat fresh, for handlers that don't report progress."""
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                with self.sessions() as session:
+                    session.execute(
+                        update(Job)
+                        .where(Job.id == job_id)
+                        .where(Job.status == JobStatus.RUNNING)
+                        .values(heartbeat=datetime.now())
+                        .execution_options(all_tenants=True)
+                    )
+                    session.commit()
+            except Exception:
+                LOGGER.exception(f"Heartbeat for job {job_id} failed")
+
+    def _run(self, job: Job) -> None:
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(job.id, stop),
+            name=f"heartbeat-{job.id}",
+            daemon=True,
+        )
+        heartbeat.start()
+        context = JobContext(
+            job_id=job.id,
+            params=job.params,
+            state=dict(job.params.get("state", {})),
+            sessions=self.sessions,
+        )
+        try:
+            with LOGGER.contextualize(correlation_id=f"job-{job.id}"):
+                with self.sessions() as session:
+                    result = HANDLERS[job.type](session, context)
+        except Exception:
+            LOGGER.exception(f"{job} failed")
+            self._fail(job, traceback.format_exc())
+        else:
+            self._finish(job, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+            self._unlock(job.type)
+
+    def _finish(self, job: Job, result: Optional[Dict[str, Any]]) -> None:
+        with self.sessions() as session:
+            session.execute(
+                update(Job)
+                .where(Job.id == job.id)
+                .values(
+                    status=JobStatus.SUCCEEDED,
+                    progress=1.0,
+                    result=result,
+                    finished=datetime.now(),
+                )
+            )
+            session.commit()
+        LOGGER.info(f"Job {job.id} ({job.type.name}) succeeded")
+
+    def _fail(self, job: Job, error: str) -> None:
+        values = {"error": error, "heartbeat": datetime.now()}
+        if job.attempts < job.max_attempts:
+            values |= {
+                "status": JobStatus.PENDING,
+                "run_after": datetime.now() + RETRY_BACKOFF * 2 ** (job.attempts - 1),
+            }
+        else:
+            values |= {"status": JobStatus.FAILED, "finished": datetime.now()}
+
+        with self.sessions() as session:
+            session.execute(update(Job).where(Job.id == job.id).values(**values))
+            session.commit()
+
+    def run_once(self) -> bool:
+        """Schedule the fortnight closes, then claim and run one job. Returns whether a job ran."""
+        with self.sessions() as session:
+            for tenant in get_tenants(session):
+                with use_tenant(tenant):
+                    schedule_fortnight_close(session)
+            self.recover_stale(session)
+            job = self.claim(session)
+
+        if job is None:
+            return False
+
+        self.run(job)
+        return True
+
+    def run_forever(self, poll_interval: float = POLL_INTERVAL) -> None:
+        LOGGER.info(f"Worker {self.name} started")
+        while True:
+            if not self.run_once():
+                sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued Claan jobs.")
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Run due jobs, then exit when none are left.",
+    )
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    engine = Database.get_engine()
+    Job.__table__.create(bind=engine, checkfirst=True)
+    worker = Worker(engine)
+
+    if args.once:
+        while worker.run_once():
+            pass
+    else:
+        worker.run_forever(poll_interval=args.poll)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""Load test of the trade, submission and vote paths under concurrent use.
+
+Seeds a synthetic roster, then has worker processes call :func:`buy_share`,
+:func:`sell_share`, :func:`submit_record` and :func:`update_vote` for it at once, as
+happens in the rush before a fortnight closes. Each member acts at random times, at
+a rate rising through the run, and workers retry calls that fail on a deadlock or
+lock timeout, as a user pressing the button again would.
+
+Reports throughput and latency percentiles per operation, rejections, errors,
+deadlocks and retries, and checks the market invariants afterwards: cash
+reconciles and is never negative, no share is sold twice, and no holding is over
+the limit. Results are saved as JSON, and ``--compare`` reports the change from an
+earlier run, such as the last release's.
+
+Workers are processes rather than threads, as Streamlit's session state, which the
+submission and vote paths read, is shared by every thread outside a running app.
+
+Run with ``python -m src.utils.load_test --help`` for the available options.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import subprocess
+import sys
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, time
+from typing import Dict, List, Optional, Tuple
+
+import email_validator
+import numpy as np
+from sqlalchemy import create_engine, func, select, update
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session
+
+from src.models.base import Base
+from src.models.claan import Claan
+from src.models.market.instrument import Instrument
+from src.models.market.portfolio import BoardVote, Portfolio
+from src.models.market.share import Share
+from src.models.market.transaction import Operation, Transaction
+from src.models.task import Task
+from src.models.user import User
+from src.utils.data.scores import submit_record
+from src.utils.data.stocks import (
+    buy_share,
+    get_portfolio,
+    issue_credit,
+    sell_share,
+    update_vote,
+)
+from src.utils.data.tasks import get_active_tasks
+from src.utils.database import Database, create_sqlite_engine, initialise
+from src.utils.logger import LOGGER
+from src.utils.synthetic_season import check, seed_season
+
+OPERATIONS = ("buy", "sell", "submit", "vote")
+# Share of calls made to each operation
+DEFAULT_MIX = {"buy": 0.4, "sell": 0.2, "submit": 0.3, "vote": 0.1}
+# Error messages of a failed attempt that's worth retrying
+RETRYABLE = ("deadlock detected", "database is locked", "could not serialize")
+DEADLOCK = "deadlock detected"
+# Seconds before the first retry, doubling with each one
+BACKOFF = 0.05
+
+# Seconds until the call is due, operation, user id and the id of its target
+Call = Tuple[float, str, int, Optional[int]]
+
+
+@dataclass
+class Sample:
+    operation: str
+    # Milliseconds, including retries
+    latency: float
+    # ok, rejected or the error's type
+    outcome: str
+    retries: int
+    deadlocks: int
+
+
+def schedule(
+    _session: Session,
+    rng: np.random.Generator,
+    claans: List[Claan],
+    duration: float,
+    rate: float,
+    mix: Dict[str, float],
+) -> List[Call]:
+    """Calls by every member of ``claans``, arriving ``rate`` times a second each on average.
+
+    Arrivals are a Poisson process whose rate rises linearly from a fifth of ``rate``
+    to nine fifths, like the rush towards a fortnight's close.
+    """
+    users = _session.execute(select(User.id).where(User.claan.in_(claans))).scalars()
+    instrument_ids = _session.execute(select(Instrument.id)).scalars().all()
+    task_ids = [task.id for task in get_active_tasks(_session=_session)]
+    operations = list(mix)
+    weights = np.array(list(mix.values())) / sum(mix.values())
+
+    calls = []
+    peak = 1.8 * rate
+    for user_id in users:
+        # Thinning: draw at the peak rate, and keep each with the rate at its time
+        times = np.cumsum(rng.exponential(1 / peak, size=int(peak * duration * 2) + 1))
+        times = times[times < duration]
+        rates = rate * (0.2 + 1.6 * times / duration)
+        times = times[rng.random(len(times)) < rates / peak]
+        for due in times:
+            operation = operations[rng.choice(len(operations), p=weights)]
+            match operation:
+                case "buy" | "sell":
+                    target = int(rng.choice(instrument_ids))
+                case "submit":
+                    target = int(rng.choice(task_ids))
+                case "vote":
+                    target = int(rng.integers(len(BoardVote)))
+            calls.append((float(due), operation, user_id, target))
+
+    return sorted(calls)
+
+
+def _call(_session: Session, operation: str, user_id: int, target: int) -> bool:
+    """Make one call the way its page does. Returns whether it was accepted."""
+    import streamlit as st
+
+    match operation:
+        case "buy" | "sell":
+            portfolio = get_portfolio(_session, user_id=user_id)
+            trade = buy_share if operation == "buy" else sell_share
+            return trade(_session, portfolio.id, target)
+        case "submit":
+            st.session_state["task_user"] = _session.get(User, user_id)
+            st.session_state["task_selection"] = next(
+                task
+                for task in get_active_tasks(_session=_session)
+                if task.id == target
+            )
+            return submit_record(_session) is not None
+        case "vote":
+            portfolio = get_portfolio(_session, user_id=user_id)
+            claan = _session.get(User, user_id).claan
+            st.session_state["portfolio_vote"] = list(BoardVote)[target]
+            update_vote(_session, portfolio, claan)
+            return True
+
+
+def worker(
+    url: str,
+    calls: List[Call],
+    start: float,
+    retries: int,
+    results: "multiprocessing.Queue",
+) -> None:
+    """Make ``calls``, each when due after ``start``, and put their samples on ``results``."""
+    _quiet()
+    LOGGER.remove()
+    Database.use_engine(_engine(url))
+
+    samples = []
+    with Database.get_sessionmaker()() as session:
+        for due, operation, user_id, target in calls:
+            delay = start + due - time()
+            if delay > 0:
+                sleep(delay)
+
+            sample = Sample(operation, 0.0, "ok", 0, 0)
+            began = perf_counter()
+            while True:
+                try:
+                    if not _call(session, operation, user_id, target):
+                        sample.outcome = "rejected"
+                    break
+                except (OperationalError, DBAPIError) as e:
+                    session.rollback()
+                    message = str(e.orig).lower()
+                    sample.deadlocks += DEADLOCK in message
+                    if sample.retries < retries and any(
+                        error in message for error in RETRYABLE
+                    ):
+                        sample.retries += 1
+                        sleep(BACKOFF * 2**sample.retries)
+                        continue
+                    sample.outcome = type(e.orig).__name__
+                    break
+                except Exception as e:
+                    session.rollback()
+                    sample.outcome = type(e).__name__
+                    break
+            sample.latency = (perf_counter() - began) * 1000
+            samples.append(sample)
+
+    results.put([asdict(sample) for sample in samples])
+
+
+def _quiet() -> None:
+    """Silence Streamlit's warnings about running outside an app, once per call made."""
+    import streamlit  # noqa: F401
+
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+
+def _engine(url: str):
+    if url.startswith("sqlite"):
+        return create_sqlite_engine(url.removeprefix("sqlite:///"))
+    return create_engine(url, pool_size=2)
+
+
+def invariants(
+    _session: Session, owned_before: Dict[int, int], since: datetime
+) -> List[str]:
+    """Return a description of each market invariant the run broke."""
+    failures = check(_session)
+
+    overdrawn = (
+        _session.execute(select(Portfolio.id).where(Portfolio.cash < 0)).scalars().all()
+    )
+    if overdrawn:
+        failures.append(f"Portfolios {overdrawn} have negative cash")
+
+    # Each share changes hands once per trade, so holdings move by buys less sells
+    owned = dict(
+        _session.execute(
+            select(Share.instrument_id, func.count(Share.owner_id)).group_by(
+                Share.instrument_id
+            )
+        ).all()
+    )
+    trades = defaultdict(int)
+    for instrument_id, operation, count in _session.execute(
+        select(Transaction.instrument_id, Transaction.operation, func.count())
+        .where(Transaction.timestamp >= since)
+        .where(Transaction.operation.in_([Operation.BUY, Operation.SELL]))
+        .group_by(Transaction.instrument_id, Transaction.operation)
+    ):
+        trades[instrument_id] += count if operation == Operation.BUY else -count
+    oversold = [
+        instrument_id
+        for instrument_id in owned
+        if owned[instrument_id] - owned_before.get(instrument_id, 0)
+        != trades[instrument_id]
+    ]
+    if oversold:
+        failures.append(f"Holdings of instruments {oversold} don't match their trades")
+
+    return failures
+
+
+def summarise(samples: List[Sample], elapsed: float) -> Dict[str, Dict[str, float]]:
+    summary = {}
+    for operation in OPERATIONS:
+        made = [sample for sample in samples if sample.operation == operation]
+        if not made:
+            continue
+        latencies = np.array([sample.latency for sample in made])
+        outcomes = defaultdict(int)
+        for sample in made:
+            outcomes[sample.outcome] += 1
+        summary[operation] = {
+            "calls": len(made),
+            "throughput": round(len(made) / elapsed, 2),
+            "p50": round(float(np.percentile(latencies, 50)), 2),
+            "p90": round(float(np.percentile(latencies, 90)), 2),
+            "p99": round(float(np.percentile(latencies, 99)), 2),
+            "max": round(float(latencies.max()), 2),
+            "retries": sum(sample.retries for sample in made),
+            "deadlocks": sum(sample.deadlocks for sample in made),
+            "outcomes": dict(outcomes),
+        }
+
+    return summary
+
+
+def compare(current: dict, previous: dict) -> None:
+    """Print the change in throughput and latency from an earlier result."""
+    print(f"Compared with {previous['version']} at {previous['started']}:")
+    for operation, stats in current["operations"].items():
+        before = previous["operations"].get(operation)
+        if before is None:
+            continue
+        changes = ", ".join(
+            f"{metric} {before[metric]} -> {stats[metric]}"
+            for metric in ("throughput", "p50", "p99", "deadlocks")
+        )
+        print(f"  {operation}: {changes}")
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--tags", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the trade, submission and vote paths with concurrent workers."
+    )
+    parser.add_argument(
+        "--url",
+        default=None,
+        help="Database to test against, which is seeded first. A temporary SQLite file by default.",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="Worker processes.")
+    parser.add_argument("--members", type=int, default=10, help="Members per Claan.")
+    parser.add_argument(
+        "--claan",
+        choices=[claan.name for claan in Claan],
+        action="append",
+        help="Only load members of this Claan, may be repeated. Every Claan by default.",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30.0, help="Seconds to run for."
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0.2, help="Mean calls per member per second."
+    )
+    for operation, share in DEFAULT_MIX.items():
+        parser.add_argument(
+            f"--{operation}",
+            type=float,
+            default=share,
+            help=f"Relative share of {operation} calls, {share} by default.",
+        )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Retries after a deadlock or lock timeout.",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--output", type=Path, default=Path("load_tests"), help="Directory for results."
+    )
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="Earlier result to compare with."
+    )
+    args = parser.parse_args()
+
+    _quiet()
+    email_validator.CHECK_DELIVERABILITY = False
+    directory = TemporaryDirectory(prefix="claans-")
+    url = args.url or f"sqlite:///{Path(directory.name) / 'load.db'}"
+    Database.use_engine(_engine(url))
+    rng = np.random.default_rng(args.seed)
+    claans = [Claan[name] for name in args.claan] if args.claan else list(Claan)
+    mix = {operation: getattr(args, operation) for operation in OPERATIONS}
+
+    from src.utils import stock_game
+
+    Base.metadata.create_all(bind=Database.get_engine())
+    with Database.get_sessionmaker()() as session:
+        seed_season(session, members=args.members, fortnights=1)
+        initialise()
+        stock_game.main()
+        # Members submit any task, as they would over a season's rotation
+        session.execute(update(Task).values(active=True))
+        session.commit()
+        issue_credit(session, value=50.0)
+        calls = schedule(session, rng, claans, args.duration, args.rate, mix)
+        owned_before = dict(
+            session.execute(
+                select(Share.instrument_id, func.count(Share.owner_id)).group_by(
+                    Share.instrument_id
+                )
+            ).all()
+        )
+    # Workers open their own connections
+    Database.get_engine().dispose()
+    LOGGER.info(f"Scheduled {len(calls)} calls over {args.duration}s")
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    started = datetime.now()
+    # Leave time for the workers to import the app before the first call is due
+    start = time() + 5.0
+    processes = [
+        context.Process(
+            target=worker,
+            args=(url, calls[index :: args.workers], start, args.retries, results),
+        )
+        for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    samples = [Sample(**sample) for _ in processes for sample in results.get()]
+    for process in processes:
+        process.join()
+    elapsed = max(time() - start, args.duration)
+
+    with Database.get_sessionmaker()() as session:
+        failures = invariants(session, owned_before, since=started)
+    Database.get_engine().dispose()
+    directory.cleanup()
+
+    result = {
+        "version": _version(),
+        "started": started.isoformat(timespec="seconds"),
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "url")
+        },
+        "dialect": url.split(":", 1)[0],
+        "elapsed": round(elapsed, 2),
+        "operations": summarise(samples, elapsed),
+        "failures": failures,
+    }
+    args.output.mkdir(parents=True, exist_ok=True)
+    path = args.output / f"{started:%Y%m%d-%H%M%S}_{result['version']}.json"
+    path.write_text(json.dumps(result, indent=2))
+
+    print(
+        f"{'operation':<8} {'calls':>6} {'/s':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'retries':>8} {'deadlocks':>9}"
+    )
+    for operation, stats in result["operations"].items():
+        print(
+            f"{operation:<8} {stats['calls']:>6} {stats['throughput']:>7} {stats['p50']:>8} "
+            f"{stats['p90']:>8} {stats['p99']:>8} {stats['retries']:>8} {stats['deadlocks']:>9}"
+            f"  {stats['outcomes']}"
+        )
+    LOGGER.info(f"Saved results to `{path}`")
+    if args.compare:
+        compare(result, json.loads(args.compare.read_text()))
+
+    for failure in failures:
+        LOGGER.error(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,168 @@
+"""Logging configuration.
+
+Records are written to stderr from a background thread, with ``enqueue``, so the page
+never waits on the write. Configured from the optional ``[logging]`` table of the
+secrets file, for example::
+
+    [logging]
+    level = "INFO"
+    json = true
+    # Minimum level by module, in place of ``level``
+    levels = { "src.utils.data.stocks" = "DEBUG" }
+    # Fraction of records below WARNING kept, by module
+    sampling = { "src.utils.data.subscribers" = 0.1 }
+
+Modules match their submodules too, the most specific entry winning. Every record
+carries a ``correlation_id``: that of the page rerun which logged it, or of the
+rerun that rendered the widget whose callback logged it, so a click can be traced to
+what it did. Records logged outside a page, such as by jobs, have none unless their
+caller sets one with ``LOGGER.contextualize``.
+
+Messages on hot paths are formatted lazily, with ``{}`` placeholders rather than
+f-strings, so debug messages cost nothing unless some module logs at debug.
+"""
+
+import json
+import tomllib
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import random
 from sys import stderr
+from typing import Dict, TypeVar
+from uuid import uuid4
 
+import streamlit as st
 from loguru import logger
 
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "{extra[correlation_id]} | <cyan>{name}</cyan>:<cyan>{function}</cyan>:"
+    "<cyan>{line}</cyan> - <level>{message}</level>"
+)
+# Where Streamlit reads secrets from by default, later files taking precedence
+SECRETS_FILES = (
+    Path.home() / ".streamlit" / "secrets.toml",
+    Path(".streamlit") / "secrets.toml",
+)
+# Records at or above this level are never sampled out
+SAMPLING_FLOOR = "WARNING"
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class LogConfig:
+    level: str = "INFO"
+    json: bool = False
+    enqueue: bool = True
+    levels: Dict[str, str] = field(default_factory=dict)
+    sampling: Dict[str, float] = field(default_factory=dict)
+
+
+def load_secrets_table(name: str) -> dict:
+    """The ``[name]`` table of the secrets files, empty without one.
+
+    Read from the files directly rather than ``st.secrets``, which watches them for
+    changes, as that takes longer to set up than the rest of the import.
+    """
+    table = {}
+    for path in SECRETS_FILES:
+        if path.exists():
+            with path.open("rb") as file:
+                table.update(tomllib.load(file).get(name, {}))
+
+    return table
+
+
+def get_log_config() -> LogConfig:
+    """The ``[logging]`` table of the secrets, or the defaults without one."""
+    secrets = load_secrets_table("logging")
+
+    return LogConfig(
+        level=secrets.get("level", LogConfig.level),
+        json=secrets.get("json", LogConfig.json),
+        enqueue=secrets.get("enqueue", LogConfig.enqueue),
+        levels=dict(secrets.get("levels", {})),
+        sampling=dict(secrets.get("sampling", {})),
+    )
+
+
+def lookup(name: str, table: Dict[str, T], default: T) -> T:
+    """The entry of ``table`` for module ``name`` or its closest parent package."""
+    while name:
+        if name in table:
+            return table[name]
+        name = name.rpartition(".")[0]
+
+    return default
+
+
+def new_correlation_id() -> None:
+    """Start a new correlation id for records of this session, at the top of each rerun."""
+    st.session_state["correlation_id"] = uuid4().hex[:12]
+
+
+def get_correlation_id() -> str:
+    """The correlation id of this session's current rerun, or ``-`` outside a page."""
+    # Imported here as it's internal to Streamlit, and only read once logging starts
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return "-"
+    return st.session_state.get("correlation_id", "-")
+
+
+def _add_correlation_id(record) -> None:
+    record["extra"].setdefault("correlation_id", get_correlation_id())
+
+
+def _serialise(record) -> str:
+    """Format a record as one line of JSON."""
+    record["extra"]["json"] = json.dumps(
+        {
+            "time": record["time"].isoformat(),
+            "level": record["level"].name,
+            "module": record["name"],
+            "function": record["function"],
+            "line": record["line"],
+            "message": record["message"],
+            **{key: value for key, value in record["extra"].items() if key != "json"},
+            "exception": (
+                None
+                if record["exception"] is None
+                else "".join(traceback.format_exception(*record["exception"]))
+            ),
+        },
+        default=str,
+    )
+    return "{extra[json]}\n"
+
 
 def create_logger():
+    config = get_log_config()
+    levels = {module: logger.level(level).no for module, level in config.levels.items()}
+    default_level = logger.level(config.level).no
+    sampling_floor = logger.level(SAMPLING_FLOOR).no
+
+    def keep(record) -> bool:
+        module = record["name"] or ""
+        if record["level"].no < lookup(module, levels, default_level):
+            return False
+        if record["level"].no >= sampling_floor:
+            return True
+        return random() < lookup(module, config.sampling, 1.0)
+
     logger.remove()
-    logger.add(stderr, level="INFO")
+    logger.configure(patcher=_add_correlation_id)
+    logger.add(
+        stderr,
+        # The lowest level any module logs at, so records below it aren't even formatted
+        level=min([default_level, *levels.values()]),
+        format=_serialise if config.json else TEXT_FORMAT,
+        filter=keep,
+        enqueue=config.enqueue,
+    )
     return logger
 
 
@@ -0,0 +1,229 @@
+"""Stock game rules as pure functions.
+
+These are shared by the live market in :mod:`src.utils.data.stocks` and the offline
+simulator in :mod:`src.utils.simulation`. Every function accepts plain floats as
+well as NumPy arrays, so the simulator can apply a rule across many simulated
+seasons at once. NumPy is imported by the functions that need it, as pages import
+this module for the scalar rules.
+"""
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional, Tuple
+
+# Shares issued to each company when the stock game is bootstrapped
+INITIAL_SHARES = 50
+# Cash a portfolio opened for a new member starts with
+OPENING_CASH = 50.0
+# Shares of their own Claan granted to each board member at bootstrap
+STARTING_SHARES = 2
+# Maximum shares of a single company a portfolio may hold
+MAX_SHARES_PER_COMPANY = 5
+# Starting, and minimum post-withhold, instrument price
+MIN_PRICE = 10.0
+# Price drop applied after every sale
+SELL_PRICE_STEP = 0.1
+# Price movement applied at escrow close
+ESCROW_PRICE_STEP = 10.0
+# Largest trade quoted on an instrument's quote ladder
+QUOTE_DEPTH = MAX_SHARES_PER_COMPANY
+
+
+def price_after_sale(price):
+    """Price after one share is sold back to the bank."""
+    import numpy as np
+
+    return np.round(price - SELL_PRICE_STEP, 2)
+
+
+def price_after_payout(price, cash_per_share):
+    """Price after a payout, increased when the dividend matches or beats the price."""
+    return price + ESCROW_PRICE_STEP * (cash_per_share >= price)
+
+
+def price_after_withhold(price):
+    """Price after escrow is withheld, decreased but never below :data:`MIN_PRICE`."""
+    import numpy as np
+
+    return np.maximum(price - ESCROW_PRICE_STEP, MIN_PRICE)
+
+
+def payout_wins(payout_votes, withhold_votes):
+    """Whether a board vote results in a payout, ties favour the payout."""
+    return payout_votes >= withhold_votes
+
+
+def split_escrow(escrow, total_shares, ipo_shares):
+    """Split escrow between shareholders and the company.
+
+    :return: Tuple of cash paid per share, and cash paid to the company for shares still in IPO.
+    """
+    import numpy as np
+
+    cash_per_share = np.round(escrow / total_shares, 2)
+    return cash_per_share, np.round(cash_per_share * ipo_shares, 2)
+
+
+class Rejection(Enum):
+    """Why a trade breaks the rules, with the message shown to the trader."""
+
+    SOLD_THIS_FORTNIGHT = "You've already sold shares in this company, so you can't buy more until next fortnight."
+    MAX_SHARES = "Can't own more than 5 shares of a single Company"
+    CASH = "You don't have enough cash to buy that!"
+    NOT_OWNED = "You don't own any shares of this company to sell."
+
+
+def buy_rejection(
+    owned_count: int, sold_this_fortnight: bool, cash: float, price: float
+) -> Optional[Rejection]:
+    """The first rule buying one more share of an instrument breaks, if any.
+
+    Scalar counterpart of :func:`can_buy`, for a single trade.
+    """
+    if sold_this_fortnight:
+        return Rejection.SOLD_THIS_FORTNIGHT
+    if owned_count >= MAX_SHARES_PER_COMPANY:
+        return Rejection.MAX_SHARES
+    if price > cash:
+        return Rejection.CASH
+    return None
+
+
+def sell_rejection(owned_count: int) -> Optional[Rejection]:
+    """The rule selling one share of an instrument breaks, if any."""
+    if owned_count < 1:
+        return Rejection.NOT_OWNED
+    return None
+
+
+def can_buy(owned_count, sold_this_fortnight, cash, price):
+    """Whether a portfolio is allowed to buy one more share of an instrument."""
+    import numpy as np
+
+    return (
+        (owned_count < MAX_SHARES_PER_COMPANY)
+        & np.logical_not(sold_this_fortnight)
+        & (price <= cash)
+    )
+
+
+@dataclass(frozen=True)
+class LinearCurve:
+    """Bonding curve whose price rises by ``slope`` of the base price per share held."""
+
+    slope: float
+
+    def factor(self, supply):
+        """Price of the next share when ``supply`` are held, as a multiple of the base price."""
+        return 1 + self.slope * supply
+
+    def total_factor(self, supply, count):
+        """Sum of :meth:`factor` over the next ``count`` shares, in O(1)."""
+        return count * (1 + self.slope * (supply + (count - 1) / 2))
+
+    def capacity(self) -> Optional[int]:
+        return None
+
+
+@dataclass(frozen=True)
+class ConstantProductCurve:
+    """Pool of ``virtual_shares`` against cash, whose product stays constant.
+
+    Each share bought leaves the pool with fewer shares and more cash, so the next
+    costs more, and a pool can never be bought out. The constant is set so the first
+    share costs the base price.
+    """
+
+    virtual_shares: int
+
+    def factor(self, supply):
+        pool = self.virtual_shares - supply
+        return self.virtual_shares * (self.virtual_shares - 1) / (pool * (pool - 1))
+
+    def total_factor(self, supply, count):
+        # Telescopes, as each share costs k / (pool * (pool - 1)) = k / (pool - 1) - k / pool
+        pool = self.virtual_shares - supply
+        return (
+            self.virtual_shares
+            * (self.virtual_shares - 1)
+            * (1 / (pool - count) - 1 / pool)
+        )
+
+    def capacity(self) -> Optional[int]:
+        """Most shares that can be held at once."""
+        return self.virtual_shares - 2
+
+
+Curve = LinearCurve | ConstantProductCurve
+
+
+@dataclass(frozen=True)
+class QuoteLadder:
+    """Total cost of buying, and proceeds of selling, 1 to :data:`QUOTE_DEPTH` shares.
+
+    Sizes that can't be traded, as fewer shares are held, are left off.
+    """
+
+    buy: Tuple[float, ...]
+    sell: Tuple[float, ...]
+
+
+def base_price(curve: Curve, price, supply):
+    """Curve's base price, given the ``price`` of the next share when ``supply`` are held."""
+    return price / curve.factor(supply)
+
+
+def buy_cost(curve: Curve, price, supply, count=1):
+    """Cost of buying ``count`` shares, when the next costs ``price``."""
+    import numpy as np
+
+    return np.round(
+        base_price(curve, price, supply) * curve.total_factor(supply, count), 2
+    )
+
+
+def sell_proceeds(curve: Curve, price, supply, count=1):
+    """Proceeds of selling ``count`` of the ``supply`` shares held."""
+    import numpy as np
+
+    return np.round(
+        base_price(curve, price, supply) * curve.total_factor(supply - count, count), 2
+    )
+
+
+def price_after_trade(curve: Curve, price, supply, change):
+    """Price of the next share after ``change`` shares are bought, or sold when negative."""
+    import numpy as np
+
+    return np.round(price * curve.factor(supply + change) / curve.factor(supply), 2)
+
+
+def quote_ladder(
+    curve: Optional[Curve], price: float, supply: int, depth: int = QUOTE_DEPTH
+) -> QuoteLadder:
+    """Quotes for 1 to ``depth`` shares, on ``curve`` or by the fixed price steps without one."""
+    sizes = range(1, depth + 1)
+    if curve is None:
+        # Buying never moves the price, and each sale drops it by a step
+        return QuoteLadder(
+            buy=tuple(round(count * price, 2) for count in sizes),
+            sell=tuple(
+                round(count * price - SELL_PRICE_STEP * count * (count - 1) / 2, 2)
+                for count in sizes
+                if count <= supply
+            ),
+        )
+
+    capacity = curve.capacity()
+    return QuoteLadder(
+        buy=tuple(
+            float(buy_cost(curve, price, supply, count))
+            for count in sizes
+            if capacity is None or supply + count <= capacity
+        ),
+        sell=tuple(
+            float(sell_proceeds(curve, price, supply, count))
+            for count in sizes
+            if count <= supply
+        ),
+    )
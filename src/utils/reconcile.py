@@ -0,0 +1,314 @@
+"""Ledger reconciliation job.
+
+Recomputes every :class:`Portfolio` and :class:`Company` cash balance from the
+:class:`Transaction` ledger and reports (or fixes) any drift between the two.
+
+The ledger is streamed in chunks so memory stays flat regardless of season length,
+and each chunk is reduced with vectorized per-holder group sums.
+
+Portfolios opened before the opening balance was posted to the ledger have no
+opening credit as their first ledger entry, yet hold
+:data:`~src.utils.market_rules.OPENING_CASH` that it doesn't account for. That isn't
+drift, so they're reported apart from it, and fixed by posting the missing opening
+credit rather than by taking the cash. Any drift they have besides is compared as
+usual, once the opening is counted.
+
+Run with ``python -m src.utils.reconcile`` to report, or ``--fix`` to write the
+ledger balances back onto the holders.
+"""
+
+import argparse
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from src.models.market.checkpoint import Checkpoint
+from src.models.market.company import Company
+from src.models.market.portfolio import Portfolio
+from src.models.market.transaction import OPERATION_SIGNS, Operation, Transaction
+from src.utils.database import Database, for_update
+from src.utils.logger import LOGGER
+from src.utils.market_rules import OPENING_CASH
+
+LEDGER_COLUMNS = ["portfolio_id", "company_id", "operation", "value"]
+
+
+@dataclass
+class ReconciliationReport:
+    """Result of a reconciliation run.
+
+    ``portfolios`` and ``companies`` are indexed by holder id, with columns
+    ``balance`` (stored cash), ``ledger`` (cash recomputed from transactions) and
+    ``drift`` (``balance - ledger``), and only contain holders whose drift is
+    above the tolerance. ``openings`` has the same columns, for portfolios missing
+    their opening balance from the ledger, with their drift before it's counted.
+    """
+
+    portfolios: pd.DataFrame
+    companies: pd.DataFrame
+    openings: pd.DataFrame
+    transactions: int
+    duration: float
+    fixed: bool = False
+
+    @property
+    def clean(self) -> bool:
+        return self.portfolios.empty and self.companies.empty and self.openings.empty
+
+
+def stream_ledger(
+    _session: Session, chunk_size: int = 10_000
+) -> Iterator[pd.DataFrame]:
+    """Yield the transaction ledger as DataFrames of at most ``chunk_size`` rows."""
+    query = select(
+        Transaction.portfolio_id,
+        Transaction.company_id,
+        Transaction.operation,
+        Transaction.value,
+    ).execution_options(yield_per=chunk_size)
+
+    for partition in _session.execute(query).partitions():
+        yield pd.DataFrame.from_records(partition, columns=LEDGER_COLUMNS)
+
+
+def sum_ledger(
+    _session: Session, chunk_size: int = 10_000
+) -> tuple[pd.Series, pd.Series, int]:
+    """Return signed ledger totals per portfolio and per company, and the row count."""
+    totals = {
+        "portfolio_id": pd.Series(dtype="float64"),
+        "company_id": pd.Series(dtype="float64"),
+    }
+    count = 0
+
+    for chunk in stream_ledger(_session=_session, chunk_size=chunk_size):
+        count += len(chunk)
+        signs = chunk["operation"].map(OPERATION_SIGNS).to_numpy(dtype="float64")
+        signed = pd.Series(chunk["value"].to_numpy(dtype="float64") * signs)
+
+        for column in totals:
+            holders = chunk[column]
+            mask = holders.notna().to_numpy()
+            if not mask.any():
+                continue
+            sums = signed[mask].groupby(holders[mask].astype("int64").to_numpy()).sum()
+            totals[column] = totals[column].add(sums, fill_value=0.0)
+
+    return totals["portfolio_id"], totals["company_id"], count
+
+
+def _compare(balances: pd.Series, ledger: pd.Series, tolerance: float) -> pd.DataFrame:
+    frame = pd.DataFrame({"balance": balances})
+    frame["ledger"] = ledger.reindex(frame.index, fill_value=0.0).round(2)
+    frame["drift"] = (frame["balance"] - frame["ledger"]).round(2)
+
+    return frame[np.abs(frame["drift"]) > tolerance]
+
+
+def opened_portfolios(_session: Session) -> set[int]:
+    """Ids of the portfolios whose first ledger entry is their opening credit."""
+    entries = (
+        select(
+            Transaction.portfolio_id,
+            Transaction.operation,
+            Transaction.value,
+            func.row_number()
+            .over(
+                partition_by=Transaction.portfolio_id,
+                order_by=(Transaction.timestamp, Transaction.id),
+            )
+            .label("position"),
+        )
+        .where(Transaction.portfolio_id.is_not(None))
+        .subquery()
+    )
+
+    return set(
+        _session.execute(
+            select(entries.c.portfolio_id).where(
+                entries.c.position == 1,
+                entries.c.operation == Operation.CREDIT,
+                entries.c.value == OPENING_CASH,
+            )
+        ).scalars()
+    )
+
+
+def post_openings(_session: Session, portfolio_ids: Iterable[int]) -> int:
+    """Post the opening credit missing from the ledger of each portfolio.
+
+    Each is dated before the portfolio's first transaction and the first checkpoint
+    holding its cash, so replaying history counts it exactly once.
+    """
+    first_checkpoints = {}
+    for timestamp, portfolio_cash in _session.execute(
+        select(Checkpoint.timestamp, Checkpoint.portfolio_cash).order_by(
+            Checkpoint.timestamp
+        )
+    ):
+        for portfolio_id in portfolio_cash:
+            first_checkpoints.setdefault(int(portfolio_id), timestamp)
+    first_transactions = dict(
+        _session.execute(
+            select(Transaction.portfolio_id, func.min(Transaction.timestamp))
+            .where(Transaction.portfolio_id.is_not(None))
+            .group_by(Transaction.portfolio_id)
+        ).all()
+    )
+
+    now = datetime.now()
+    openings = []
+    for portfolio_id in portfolio_ids:
+        before = [
+            timestamp
+            for timestamp in (
+                first_checkpoints.get(portfolio_id),
+                first_transactions.get(portfolio_id),
+            )
+            if timestamp is not None
+        ]
+        openings.append(
+            Transaction(
+                value=OPENING_CASH,
+                operation=Operation.CREDIT,
+                instrument=None,
+                portfolio=portfolio_id,
+                company=None,
+                timestamp=min(before) - timedelta(microseconds=1) if before else now,
+            )
+        )
+    _session.add_all(openings)
+    _session.flush()
+
+    return len(openings)
+
+
+def reconcile(
+    _session: Session,
+    fix: bool = False,
+    chunk_size: int = 10_000,
+    tolerance: float = 0.005,
+) -> ReconciliationReport:
+    """Compare stored cash balances against the transaction ledger.
+
+    Balance rows are locked before the ledger is read, so trades committed while
+    the job is running can't show up as false drift.
+
+    :param _session: Session to run the reconciliation in, it will be committed if ``fix`` is set and rolled back otherwise.
+    :param fix: When True, missing opening balances are posted to the ledger, and other drifted balances are overwritten with the ledger value.
+    :param chunk_size: Number of transactions to pull from the cursor at a time.
+    :param tolerance: Absolute difference, in dollars, below which a balance is considered reconciled.
+    """
+    start = perf_counter()
+
+    portfolio_rows = _session.execute(
+        for_update(_session, select(Portfolio.id, Portfolio.cash))
+    ).all()
+    company_rows = _session.execute(
+        for_update(_session, select(Company.id, Company.cash))
+    ).all()
+    portfolio_balances = pd.Series(
+        dict(portfolio_rows), name="balance", dtype="float64"
+    )
+    company_balances = pd.Series(dict(company_rows), name="balance", dtype="float64")
+
+    portfolio_ledger, company_ledger, count = sum_ledger(
+        _session=_session, chunk_size=chunk_size
+    )
+
+    # Without an opening, and holding the cash it would have posted. Portfolios
+    # opened at no cash, such as those the game was set up with, have none to post
+    unexplained = _compare(portfolio_balances, portfolio_ledger, tolerance)
+    openings = unexplained[
+        ~unexplained.index.isin(list(opened_portfolios(_session)))
+        & (unexplained["drift"] >= OPENING_CASH - tolerance)
+    ]
+    portfolio_ledger = portfolio_ledger.add(
+        pd.Series(OPENING_CASH, index=openings.index), fill_value=0.0
+    )
+    report = ReconciliationReport(
+        portfolios=_compare(portfolio_balances, portfolio_ledger, tolerance),
+        companies=_compare(company_balances, company_ledger, tolerance),
+        openings=openings,
+        transactions=count,
+        duration=0.0,
+    )
+
+    if fix and not report.clean:
+        if not report.openings.empty:
+            post_openings(_session, (int(id) for id in report.openings.index))
+        for model, drifted in (
+            (Portfolio, report.portfolios),
+            (Company, report.companies),
+        ):
+            if drifted.empty:
+                continue
+            _session.execute(
+                update(model),
+                [
+                    {"id": int(holder_id), "cash": float(ledger)}
+                    for holder_id, ledger in drifted["ledger"].items()
+                ],
+            )
+        _session.commit()
+        report.fixed = True
+    else:
+        _session.rollback()
+
+    report.duration = perf_counter() - start
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reconcile portfolio and company cash against the transaction ledger."
+    )
+    parser.add_argument(
+        "--fix",
+        action="store_true",
+        help="Post missing opening balances, and overwrite other drifted balances with the ledger value.",
+    )
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--tolerance", type=float, default=0.005)
+    args = parser.parse_args()
+
+    LOGGER.info("Reconciling ledger...")
+    with Database.get_session() as session:
+        report = reconcile(
+            _session=session,
+            fix=args.fix,
+            chunk_size=args.chunk_size,
+            tolerance=args.tolerance,
+        )
+
+    LOGGER.info(
+        f"Reconciled {report.transactions} transactions in {report.duration:.2f}s"
+    )
+    if report.clean:
+        LOGGER.info("No drift found")
+        return
+
+    if not report.openings.empty:
+        LOGGER.warning(
+            f"Opening balance missing from the ledger of {len(report.openings)} portfolios:\n{report.openings}"
+        )
+    for name, drifted in (
+        ("portfolios", report.portfolios),
+        ("companies", report.companies),
+    ):
+        if not drifted.empty:
+            LOGGER.warning(f"Drift found in {len(drifted)} {name}:\n{drifted}")
+    if report.fixed:
+        LOGGER.info(
+            "Opening balances posted and drifted balances reset to ledger values"
+        )
+
+
+if __name__ == "__main__":
+    main()
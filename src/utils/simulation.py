@@ -0,0 +1,266 @@
+"""Monte Carlo simulator for the stock game economy.
+
+Plays out whole seasons offline using the rules in :mod:`src.utils.market_rules`,
+so prices and payouts can be balanced before a season launches. State is held in
+NumPy arrays with simulations on the first axis, so each rule is applied to every
+simulated season at once, and batches of simulations are spread across a process pool.
+
+Run with ``python -m src.utils.simulation --help`` for the available options.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.models.claan import Claan
+from src.models.task_reward import TaskReward
+from src.utils.market_rules import (
+    INITIAL_SHARES,
+    MIN_PRICE,
+    STARTING_SHARES,
+    can_buy,
+    payout_wins,
+    price_after_payout,
+    price_after_sale,
+    price_after_withhold,
+    split_escrow,
+)
+
+REWARDS = np.array([reward.value for reward in TaskReward], dtype="float64")
+
+
+@dataclass
+class BehaviourModel:
+    """Describes how board members act each fortnight.
+
+    :param submissions: Mean number of tasks each member submits per fortnight, drawn from a Poisson distribution.
+    :param reward_weights: Relative likelihood of each :class:`TaskReward` being submitted, defaulting to uniform.
+    :param payout_vote: Probability a member votes to pay out.
+    :param withhold_vote: Probability a member votes to withhold, the remainder abstain.
+    :param buy: Probability a member tries to buy one share each fortnight.
+    :param sell: Probability a member tries to sell one share each fortnight.
+    :param own_claan_bias: Probability a purchase is of the member's own Claan, rather than a random one.
+    """
+
+    submissions: float = 4.0
+    reward_weights: List[float] = field(default_factory=lambda: [1.0] * len(REWARDS))
+    payout_vote: float = 0.6
+    withhold_vote: float = 0.3
+    buy: float = 0.5
+    sell: float = 0.2
+    own_claan_bias: float = 0.5
+
+
+@dataclass
+class SimulationConfig:
+    simulations: int = 1000
+    fortnights: int = 6
+    members: int = 8
+    credit: float = 10.0
+    seed: int = 0
+    behaviour: BehaviourModel = field(default_factory=BehaviourModel)
+
+
+def simulate(config: SimulationConfig, simulations: int, seed) -> Dict[str, np.ndarray]:
+    """Play ``simulations`` seasons in parallel.
+
+    :return: Dict of final ``price`` and company ``stash`` (simulations x claans), and
+        member ``wealth`` and ``cash`` (simulations x members).
+    """
+    if config.members * STARTING_SHARES > INITIAL_SHARES:
+        raise ValueError(
+            "Not enough initial shares to grant every member their starting shares"
+        )
+
+    rng = np.random.default_rng(seed)
+    behaviour = config.behaviour
+
+    claans = len(Claan)
+    members = claans * config.members
+    sims = np.arange(simulations)
+    member_claan = np.repeat(np.arange(claans), config.members)
+    reward_p = np.asarray(behaviour.reward_weights, dtype="float64")
+    reward_p = reward_p / reward_p.sum()
+
+    price = np.full((simulations, claans), MIN_PRICE)
+    stash = np.zeros((simulations, claans))
+    cash = np.zeros((simulations, members))
+    holdings = np.zeros((simulations, members, claans), dtype="int64")
+    holdings[:, np.arange(members), member_claan] = STARTING_SHARES
+    ipo = np.full(
+        (simulations, claans), INITIAL_SHARES - STARTING_SHARES * config.members
+    )
+    bank = np.zeros((simulations, claans), dtype="int64")
+
+    for _ in range(config.fortnights):
+        cash += config.credit
+        sold = np.zeros((simulations, members, claans), dtype=bool)
+
+        # Members trade one at a time, as supply depends on earlier trades
+        for member in rng.permutation(members):
+            wants_sell = rng.random(simulations) < behaviour.sell
+            held = holdings[:, member, :] > 0
+            weights = held * rng.random((simulations, claans))
+            target = weights.argmax(axis=1)
+            selling = wants_sell & held.any(axis=1)
+
+            cash[selling, member] += price[sims[selling], target[selling]]
+            holdings[sims[selling], member, target[selling]] -= 1
+            bank[sims[selling], target[selling]] += 1
+            sold[sims[selling], member, target[selling]] = True
+            price[sims[selling], target[selling]] = price_after_sale(
+                price[sims[selling], target[selling]]
+            )
+
+            wants_buy = rng.random(simulations) < behaviour.buy
+            own = rng.random(simulations) < behaviour.own_claan_bias
+            target = np.where(
+                own, member_claan[member], rng.integers(0, claans, simulations)
+            )
+            supply = ipo[sims, target] + bank[sims, target]
+            buying = (
+                wants_buy
+                & (supply > 0)
+                & can_buy(
+                    holdings[sims, member, target],
+                    sold[sims, member, target],
+                    cash[:, member],
+                    price[sims, target],
+                )
+            )
+            from_ipo = buying & (ipo[sims, target] > 0)
+            from_bank = buying & ~from_ipo
+
+            cash[buying, member] -= price[sims[buying], target[buying]]
+            holdings[sims[buying], member, target[buying]] += 1
+            ipo[sims[from_ipo], target[from_ipo]] -= 1
+            bank[sims[from_bank], target[from_bank]] -= 1
+
+        submissions = rng.poisson(behaviour.submissions, (simulations, members))
+        escrow_member = np.zeros((simulations, members))
+        for reward, count in zip(
+            REWARDS, np.moveaxis(rng.multinomial(submissions, reward_p), -1, 0)
+        ):
+            escrow_member += reward * count
+        escrow = np.zeros((simulations, claans))
+        np.add.at(escrow, (slice(None), member_claan), escrow_member)
+
+        votes = rng.random((simulations, members))
+        payout_votes = np.zeros((simulations, claans))
+        withhold_votes = np.zeros((simulations, claans))
+        np.add.at(
+            payout_votes, (slice(None), member_claan), votes < behaviour.payout_vote
+        )
+        np.add.at(
+            withhold_votes,
+            (slice(None), member_claan),
+            (votes >= behaviour.payout_vote)
+            & (votes < behaviour.payout_vote + behaviour.withhold_vote),
+        )
+        paying = payout_wins(payout_votes, withhold_votes)
+
+        cash_per_share, to_company = split_escrow(escrow, INITIAL_SHARES, ipo)
+        cash += (holdings * np.where(paying, cash_per_share, 0.0)[:, None, :]).sum(
+            axis=2
+        )
+        stash += np.where(paying, to_company, escrow)
+        price = np.where(
+            paying,
+            price_after_payout(price, cash_per_share),
+            price_after_withhold(price),
+        )
+
+    wealth = cash + (holdings * price[:, None, :]).sum(axis=2)
+
+    return {"price": price, "stash": stash, "wealth": wealth, "cash": cash}
+
+
+def run(
+    config: SimulationConfig, workers: Optional[int] = None
+) -> Dict[str, np.ndarray]:
+    """Split ``config.simulations`` into batches and simulate them across a process pool."""
+    workers = workers or os.cpu_count() or 1
+    batches = [
+        len(batch)
+        for batch in np.array_split(np.arange(config.simulations), workers)
+        if len(batch)
+    ]
+    seeds = np.random.SeedSequence(config.seed).spawn(len(batches))
+
+    with ProcessPoolExecutor(max_workers=len(batches)) as pool:
+        results = list(pool.map(simulate, [config] * len(batches), batches, seeds))
+
+    return {
+        key: np.concatenate([result[key] for result in results]) for key in results[0]
+    }
+
+
+def summarise(results: Dict[str, np.ndarray]) -> Dict[str, pd.DataFrame]:
+    """Percentile tables for each result, per Claan for prices and stashes."""
+    percentiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+    claan_names = [claan.name for claan in Claan]
+
+    return {
+        "price": pd.DataFrame(results["price"], columns=claan_names).describe(
+            percentiles
+        ),
+        "stash": pd.DataFrame(results["stash"], columns=claan_names).describe(
+            percentiles
+        ),
+        "wealth": pd.DataFrame(
+            {
+                "wealth": results["wealth"].ravel(),
+                "cash": results["cash"].ravel(),
+            }
+        ).describe(percentiles),
+    }
+
+
+def main():
+    defaults = BehaviourModel()
+    parser = argparse.ArgumentParser(description="Simulate stock game seasons.")
+    parser.add_argument("--simulations", type=int, default=1000)
+    parser.add_argument("--fortnights", type=int, default=6)
+    parser.add_argument("--members", type=int, default=8)
+    parser.add_argument("--credit", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    for name, value in asdict(defaults).items():
+        if isinstance(value, float):
+            parser.add_argument(
+                f"--{name.replace('_', '-')}", type=float, default=value
+            )
+    args = parser.parse_args()
+
+    config = SimulationConfig(
+        simulations=args.simulations,
+        fortnights=args.fortnights,
+        members=args.members,
+        credit=args.credit,
+        seed=args.seed,
+        behaviour=BehaviourModel(
+            **{
+                name: getattr(args, name)
+                for name, value in asdict(defaults).items()
+                if isinstance(value, float)
+            }
+        ),
+    )
+
+    start = perf_counter()
+    results = run(config, workers=args.workers)
+    print(f"Simulated {config.simulations} seasons in {perf_counter() - start:.2f}s")
+
+    for name, table in summarise(results).items():
+        print(f"\n--- {name.title()} ---")
+        print(table.round(2).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Process-wide snapshot of the portal and Claan header data.
+
+Every session shows the same scores and corporate data, so rather than each session
+loading and keeping a copy of its own, :data:`SNAPSHOTS` holds one immutable
+:class:`PortalSnapshot` per tenant, which every session reads.
+
+Snapshots are built on background threads, never by a page's rerun:
+
+* for every tenant when the first page runs, and for a tenant when first read
+* every :data:`REFRESH_INTERVAL` seconds, for tenants with a snapshot
+* when an event changes what they show, through :meth:`SnapshotService.invalidate`
+
+Builds are single-flight: however many sessions find a snapshot missing or stale, one
+build runs per tenant, and invalidations during it queue one more rather than one
+each. Until it finishes, sessions are shown the stale snapshot, except the session
+whose write invalidated it, which waits for the snapshot including its write.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from threading import Condition, Thread
+from time import sleep
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+
+import streamlit as st
+from sqlalchemy.orm import Session
+
+from src.models.claan import Claan
+from src.models.tenant import TenantContext, current_tenant, use_tenant
+from src.utils.database import Database
+from src.utils.logger import LOGGER
+from src.utils.tenancy import get_tenants
+from src.utils.tracing import span
+
+REFRESH_INTERVAL = 60.0
+# Longest a session waits for the snapshot including its write, before showing a stale one
+WAIT_TIMEOUT = 10.0
+# Session state key of the generation the session's last write will appear in
+SESSION_GENERATION = "snapshot_generation"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class PortalSnapshot:
+    """Scores and corporate data of every Claan, as of ``taken``.
+
+    Shared by every session, so its mappings are read-only views.
+    """
+
+    generation: int
+    taken: datetime
+    scores: Mapping[Claan, int]
+    corporate: Mapping[Claan, Mapping[str, float]]
+
+    @property
+    def age(self) -> float:
+        """Seconds since the snapshot was taken."""
+        return (datetime.now() - self.taken).total_seconds()
+
+
+def build_snapshot(_session: Session, generation: int) -> PortalSnapshot:
+    from src.utils.data.scores import get_scores
+    from src.utils.data.stocks import get_corporate_data
+
+    return PortalSnapshot(
+        generation=generation,
+        taken=datetime.now(),
+        scores=MappingProxyType(dict(get_scores(_session=_session))),
+        corporate=MappingProxyType(
+            {
+                claan: MappingProxyType(
+                    dict(get_corporate_data(_session=_session, claan=claan))
+                )
+                for claan in Claan
+            }
+        ),
+    )
+
+
+@dataclass
+class _TenantSnapshot:
+    tenant: TenantContext
+    snapshot: Optional[PortalSnapshot] = None
+    # Bumped by every invalidation, so snapshots built before it are known to be stale
+    generation: int = 0
+    building: bool = False
+    error: Optional[str] = None
+
+
+class SnapshotService:
+    """Builds, refreshes and serves each tenant's :class:`PortalSnapshot`.
+
+    :param interval: Seconds between refreshes of every snapshot.
+    :param wait_timeout: Longest :meth:`get` waits for a newer snapshot than it has.
+    """
+
+    def __init__(
+        self, interval: float = REFRESH_INTERVAL, wait_timeout: float = WAIT_TIMEOUT
+    ):
+        self.interval = interval
+        self.wait_timeout = wait_timeout
+        self._tenants: Dict[int, _TenantSnapshot] = {}
+        # Guards the tenants' state, and is notified whenever a build finishes
+        self._built = Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="snapshot"
+        )
+        self._refresher: Optional[Thread] = None
+
+    def _state(self, tenant: TenantContext) -> _TenantSnapshot:
+        return self._tenants.setdefault(tenant.id, _TenantSnapshot(tenant=tenant))
+
+    def get(self, generation: int = 0) -> PortalSnapshot:
+        """The current tenant's snapshot, of at least ``generation``.
+
+        Waits for the first snapshot, and up to ``wait_timeout`` for one of
+        ``generation``, after which the stale one is returned.
+        """
+        self.start()
+        tenant = current_tenant()
+        with self._built:
+            state = self._state(tenant)
+            if state.snapshot is not None and state.snapshot.generation >= generation:
+                return state.snapshot
+
+            self._build(state)
+            self._built.wait_for(
+                lambda: (
+                    (
+                        state.snapshot is not None
+                        and state.snapshot.generation >= generation
+                    )
+                    or not state.building
+                ),
+                timeout=None if state.snapshot is None else self.wait_timeout,
+            )
+            if state.snapshot is None:
+                raise SnapshotError(f"No snapshot for {tenant.slug}: {state.error}")
+            return state.snapshot
+
+    def invalidate(self) -> int:
+        """Mark the current tenant's snapshot stale, and rebuild it in the background.
+
+        :return: The generation of the snapshot that will include the change.
+        """
+        with self._built:
+            state = self._state(current_tenant())
+            state.generation += 1
+            self._build(state)
+            return state.generation
+
+    def _build(self, state: _TenantSnapshot) -> None:
+        """Start building ``state``'s snapshot, unless a build is running already."""
+        if state.building:
+            # It goes again once finished if the generation has moved on meanwhile
+            return
+        state.building = True
+        self._executor.submit(self._run_build, state)
+
+    def _run_build(self, state: _TenantSnapshot) -> None:
+        try:
+            while True:
+                with self._built:
+                    generation = state.generation
+                with use_tenant(state.tenant), Database.get_sessionmaker()() as session:
+                    snapshot = build_snapshot(session, generation)
+
+                with self._built:
+                    state.snapshot = snapshot
+                    state.error = None
+                    self._built.notify_all()
+                    if state.generation == generation:
+                        state.building = False
+                        return
+        except Exception as e:
+            LOGGER.exception(f"Building the snapshot for {state.tenant.slug} failed")
+            with self._built:
+                state.error = repr(e)
+                state.building = False
+                self._built.notify_all()
+
+    def start(self) -> None:
+        """Build every tenant's snapshot and start refreshing them, once per process."""
+        with self._built:
+            if self._refresher is not None:
+                return
+            self._refresher = Thread(
+                target=self._refresh_forever, name="snapshot-refresher", daemon=True
+            )
+        self._refresher.start()
+
+    def _refresh_forever(self) -> None:
+        try:
+            with Database.get_sessionmaker()() as session:
+                tenants = get_tenants(session)
+        except Exception:
+            LOGGER.exception("Listing tenants to build snapshots for failed")
+            tenants = []
+        with self._built:
+            for tenant in tenants:
+                self._build(self._state(tenant))
+
+        while True:
+            sleep(self.interval)
+            with self._built:
+                # Tenants whose first build failed are built again when next read
+                for state in self._tenants.values():
+                    if (
+                        state.snapshot is not None
+                        and state.snapshot.age >= self.interval
+                    ):
+                        self._build(state)
+
+
+SNAPSHOTS = SnapshotService()
+
+
+def get_portal_snapshot() -> PortalSnapshot:
+    """The current tenant's snapshot, including this session's own writes."""
+    with span("snapshot") as current:
+        snapshot = SNAPSHOTS.get(generation=st.session_state.get(SESSION_GENERATION, 0))
+        current.set("snapshot.generation", snapshot.generation)
+        current.set("snapshot.age", round(snapshot.age, 3))
+
+    return snapshot
@@ -0,0 +1,161 @@
+"""Import-time profile of the app's pages, as a startup diagnostic.
+
+Each page is imported in a fresh interpreter with ``-X importtime``, after Streamlit
+itself, as the server has already loaded it by the time a page first runs. What's
+left is the cost of a page's own imports on a cold start, which is reported with the
+modules that contribute most to it.
+
+Heavy dependencies, such as pandas and Faker, should be imported inside the functions
+that use them, so pages that don't need them don't pay for them. With ``--check``,
+exits non-zero when any page's cold import time is over its budget, so a new
+module-level import that blows it fails CI.
+
+Run with ``python -m src.utils.startup --help`` for the available options.
+"""
+
+import argparse
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Set
+
+ROOT = Path(__file__).parents[2]
+# Relative to ROOT, wherever this is run from
+PAGES = [
+    Path("Claan-Portal.py"),
+    *sorted(page.relative_to(ROOT) for page in (ROOT / "pages").glob("[0-9]_*.py")),
+]
+# Seconds a page's imports may take on a cold start
+IMPORT_BUDGET = 0.6
+PAGE_BUDGETS = {
+    # Renders tables on every run, so imports pandas up front
+    Path("pages/7_Admin.py"): 1.2,
+}
+
+_MARKER = "startup: page imports"
+# Runs the page's module level, but not its ``if __name__ == "__main__"`` block
+_SCRIPT = f"""
+import runpy, sys
+import streamlit
+print({_MARKER!r}, file=sys.stderr, flush=True)
+runpy.run_path(sys.argv[1], run_name="__startup__")
+"""
+
+
+@dataclass(frozen=True)
+class ImportRecord:
+    module: str
+    # Microseconds, as reported by -X importtime
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+@dataclass(frozen=True)
+class PageProfile:
+    page: Path
+    imports: List[ImportRecord]
+
+    @property
+    def total(self) -> float:
+        """Seconds spent importing modules the page loaded itself."""
+        return sum(record.cumulative_us for record in self.top_level) / 1e6
+
+    @property
+    def packages(self) -> Set[str]:
+        """Top-level packages of every module the page loaded itself."""
+        return {record.module.partition(".")[0] for record in self.imports}
+
+    @property
+    def top_level(self) -> List[ImportRecord]:
+        return [record for record in self.imports if record.depth == 0]
+
+    def slowest(self, count: int) -> List[ImportRecord]:
+        return sorted(self.imports, key=lambda record: record.self_us, reverse=True)[
+            :count
+        ]
+
+
+def parse_importtime(output: str) -> List[ImportRecord]:
+    """Parse ``-X importtime`` lines, such as ``import time:  45 |  120 |   pandas.core``."""
+    records = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        # Nesting is shown by two spaces per level, after the one separating the column
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        records.append(
+            ImportRecord(
+                module=name.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+                depth=depth,
+            )
+        )
+
+    return records
+
+
+def profile_page(page: Path) -> PageProfile:
+    """Import ``page``, relative to ROOT, in a fresh interpreter, and time its imports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SCRIPT, str(ROOT / page)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    page_output = result.stderr.split(_MARKER, 1)[1]
+
+    return PageProfile(page=page, imports=parse_importtime(page_output))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Profile the cold import time of the app's pages."
+    )
+    parser.add_argument(
+        "pages",
+        nargs="*",
+        type=Path,
+        default=PAGES,
+        help="Pages to profile, relative to the repository root.",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Slowest modules to list per page."
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=f"Fail if a page's imports take longer than its budget, {IMPORT_BUDGET}s unless set in PAGE_BUDGETS.",
+    )
+    parser.add_argument(
+        "--budget", type=float, help="Budget in seconds for every page, with --check."
+    )
+    args = parser.parse_args()
+
+    over_budget = []
+    for page in args.pages:
+        profile = profile_page(page)
+        budget = args.budget or PAGE_BUDGETS.get(page, IMPORT_BUDGET)
+        print(f"{page}: {profile.total:.3f}s (budget {budget}s)")
+        for record in profile.slowest(args.top):
+            print(
+                f"  {record.self_us / 1000:8.1f}ms self {record.cumulative_us / 1000:8.1f}ms total  {record.module}"
+            )
+
+        if args.check and profile.total > budget:
+            over_budget.append(
+                f"{page} imports in {profile.total:.3f}s, over {budget}s"
+            )
+
+    for failure in over_budget:
+        print(failure, file=sys.stderr)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,116 +1,175 @@
-from sqlalchemy import func, select
+from contextlib import contextmanager
+from time import perf_counter
+
+from sqlalchemy import case, func, insert, select, update
 
 from src.models.base import Base
 from src.models.claan import Claan
+from src.models.tenant import current_tenant
 from src.models.user import User
-from src.utils.data.stocks import grant_share_to_user
+from src.utils.data.history import write_checkpoint
+from src.utils.data.ledger import numbers
 from src.utils.database import Database
 from src.utils.logger import LOGGER
+from src.utils.market_rules import INITIAL_SHARES, STARTING_SHARES
+
+
+@contextmanager
+def timed(step: str):
+    LOGGER.info(f"{step}...")
+    start = perf_counter()
+    yield
+    LOGGER.info(f"{step} took {perf_counter() - start:.3f}s")
 
 
 def main():
     LOGGER.info("Initializing stock game...")
 
     ## Build tables
-    from src.models.market import Company, Instrument, Portfolio, Share, Transaction
-
-    _tables = [Company, Instrument, Portfolio, Share, Transaction]
+    from src.models.market import (
+        Checkpoint,
+        Company,
+        Instrument,
+        Portfolio,
+        Share,
+        Transaction,
+    )
+
+    _tables = [Checkpoint, Company, Instrument, Portfolio, Share, Transaction]
     Base.metadata.create_all(bind=Database.get_engine())
 
+    # Queries nested in an INSERT aren't limited to the tenant, so those limit themselves
+    tenant = current_tenant()
     with Database.get_session() as session:
         ## Populate companies table
-        with session.begin_nested() as transaction:
-            LOGGER.info("Populating companies")
-
-            companies_query = select(Company)
-            companies = session.execute(companies_query).scalars().all()
-
-            new_companies = []
-            for claan in Claan:
-                if claan not in [company.claan for company in companies]:
-                    new_companies.append(Company(claan))
-            session.add_all(new_companies)
-            transaction.commit()
-
-        ## Populate instruments table
-        with session.begin_nested() as transaction:
-            LOGGER.info("Populating instruments")
-
-            companies_query = select(Company)
-            companies = session.execute(companies_query).scalars().all()
-
-            instruments_query = select(Instrument.company_id)
-            instruments = session.execute(instruments_query).scalars().all()
-
-            new_instruments = [
-                Instrument(company.id, company.claan.name.split("_")[0].upper())
-                for company in companies
-                if company.id not in instruments
-            ]
-            session.add_all(new_instruments)
-            transaction.commit()
-
-        ## Populate shares table
-        with session.begin_nested() as transaction:
-            LOGGER.info("Populating shares")
-
-            instruments_query = select(Instrument)
-            instruments = session.execute(instruments_query).scalars().all()
-
-            new_shares = []
-            for instrument in instruments:
-                shares_query = (
-                    select(func.count())
-                    .select_from(Share)
-                    .where(Share.instrument == instrument)
+        with session.begin_nested(), timed("Populating companies"):
+            existing = set(session.execute(select(Company.claan)).scalars())
+            missing = [{"claan": claan} for claan in Claan if claan not in existing]
+            if missing:
+                session.execute(insert(Company), missing)
+            LOGGER.info(f"Added {len(missing)} companies")
+
+        ## Populate instruments table, one per company
+        with session.begin_nested(), timed("Populating instruments"):
+            ticker = case(
+                *[
+                    (Company.claan == claan, claan.name.split("_")[0].upper())
+                    for claan in Claan
+                ]
+            )
+            companies_without_instrument = (
+                select(Company.id, ticker)
+                .outerjoin(Instrument)
+                .where(Instrument.id.is_(None))
+                .where(Company.tenant_id == tenant.id)
+            )
+            result = session.execute(
+                insert(Instrument).from_select(
+                    ["company_id", "ticker"], companies_without_instrument
                 )
-                shares_count = session.execute(shares_query).scalar_one()
-
-                for _ in range(0, 50 - shares_count):
-                    new_shares.append(Share(instrument=instrument, owner=None))
-
-            session.add_all(new_shares)
-            transaction.commit()
-
-        ## Populate portfolios table
-        with session.begin_nested() as transaction:
-            LOGGER.info("Populating portfolios")
-
-            users_query = select(User)
-            users = session.execute(users_query).scalars().all()
-
-            new_portfolios = []
-            for user in users:
-                portfolio_query = select(Portfolio).where(Portfolio.user_id == user.id)
-                portfolio = session.execute(portfolio_query).scalar_one_or_none()
-
-                if not portfolio and user.claan:
-                    company_query = select(Company).where(Company.claan == user.claan)
-                    company = session.execute(company_query).scalar_one()
-
-                    new_portfolios.append(Portfolio(user, company))
-
-            session.add_all(new_portfolios)
-            transaction.commit()
+            )
+            LOGGER.info(f"Added {result.rowcount} instruments")
+
+        ## Top up each instrument's share pool to the initial share count
+        with session.begin_nested(), timed("Populating shares"):
+            share_count = (
+                select(func.count(Share.id))
+                .where(Share.instrument_id == Instrument.id)
+                .scalar_subquery()
+            )
+            pool = numbers(INITIAL_SHARES)
+            missing_shares = (
+                select(Instrument.id)
+                .join(pool, pool.c.n > share_count)
+                .where(Instrument.tenant_id == tenant.id)
+            )
+            result = session.execute(
+                insert(Share).from_select(["instrument_id"], missing_shares)
+            )
+            LOGGER.info(f"Added {result.rowcount} shares")
+
+        ## Populate portfolios table, for users in a Claan
+        with session.begin_nested(), timed("Populating portfolios"):
+            users_without_portfolio = (
+                select(User.id, Company.id)
+                .join(
+                    Company,
+                    (Company.claan == User.claan)
+                    & (Company.tenant_id == User.tenant_id),
+                )
+                .where(User.tenant_id == tenant.id)
+                .where(
+                    ~select(Portfolio.id).where(Portfolio.user_id == User.id).exists()
+                )
+            )
+            result = session.execute(
+                insert(Portfolio).from_select(
+                    ["user_id", "company_id"], users_without_portfolio
+                )
+            )
+            LOGGER.info(f"Added {result.rowcount} portfolios")
+
+        ## Issue starting shares to board members from their company's pool
+        with session.begin_nested(), timed("Issuing starting shares"):
+            owned_count = (
+                select(func.count(Share.id))
+                .where(Share.owner_id == Portfolio.id)
+                .scalar_subquery()
+            )
+            # One row per share each portfolio is still owed, ranked within its instrument
+            slots = numbers(STARTING_SHARES)
+            demand = (
+                select(
+                    Portfolio.id.label("portfolio_id"),
+                    Instrument.id.label("instrument_id"),
+                    func.row_number()
+                    .over(
+                        partition_by=Instrument.id,
+                        order_by=(Portfolio.id, slots.c.n),
+                    )
+                    .label("rank"),
+                )
+                .join(Instrument, Instrument.company_id == Portfolio.company_id)
+                .join(slots, slots.c.n <= STARTING_SHARES - owned_count)
+                .subquery()
+            )
+            # Unowned shares, ranked within their instrument
+            supply = (
+                select(
+                    Share.id.label("share_id"),
+                    Share.instrument_id,
+                    func.row_number()
+                    .over(partition_by=Share.instrument_id, order_by=Share.id)
+                    .label("rank"),
+                )
+                .where(Share.owner_id.is_(None))
+                .subquery()
+            )
+            grants = (
+                select(supply.c.share_id, demand.c.portfolio_id)
+                .join(
+                    demand,
+                    (demand.c.instrument_id == supply.c.instrument_id)
+                    & (demand.c.rank == supply.c.rank),
+                )
+                .subquery()
+            )
+            result = session.execute(
+                update(Share)
+                .where(Share.id == grants.c.share_id)
+                .values(owner_id=grants.c.portfolio_id, ipo=False)
+                .execution_options(synchronize_session=False)
+            )
+            LOGGER.info(f"Granted {result.rowcount} shares")
 
-        ## Issue shares to board members
-        with session.begin_nested() as transaction:
-            LOGGER.info("Issuing starting shares")
-            query = (
-                select(Portfolio, User, func.count(Share.id).label("count"))
-                .select_from(Portfolio)
-                .join(User)
-                .join(Share, isouter=True)
-                .group_by(Portfolio, User)
+        ## Write the opening market checkpoint for history replay
+        with session.begin_nested(), timed("Writing opening checkpoint"):
+            checkpoint_count = session.scalar(
+                select(func.count()).select_from(Checkpoint)
             )
-            result = session.execute(query).scalars().all()
-
-            for portfolio in result:
-                if len(portfolio.shares) < 2:
-                    for _ in range(0, 2 - len(portfolio.shares)):
-                        LOGGER.info(f"Issuing share to user {portfolio.user.name}")
-                        with session.begin_nested():
-                            grant_share_to_user(_session=session, portfolio=portfolio)
+            if checkpoint_count == 0:
+                LOGGER.info("Writing opening market checkpoint")
+                write_checkpoint(_session=session)
 
         # ### Disabled currently as users will start with 0 dollars ###
         # ## Grant starting funds to users with no transactions
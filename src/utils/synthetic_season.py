@@ -0,0 +1,274 @@
+"""Play a synthetic season against an embedded SQLite database.
+
+Runs the real write paths, from initialisation and the stock game bootstrap through
+task records, trades, credit and each fortnight's escrow, in-process with no database
+server, then checks the results hold together:
+
+* every cash balance reconciles with the transaction ledger
+* replaying history from the checkpoints rebuilds current cash and prices
+* no portfolio holds more shares of a company than the rules allow
+* no fortnight pays out more in dividends than its escrow released
+
+Fortnights are played back to back, with the season backdated so the last one is
+the current fortnight. Exits non-zero if a check fails, so it can gate a deployment.
+
+Run with ``python -m src.utils.synthetic_season --help`` for the available options.
+"""
+
+import argparse
+import logging
+import sys
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import List, Optional
+
+import email_validator
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from src.models.base import Base
+from src.models.claan import Claan
+from src.models.market.instrument import Instrument
+from src.models.market.portfolio import BoardVote, Portfolio
+from src.models.market.pricing_curve import CurveKind, PricingCurve
+from src.models.market.share import Share
+from src.models.market.transaction import Operation, Transaction
+from src.models.record import Record
+from src.models.season import Season
+from src.models.task import Task
+from src.models.user import User
+from src.utils.data.history import get_market_state
+from src.utils.data.stocks import buy_share, issue_credit, process_escrow, sell_share
+from src.utils.database import Database, create_sqlite_engine, initialise
+from src.utils.logger import LOGGER
+from src.utils.market_rules import MAX_SHARES_PER_COMPANY
+from src.utils.reconcile import reconcile
+
+
+def seed_season(_session: Session, members: int, fortnights: int) -> None:
+    """Add a season backdated by ``fortnights``, and ``members`` active users per Claan."""
+    start = date.today() - timedelta(weeks=2 * (fortnights - 1))
+    _session.add(Season(name="Synthetic", start_date=start))
+    _session.add_all(
+        User(
+            long_name=f"{claan.value} Member {number}",
+            name=f"{claan.name.split('_')[0].title()} {number}",
+            email=f"{claan.name.lower()}.{number}@advancinganalytics.co.uk",
+            claan=claan,
+        )
+        for claan in Claan
+        for number in range(members)
+    )
+    _session.commit()
+
+
+def add_curve(_session: Session, kind: CurveKind) -> None:
+    """Price every instrument this season on a ``kind`` curve."""
+    season_id = _session.execute(select(Season.id)).scalar_one()
+    _session.add(
+        PricingCurve(season_id=season_id, kind=kind, slope=0.05, virtual_shares=400)
+    )
+    _session.commit()
+
+
+@dataclass(frozen=True)
+class FortnightResult:
+    trades: int
+    # Escrow held before processing, and dividends paid to portfolios out of it
+    escrow: float
+    dividends: float
+
+
+def play_fortnight(
+    _session: Session, rng: np.random.Generator, fortnight: int, submissions: float
+) -> FortnightResult:
+    """Submit records, vote and trade for every portfolio, then process escrow."""
+    tasks = _session.execute(select(Task)).scalars().all()
+    portfolios = _session.execute(select(Portfolio)).scalars().all()
+    instrument_ids = _session.execute(select(Instrument.id)).scalars().all()
+
+    records = []
+    for portfolio in portfolios:
+        for index in rng.integers(len(tasks), size=rng.poisson(submissions)):
+            task = tasks[index]
+            records.append(
+                Record(
+                    task=task,
+                    user=portfolio.user_id,
+                    claan=portfolio.company.claan,
+                    reward=task.reward,
+                )
+            )
+        portfolio.board_vote = list(BoardVote)[rng.integers(len(BoardVote))]
+    _session.add_all(records)
+    _session.commit()
+
+    trades = 0
+    for portfolio in portfolios:
+        instrument_id = int(rng.choice(instrument_ids))
+        if rng.random() < 0.3:
+            trades += sell_share(_session, portfolio.id, instrument_id)
+        else:
+            trades += buy_share(_session, portfolio.id, instrument_id)
+
+    escrow = _session.execute(
+        select(func.coalesce(func.sum(Record.score), 0)).where(Record.escrow)
+    ).scalar_one()
+    last_transaction = _session.execute(
+        select(func.coalesce(func.max(Transaction.id), 0))
+    ).scalar_one()
+    process_escrow(_session, fortnight=fortnight)
+    dividends = _session.execute(
+        select(func.coalesce(func.sum(Transaction.value), 0.0))
+        .where(Transaction.id > last_transaction)
+        .where(Transaction.operation == Operation.CREDIT)
+        .where(Transaction.portfolio_id.is_not(None))
+    ).scalar_one()
+
+    return FortnightResult(trades=trades, escrow=float(escrow), dividends=dividends)
+
+
+def check_dividends(results: List[FortnightResult]) -> List[str]:
+    """Return a description of each fortnight that paid more dividends than its escrow."""
+    return [
+        f"Fortnight {fortnight} paid ${result.dividends:.2f} of dividends out of ${result.escrow:.2f} escrow"
+        for fortnight, result in enumerate(results)
+        if result.dividends > result.escrow + 0.005
+    ]
+
+
+def check(_session: Session) -> List[str]:
+    """Return a description of each consistency check that failed."""
+    failures = []
+
+    report = reconcile(_session)
+    if not report.clean:
+        failures.append(
+            f"{len(report.portfolios) + len(report.openings)} portfolios and {len(report.companies)} companies don't reconcile"
+        )
+
+    state = get_market_state(_session=_session, timestamp=datetime.now())
+    cash = dict(_session.execute(select(Portfolio.id, Portfolio.cash)).all())
+    drifted = [
+        portfolio_id
+        for portfolio_id, balance in cash.items()
+        if abs(state.portfolio_cash.get(portfolio_id, 0.0) - balance) > 0.005
+    ]
+    if drifted:
+        failures.append(f"Replayed cash differs for portfolios {drifted}")
+
+    prices = dict(_session.execute(select(Instrument.id, Instrument.price)).all())
+    mispriced = [
+        instrument_id
+        for instrument_id, price in prices.items()
+        if abs(state.prices.get(instrument_id, 0.0) - price) > 0.005
+    ]
+    if mispriced:
+        failures.append(f"Replayed prices differ for instruments {mispriced}")
+
+    over_limit = _session.execute(
+        select(Share.owner_id, Share.instrument_id)
+        .where(Share.owner_id.is_not(None))
+        .group_by(Share.owner_id, Share.instrument_id)
+        .having(func.count(Share.id) > MAX_SHARES_PER_COMPANY)
+    ).all()
+    if over_limit:
+        failures.append(f"{len(over_limit)} holdings are over the per-company limit")
+
+    return failures
+
+
+def play_season(
+    database: str,
+    members: int,
+    fortnights: int,
+    submissions: float = 4.0,
+    curve: Optional[CurveKind] = None,
+    seed: Optional[int] = None,
+) -> List[str]:
+    """Play a season on a new SQLite ``database`` file, returning the checks that failed."""
+    # Data functions report to the Streamlit page, which doesn't exist here
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    # Synthetic members are never emailed, and there may be no network to check domains
+    email_validator.CHECK_DELIVERABILITY = False
+    # Not in memory, as the bootstrap and event subscribers use connections of their own
+    Database.use_engine(create_sqlite_engine(database))
+    rng = np.random.default_rng(seed)
+
+    from src.utils import stock_game
+
+    start = perf_counter()
+    Base.metadata.create_all(bind=Database.get_engine())
+    with Database.get_sessionmaker()() as session:
+        seed_season(session, members=members, fortnights=fortnights)
+        if curve is not None:
+            add_curve(session, curve)
+        initialise()
+        stock_game.main()
+        LOGGER.info(f"Set up in {perf_counter() - start:.2f}s")
+
+        results = []
+        for fortnight in range(fortnights):
+            issue_credit(session, value=10.0)
+            results.append(play_fortnight(session, rng, fortnight, submissions))
+        trades = sum(result.trades for result in results)
+        LOGGER.info(
+            f"Played {fortnights} fortnights with {trades} trades in {perf_counter() - start:.2f}s"
+        )
+
+        failures = check(session) + check_dividends(results)
+
+    Database.get_engine().dispose()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play a synthetic season on an embedded SQLite database and check its consistency."
+    )
+    parser.add_argument(
+        "--database",
+        default=None,
+        help="SQLite database file to keep, which must not already hold a season. A temporary one by default.",
+    )
+    parser.add_argument("--members", type=int, default=10, help="Members per Claan.")
+    parser.add_argument("--fortnights", type=int, default=6)
+    parser.add_argument(
+        "--submissions",
+        type=float,
+        default=4.0,
+        help="Mean records each member submits per fortnight.",
+    )
+    parser.add_argument(
+        "--curve",
+        choices=[kind.name.lower() for kind in CurveKind],
+        default=None,
+        help="Price instruments on a curve, rather than the fixed steps.",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    with TemporaryDirectory(prefix="claans-") as directory:
+        failures = play_season(
+            database=args.database or str(Path(directory) / "season.db"),
+            members=args.members,
+            fortnights=args.fortnights,
+            submissions=args.submissions,
+            curve=CurveKind[args.curve.upper()] if args.curve else None,
+            seed=args.seed,
+        )
+
+    for failure in failures:
+        LOGGER.error(failure)
+    if failures:
+        sys.exit(1)
+    LOGGER.info(f"All checks passed in {perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
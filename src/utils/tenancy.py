@@ -0,0 +1,270 @@
+"""Several organisations served by one deployment and database.
+
+Each organisation is a :class:`~src.models.tenant.Tenant`, and every other table is
+:class:`~src.models.tenant.TenantScoped`. Code runs for the current tenant: pages pick
+it from the ``tenant`` query parameter, by slug, and pin it to the browser session
+once its ``tenant`` password has been entered, while jobs and event subscribers run for the tenant of their job or event. Without
+one, as in scripts, code runs for the default tenant, which every database has.
+
+Every ORM ``SELECT``, ``UPDATE`` and ``DELETE`` run through a session is limited to
+the current tenant's rows, including in subqueries, so the data layer needs no tenant
+filters of its own. Statements that must see every tenant, such as a worker claiming
+jobs, opt out with ``.execution_options(all_tenants=True)``. ``INSERT ... SELECT``
+statements aren't filtered, so give their select a tenant of its own.
+
+Cached loaders' keys and tags include the tenant, so tenants never share entries,
+and a write only invalidates its own tenant's.
+
+Run with ``python -m src.utils.tenancy --help`` to add tenants, or to add tenancy to
+a database created before it.
+"""
+
+import argparse
+from typing import List, Optional
+
+import streamlit as st
+from sqlalchemy import Engine, UniqueConstraint, event, inspect, select, text
+from sqlalchemy.orm import ORMExecuteState, Session, with_loader_criteria
+from sqlalchemy.schema import AddConstraint
+
+from src.models.base import Base
+from src.models.tenant import (
+    DEFAULT_TENANT,
+    Tenant,
+    TenantContext,
+    TenantScoped,
+    current_tenant,
+    set_tenant_fallback,
+)
+from src.utils.logger import LOGGER
+
+TENANT_PARAM = "tenant"
+# Columns unique across the database before tenancy, now unique within a tenant
+LEGACY_UNIQUE = {"users": ("email",), "jobs": ("key",)}
+
+
+class TenantError(Exception):
+    pass
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _limit_to_tenant(state: ORMExecuteState) -> None:
+    if not (state.is_select or state.is_update or state.is_delete):
+        return
+    if state.is_column_load or state.is_relationship_load:
+        # Loading more of rows that were already limited
+        return
+    if state.execution_options.get("all_tenants", False):
+        return
+
+    tenant_id = current_tenant().id
+    state.statement = state.statement.options(
+        with_loader_criteria(
+            TenantScoped,
+            # A closure variable, so it's a bound parameter of the cached statement
+            lambda cls: cls.tenant_id == tenant_id,
+            include_aliases=True,
+        )
+    )
+
+
+def _session_tenant() -> Optional[TenantContext]:
+    """The tenant pinned to the browser session, for callbacks and pages."""
+    # Imported here as it's internal to Streamlit
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.get("tenant")
+
+
+set_tenant_fallback(_session_tenant)
+
+
+def to_context(tenant: Tenant) -> TenantContext:
+    return TenantContext(
+        id=tenant.id,
+        slug=tenant.slug,
+        name=tenant.name,
+        email_domain=tenant.email_domain,
+    )
+
+
+def get_tenant(_session: Session, slug: str) -> Optional[TenantContext]:
+    tenant = _session.execute(
+        select(Tenant).where(Tenant.slug == slug)
+    ).scalar_one_or_none()
+
+    return to_context(tenant) if tenant is not None else None
+
+
+def get_tenants(_session: Session) -> List[TenantContext]:
+    return [
+        to_context(tenant)
+        for tenant in _session.execute(select(Tenant).order_by(Tenant.id)).scalars()
+    ]
+
+
+def select_tenant(_session: Session) -> TenantContext:
+    """Pin the tenant named by the page's query parameter to the browser session.
+
+    Tenants other than the default are only pinned once their ``tenant`` password is
+    entered, so the parameter alone doesn't open another organisation's pages.
+    Switching tenant clears the session state, so nothing loaded for one tenant is
+    shown to another. Stops the page if the tenant doesn't exist, or until its
+    password is entered.
+    """
+    slug = st.query_params.get(TENANT_PARAM, DEFAULT_TENANT.slug)
+    pinned: Optional[TenantContext] = st.session_state.get("tenant")
+    if pinned is not None and pinned.slug == slug:
+        return pinned
+
+    tenant = get_tenant(_session, slug)
+    if tenant is None:
+        st.error(f"No organisation `{slug}`")
+        st.stop()
+    if tenant.slug != DEFAULT_TENANT.slug:
+        _check_tenant_password(tenant)
+
+    if pinned is not None:
+        LOGGER.info(f"Session switched from tenant {pinned.slug} to {tenant.slug}")
+        db_session = st.session_state.get("db_session")
+        st.session_state.clear()
+        if db_session is not None:
+            st.session_state["db_session"] = db_session
+    st.session_state["tenant"] = tenant
+
+    return tenant
+
+
+def _check_tenant_password(tenant: TenantContext) -> None:
+    """Stop the page until the tenant's password has been entered."""
+    if st.secrets.get("env", {}).get("debug", False):
+        return
+
+    expected = get_password(TENANT_PARAM, tenant)
+    if expected is None:
+        st.error(f"{tenant.name} has no password set, so can't be opened")
+        st.stop()
+
+    prompt = st.empty()
+    entered = prompt.text_input(
+        f"{tenant.name} Password", type="password", key=f"tenant_password_{tenant.slug}"
+    )
+    if entered != expected:
+        if entered:
+            st.error("😕 Password incorrect")
+        st.stop()
+    prompt.empty()
+
+
+def get_password(name: str, tenant: Optional[TenantContext] = None) -> Optional[str]:
+    """A tenant's password ``name``, from ``[passwords.<slug>]`` in secrets.
+
+    For the current tenant unless given one. The default tenant's passwords are
+    ``[passwords]`` itself, as before tenancy.
+    """
+    tenant = tenant or current_tenant()
+    passwords = st.secrets["passwords"]
+    if tenant.slug != DEFAULT_TENANT.slug:
+        passwords = passwords.get(tenant.slug, {})
+
+    return passwords.get(name)
+
+
+def add_tenant(_session: Session, slug: str, name: str, email_domain: str) -> Tenant:
+    if get_tenant(_session, slug) is not None:
+        raise TenantError(f"Tenant `{slug}` already exists")
+
+    tenant = Tenant(slug=slug, name=name, email_domain=email_domain)
+    _session.add(tenant)
+    _session.commit()
+    LOGGER.info(f"Added tenant {tenant.slug} with id {tenant.id}")
+
+    return tenant
+
+
+def migrate(engine: Engine) -> None:
+    """Add tenancy to a database created before it, giving every row the default tenant.
+
+    Adds the missing ``tenant_id`` columns and tenant-aware indexes. On Postgres, the
+    old database-wide unique constraints are replaced by per-tenant ones. SQLite can't
+    drop constraints without rebuilding tables, so keeps them, which is still correct
+    while it only serves the default tenant.
+    """
+    Tenant.__table__.create(bind=engine, checkfirst=True)
+    postgres = engine.dialect.name == "postgresql"
+
+    with engine.begin() as connection:
+        tables = set(inspect(connection).get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables or "tenant_id" not in table.c:
+                continue
+            columns = {
+                column["name"] for column in inspect(connection).get_columns(table.name)
+            }
+            if "tenant_id" in columns:
+                continue
+
+            reference = " REFERENCES tenants (id) ON DELETE CASCADE" if postgres else ""
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table.name} ADD COLUMN tenant_id INTEGER NOT NULL "
+                    f"DEFAULT {DEFAULT_TENANT.id}{reference}"
+                )
+            )
+            LOGGER.info(f"Added tenant_id to {table.name}")
+
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+            if not postgres:
+                continue
+            # Postgres's names for the database-wide constraints the tenant ones replace
+            for column in LEGACY_UNIQUE.get(table.name, ()):
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"DROP CONSTRAINT IF EXISTS {table.name}_{column}_key"
+                    )
+                )
+            for constraint in table.constraints:
+                if isinstance(constraint, UniqueConstraint) and (
+                    "tenant_id" in constraint.columns
+                ):
+                    connection.execute(AddConstraint(constraint))
+
+
+def main():
+    from src.utils.database import Database
+
+    parser = argparse.ArgumentParser(description="Manage the tenants of a database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Add a tenant.")
+    add.add_argument("slug", help="Name in the page URL's ?tenant= parameter.")
+    add.add_argument("name")
+    add.add_argument(
+        "email_domain", help="Members' emails must be on a domain containing this."
+    )
+    commands.add_parser("list", help="List the tenants.")
+    commands.add_parser("migrate", help="Add tenancy to a database created before it.")
+    args = parser.parse_args()
+
+    engine = Database.get_engine()
+    if args.command == "migrate":
+        migrate(engine)
+        return
+
+    Base.metadata.create_all(bind=engine)
+    with Database.get_sessionmaker()() as session:
+        if args.command == "add":
+            try:
+                add_tenant(session, args.slug, args.name, args.email_domain)
+            except TenantError as e:
+                parser.error(str(e))
+        else:
+            for tenant in get_tenants(session):
+                print(f"{tenant.id:>4}  {tenant.slug:<24} {tenant.email_domain}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""Span tracing of page reruns, loaders, cache lookups and SQL.
+
+Each page rerun, fragment rerun and widget callback is a trace, opened with
+:func:`trace` or :func:`traced`. Inside one, loaders wrapped with :func:`~src.utils.cache.cached` add a
+span with a child for their cache lookup, every SQL statement adds a span, and code
+can add its own with :func:`span`. Outside a trace, as in jobs and scripts, spans
+cost a context variable lookup and record nothing.
+
+Off unless enabled. Finished traces are then appended to a file as OTLP JSON, one
+export request per line, as read by the OpenTelemetry Collector's ``otlpjsonfile``
+receiver. They're written by a background thread, so a rerun never waits on the
+file, and the file is rotated once it reaches ``max_mb``. Traces slower than
+``slow_ms`` are also kept in memory, for the admin page's flame summary. Configured
+from the optional ``[tracing]`` table of the secrets file::
+
+    [tracing]
+    enabled = true
+    file = "traces/spans.jsonl"   # empty to keep traces in memory only
+    max_mb = 100                  # size at which the file is rotated
+    backups = 3                   # rotated files kept
+    slow_ms = 500
+    keep = 20                     # slow traces kept in memory
+"""
+
+import json
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from os import urandom
+from pathlib import Path
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import time_ns
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.models.tenant import current_tenant
+from src.utils.logger import (
+    LOGGER,
+    get_correlation_id,
+    load_secrets_table,
+    new_correlation_id,
+)
+
+SERVICE_NAME = "claans"
+# Characters of each SQL statement kept on its span
+STATEMENT_LENGTH = 500
+# OTLP span kinds
+INTERNAL = 1
+CLIENT = 3
+# Finished traces waiting to be written, beyond which new ones are dropped
+EXPORT_QUEUE_SIZE = 1000
+
+
+@dataclass(frozen=True)
+class TracingConfig:
+    enabled: bool = False
+    file: Optional[Path] = Path("traces/spans.jsonl")
+    max_mb: float = 100.0
+    backups: int = 3
+    slow_ms: float = 500.0
+    keep: int = 20
+
+
+def get_tracing_config() -> TracingConfig:
+    """The ``[tracing]`` table of the secrets, or the defaults without one."""
+    secrets = load_secrets_table("tracing")
+    file = secrets.get("file", TracingConfig.file)
+
+    return TracingConfig(
+        enabled=secrets.get("enabled", TracingConfig.enabled),
+        file=Path(file) if file else None,
+        max_mb=float(secrets.get("max_mb", TracingConfig.max_mb)),
+        backups=int(secrets.get("backups", TracingConfig.backups)),
+        slow_ms=float(secrets.get("slow_ms", TracingConfig.slow_ms)),
+        keep=int(secrets.get("keep", TracingConfig.keep)),
+    )
+
+
+CONFIG = get_tracing_config()
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    kind: int = INTERNAL
+    start: int = field(default_factory=time_ns)
+    end: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+    children: List["Span"] = field(default_factory=list)
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time_ns()) - self.start) / 1e6
+
+    def walk(self, depth: int = 0) -> Iterator[Tuple[int, "Span"]]:
+        """This span and its descendants, depth first, with their depth."""
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+
+class _NoSpan:
+    """Stands in for a span outside a trace."""
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_exports: "Queue[Span]" = Queue(maxsize=EXPORT_QUEUE_SIZE)
+_exporter_lock = Lock()
+_exporter: Optional[Thread] = None
+SLOW_TRACES: Deque[Span] = deque(maxlen=CONFIG.keep)
+
+
+def _start(name: str, parent: Optional[Span], kind: int, attributes: dict) -> Span:
+    span = Span(
+        trace_id=parent.trace_id if parent else urandom(16).hex(),
+        span_id=urandom(8).hex(),
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        kind=kind,
+        attributes=attributes,
+    )
+    if parent is not None:
+        parent.children.append(span)
+    return span
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span | _NoSpan]:
+    """A child of the current span, or nothing outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+
+    child = _start(name, parent, INTERNAL, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = repr(e)
+        raise
+    finally:
+        child.end = time_ns()
+        _current.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[Span | _NoSpan]:
+    """Start a trace, or within one, a span.
+
+    For code that may run on its own or as part of a larger trace, such as a fragment,
+    which reruns alone or with its page.
+    """
+    if not CONFIG.enabled:
+        yield NO_SPAN
+        return
+    if _current.get() is not None:
+        with span(name, **attributes) as child:
+            yield child
+        return
+
+    attributes.setdefault("correlation_id", get_correlation_id())
+    attributes.setdefault("tenant", current_tenant().slug)
+    root = _start(name, None, INTERNAL, attributes)
+    token = _current.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = repr(e)
+        raise
+    finally:
+        # Streamlit's stop and rerun aren't exceptions, so finish the trace as usual
+        root.end = time_ns()
+        _current.reset(token)
+        _finish(root)
+
+
+@contextmanager
+def trace_rerun(page: str) -> Iterator[Span | _NoSpan]:
+    """Start a new correlation id, and trace the page's rerun under it."""
+    new_correlation_id()
+    with trace("rerun", page=page) as root:
+        yield root
+
+
+def traced(func: Callable) -> Callable:
+    """Run ``func`` in a :func:`trace` named after it.
+
+    For widget callbacks, which Streamlit runs before the rerun they trigger, and
+    fragments.
+    """
+
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        with trace(func.__qualname__):
+            return func(*args, **kwargs)
+
+    return _wrapper
+
+
+def _finish(root: Span) -> None:
+    if root.duration_ms >= CONFIG.slow_ms:
+        SLOW_TRACES.append(root)
+    if CONFIG.file is None:
+        return
+
+    _start_exporter()
+    try:
+        _exports.put_nowait(root)
+    except Full:
+        LOGGER.warning(f"Trace export queue is full, dropped trace {root.trace_id}")
+
+
+def _start_exporter() -> None:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = Thread(target=_export_forever, name="trace-export", daemon=True)
+            _exporter.start()
+
+
+def _rotate(path: Path, backups: int) -> None:
+    """Move ``path`` to ``path.1``, and each older backup along, dropping the last."""
+    for number in range(backups - 1, 0, -1):
+        older = path.with_name(f"{path.name}.{number}")
+        if older.exists():
+            older.replace(path.with_name(f"{path.name}.{number + 1}"))
+    if backups > 0:
+        path.replace(path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink()
+
+
+def _export_forever() -> None:
+    path = CONFIG.file
+    max_bytes = CONFIG.max_mb * 1024 * 1024
+    while True:
+        roots = [_exports.get()]
+        while not _exports.empty():
+            roots.append(_exports.get_nowait())
+        try:
+            lines = "".join(json.dumps(to_otlp(root)) + "\n" for root in roots)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists() and path.stat().st_size + len(lines) > max_bytes:
+                _rotate(path, CONFIG.backups)
+            with path.open("a") as file:
+                file.write(lines)
+        except Exception:
+            LOGGER.exception(f"Writing {len(roots)} traces to {path} failed")
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(root: Span) -> dict:
+    """An OTLP JSON export request holding every span of ``root``'s trace."""
+    spans = []
+    for _, item in root.walk():
+        spans.append(
+            {
+                "traceId": item.trace_id,
+                "spanId": item.span_id,
+                "parentSpanId": item.parent_id or "",
+                "name": item.name,
+                "kind": item.kind,
+                "startTimeUnixNano": str(item.start),
+                "endTimeUnixNano": str(item.end),
+                "attributes": [
+                    {"key": key, "value": _otlp_value(value)}
+                    for key, value in item.attributes.items()
+                ],
+                "status": (
+                    {"code": 2, "message": item.error} if item.error else {"code": 0}
+                ),
+            }
+        )
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": SERVICE_NAME},
+                        }
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def get_slow_traces(tenant: Optional[str] = None) -> List[Span]:
+    """Traces slower than ``slow_ms`` from this process, slowest first.
+
+    :param tenant: Only the traces of the tenant with this slug.
+    """
+    return sorted(
+        (
+            root
+            for root in SLOW_TRACES
+            if tenant is None or root.attributes.get("tenant") == tenant
+        ),
+        key=lambda root: root.duration_ms,
+        reverse=True,
+    )
+
+
+def flame(root: Span) -> List[Dict[str, Any]]:
+    """A row per span of ``root``'s trace, depth first, for a flame-style table.
+
+    Self time is a span's duration less its children's, so the rows whose self time
+    adds up to most of the root's duration are where the time went.
+    """
+    rows = []
+    for depth, item in root.walk():
+        children = sum(child.duration_ms for child in item.children)
+        rows.append(
+            {
+                "span": "  " * depth + item.name,
+                "start": round((item.start - root.start) / 1e6, 2),
+                "duration": round(item.duration_ms, 2),
+                "self": round(max(item.duration_ms - children, 0.0), 2),
+                "share": item.duration_ms / root.duration_ms
+                if root.duration_ms
+                else 0.0,
+                "detail": item.attributes.get("db.statement")
+                or ", ".join(
+                    f"{key}={value}" for key, value in item.attributes.items()
+                ),
+            }
+        )
+
+    return rows
+
+
+def trace_sql(engine: Engine) -> None:
+    """Add a span for every statement ``engine`` runs inside a trace."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is None:
+            return
+        child = _start(
+            f"SQL {statement.lstrip().split(None, 1)[0].upper()}",
+            parent,
+            CLIENT,
+            {
+                "db.system": conn.dialect.name,
+                "db.statement": statement[:STATEMENT_LENGTH],
+            },
+        )
+        conn.info.setdefault("trace_spans", []).append(child)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            child = spans.pop()
+            child.end = time_ns()
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                child.set("db.rows", cursor.rowcount)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        spans = (
+            context.connection.info.get("trace_spans") if context.connection else None
+        )
+        if spans:
+            child = spans.pop()
+            child.end = time_ns()
+            child.error = repr(context.original_exception)
@@ -0,0 +1,37 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from src.utils.startup import IMPORT_BUDGET, PAGE_BUDGETS, PAGES, profile_page
+
+# Dependencies too slow to import for pages that don't use them on every run
+HEAVY_PACKAGES = {"faker", "numpy", "pandas"}
+EAGER_PACKAGES = {
+    # Renders tables on every run
+    Path("pages/7_Admin.py"): {"numpy", "pandas"},
+}
+# A cold start's time varies with the machine's load, so a page is timed a few times
+RUNS = 3
+
+
+@pytest.mark.parametrize("page", PAGES, ids=str)
+def test_page_defers_heavy_imports(page):
+    allowed = EAGER_PACKAGES.get(page, set())
+
+    heavy = (profile_page(page).packages & HEAVY_PACKAGES) - allowed
+
+    assert not heavy, f"{page} imports {sorted(heavy)} up front"
+
+
+@pytest.mark.skipif(
+    not os.environ.get("CHECK_IMPORT_TIME"),
+    reason="Timings depend on the machine, set CHECK_IMPORT_TIME=1 to check them",
+)
+@pytest.mark.parametrize("page", PAGES, ids=str)
+def test_page_imports_within_budget(page):
+    budget = PAGE_BUDGETS.get(page, IMPORT_BUDGET)
+
+    fastest = min(profile_page(page).total for _ in range(RUNS))
+
+    assert fastest <= budget, f"{page} imports in {fastest:.3f}s, over {budget}s"
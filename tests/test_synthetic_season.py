@@ -0,0 +1,22 @@
+from src.models.market.pricing_curve import CurveKind
+from src.utils.synthetic_season import play_season
+
+
+def test_season_holds_together(tmp_path):
+    failures = play_season(
+        database=str(tmp_path / "season.db"), members=3, fortnights=2, seed=1
+    )
+
+    assert failures == []
+
+
+def test_season_on_a_curve_holds_together(tmp_path):
+    failures = play_season(
+        database=str(tmp_path / "season.db"),
+        members=3,
+        fortnights=2,
+        curve=CurveKind.LINEAR,
+        seed=1,
+    )
+
+    assert failures == []